@@ -0,0 +1,77 @@
+'''
+Measures the frame rate of the simulated camera (`FakeCalCamera`) without
+the GUI and without frame rate limit, for a static scene, a moving stage,
+and a moving focus. Also compares the cost of drawing the pipette with the
+previous implementation (blurring the sprite for every frame and pasting it
+with PIL).
+'''
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from holypipette.devices.camera import FakeCalCamera, WorldModel
+from holypipette.devices.manipulator import FakeManipulator
+from holypipette.devices.pressurecontroller import FakePressureController
+
+N_FRAMES = 200
+
+stage = FakeManipulator(min=[-1000, -1000, -1000], max=[1000, 1000, 1000])
+pipette = FakeManipulator(min=[-1000, -1000, -50], max=[4000, 20000, 20000])
+pipette.x = [200, 300, 125]
+stage.x = [0, 0, 0]
+world_model = WorldModel(pipette=pipette, pressure=FakePressureController())
+world_model.telemetry.is_enabled = False
+camera = FakeCalCamera(stageManip=stage, pipetteManip=pipette, image_z=0,
+                       targetFramerate=np.inf, worldModel=world_model)
+camera.stop_acquisition()
+
+
+def move_stage(idx):
+    stage.x[0] = idx % 500
+
+
+def move_focus(idx):
+    stage.x[2] = 20 + (idx % 100) / 2.
+
+
+for name, update in [('static', lambda idx: None),
+                     ('moving stage', move_stage),
+                     ('moving focus', move_focus)]:
+    stage.x[:] = [0, 0, 20]
+    camera.raw_snap()
+    start = time.perf_counter()
+    for idx in range(N_FRAMES):
+        update(idx)
+        camera.raw_snap()
+    elapsed = (time.perf_counter() - start) / N_FRAMES
+    print('{}: {:.2f}ms/frame ({:.0f} fps)'.format(name, elapsed*1000, 1/elapsed))
+
+
+def paste_pipette_pil(pipette, frame, x, y, focusFactor):
+    '''The previous implementation of `FakePipette.draw_pipette`.'''
+    frame = Image.fromarray(frame)
+    pipetteImg = cv2.GaussianBlur(np.array(pipette.pipetteImg), (63, 63), focusFactor)
+    pipetteImg = Image.fromarray(pipetteImg)
+    alphaMask = cv2.GaussianBlur(np.array(pipette.alphaMask), (63, 63), focusFactor / 2)
+    alphaMask = Image.fromarray((alphaMask / 1.3).astype(np.uint8))
+    frame.paste(pipetteImg, (x, y), alphaMask)
+    return np.array(frame)
+
+
+background = camera.get_microscope_image(0, 0)
+positions = [(int(x), int(y)) for x, y in zip(np.linspace(-800, 900, N_FRAMES),
+                                              np.linspace(-200, 900, N_FRAMES))]
+for name, draw in [('PIL paste', lambda frame, x, y: paste_pipette_pil(camera.pipette, frame, x, y, 2.)),
+                   ('sprite cache', lambda frame, x, y: camera.pipette.draw_pipette(frame, x, y, 2.))]:
+    start = time.perf_counter()
+    for x, y in positions:
+        draw(background.copy(), x, y)
+    elapsed = (time.perf_counter() - start) / N_FRAMES
+    print('pipette ({}): {:.2f}ms/frame'.format(name, elapsed*1000))
+
+x, y = positions[N_FRAMES // 2]
+difference = np.abs(paste_pipette_pil(camera.pipette, background.copy(), x, y, 2.).astype(int) -
+                    camera.pipette.draw_pipette(background.copy(), x, y, 2.))
+print('maximum difference between the two: {}'.format(difference.max()))
@@ -0,0 +1,57 @@
+'''
+Measures the cost per frame of the flat-field correction, compared to the
+same correction calculated in floating point.
+'''
+import time
+
+import numpy as np
+
+from holypipette.devices.camera.flatfield import FlatFieldCorrection
+
+N_FRAMES = 200
+rng = np.random.default_rng(42)
+
+for dtype, max_value, shape in [(np.uint8, 255, (768, 1024)),
+                                (np.uint8, 255, (2048, 2048)),
+                                (np.uint16, 4095, (2048, 2048))]:
+    y, x = np.mgrid[:shape[0], :shape[1]]
+    # vignetting: brighter in the center
+    illumination = 1 - 0.5*((x/shape[1] - 0.5)**2 + (y/shape[0] - 0.5)**2)
+    dark = rng.normal(0.02*max_value, 0.005*max_value, shape).clip(0, max_value)
+    flat = dark + 0.8*max_value*illumination
+    frames = [(dark + 0.5*max_value*illumination +
+               rng.normal(0, 0.01*max_value, shape)).clip(0, max_value).astype(dtype)
+              for _ in range(4)]
+
+    correction = FlatFieldCorrection()
+    correction.set_dark(dark)
+    correction.set_flat(flat)
+
+    image = frames[0].copy()
+    correction.apply(image)
+    print('{} {}x{}: corrected std {:.2f} (uncorrected {:.2f})'.format(np.dtype(dtype).name,
+                                                                     shape[1], shape[0],
+                                                                     image.std(), frames[0].std()))
+
+    start = time.perf_counter()
+    for idx in range(N_FRAMES):
+        np.copyto(image, frames[idx % len(frames)])
+        correction.apply(image)
+    integer = (time.perf_counter() - start) / N_FRAMES
+
+    gain = (flat - dark).mean() / (flat - dark)
+    start = time.perf_counter()
+    for idx in range(N_FRAMES):
+        np.copyto(image, frames[idx % len(frames)])
+        image[:] = np.clip((image - dark) * gain + 0.5, 0, max_value)
+    floating = (time.perf_counter() - start) / N_FRAMES
+
+    start = time.perf_counter()
+    for idx in range(N_FRAMES):
+        np.copyto(image, frames[idx % len(frames)])
+    copy = (time.perf_counter() - start) / N_FRAMES
+
+    print('  integer: {:.2f}ms/frame, float: {:.2f}ms/frame '
+          '(frame copy: {:.2f}ms)'.format((integer - copy)*1000,
+                                          (floating - copy)*1000,
+                                          copy*1000))
@@ -2,9 +2,9 @@
 Module defining the `TaskController` class.
 """
 import functools
-import time
 
 from holypipette.log_utils import LoggingObject
+from holypipette.utils import clock
 
 
 class RequestedAbortException(Exception):
@@ -68,18 +68,18 @@ class TaskController(LoggingObject):
             raise RequestedAbortException()
 
     def sleep(self, seconds):
-        """Convenience function that sleeps (as `time.sleep`) but remains
-        sensitive to abort requests"""
+        """Convenience function that sleeps (as `time.sleep`, but according to
+        the current `.clock`) but remains sensitive to abort requests"""
         check_every = 0.25
-        start = time.time()
+        start = clock.time()
         self.abort_if_requested()
-        while time.time() - start < (seconds-check_every):
-            time.sleep(check_every)
+        while clock.time() - start < (seconds-check_every):
+            clock.sleep(check_every)
             self.abort_if_requested()
 
-        remaining = seconds - (time.time() - start)
+        remaining = seconds - (clock.time() - start)
         if remaining > 0:
-            time.sleep(remaining)
+            clock.sleep(remaining)
         self.abort_if_requested()
 
     # SAVED STATES:
@@ -1,5 +1,5 @@
 from .base import TaskController
-from time import sleep
+from time import sleep, time
 from scipy.optimize import golden, minimize_scalar
 from numpy import array,arange
 import numpy as np
@@ -130,7 +130,7 @@ class ParameciumDeviceController(TaskController):
         Finds the center of the device.
         '''
         # Assume we are in the lighted region
-        I0 = self.camera.snap().mean()
+        I0 = self.camera.grab().mean()
         self.calibrated_stage.save_state()
 
         ## Move the stage left and right
@@ -141,7 +141,7 @@ class ParameciumDeviceController(TaskController):
         while (I>.5*I0) and (n<30):
             self.calibrated_stage.relative_move(500., axis=0)
             self.calibrated_stage.wait_until_still()
-            I = self.camera.snap().mean()
+            I = self.camera.grab(fresh_after=time()).mean()
             n += 1
         x0 = self.calibrated_stage.position(axis=0)
         self.calibrated_stage.recover_state()
@@ -154,7 +154,7 @@ class ParameciumDeviceController(TaskController):
         while (I > .5 * I0) and (n < 30):
             self.calibrated_stage.relative_move(-500., axis=0)
             self.calibrated_stage.wait_until_still()
-            I = self.camera.snap().mean()
+            I = self.camera.grab(fresh_after=time()).mean()
             n += 1
         x1 = self.calibrated_stage.position(axis=0)
         self.calibrated_stage.recover_state()
@@ -173,7 +173,7 @@ class ParameciumDeviceController(TaskController):
         while (I>.5*I0) and (n<30):
             self.calibrated_stage.relative_move(500., axis=1)
             self.calibrated_stage.wait_until_still()
-            I = self.camera.snap().mean()
+            I = self.camera.grab(fresh_after=time()).mean()
             n += 1
         y0 = self.calibrated_stage.position(axis=1)
         self.calibrated_stage.recover_state()
@@ -186,7 +186,7 @@ class ParameciumDeviceController(TaskController):
         while (I > .5 * I0) and (n < 30):
             self.calibrated_stage.relative_move(-500., axis=1)
             self.calibrated_stage.wait_until_still()
-            I = self.camera.snap().mean()
+            I = self.camera.grab(fresh_after=time()).mean()
             n += 1
         y1 = self.calibrated_stage.position(axis=1)
         self.calibrated_stage.recover_state()
@@ -1,5 +1,5 @@
 from .base import TaskController
-from time import sleep
+from time import sleep, time
 from scipy.optimize import golden, minimize_scalar
 from numpy import array,arange
 
@@ -30,10 +30,9 @@ class ParameciumDropletController(TaskController):
         def image_variance(z):
             self.microscope.absolute_move(z)
             sleep(self.config.autofocus_sleep) # more?
-            image = self.camera.snap()
-            frame = image[int(y + height / 2 - size / 2):int(y + height / 2 + size / 2),
-                    int(x + width / 2 - size / 2):int(
-                        x + width / 2 + size / 2)]  # is there a third dimension?
+            frame = self.camera.grab(fresh_after=time(),
+                                     roi=(x + width / 2 - size / 2, y + height / 2 - size / 2,
+                                          size, size))
             variance = frame.var()
             return -variance
 
@@ -77,9 +76,9 @@ class ParameciumDropletController(TaskController):
         #self.microscope.wait_until_still()
 
         # Take image of ROI
-        image = self.camera.snap()
-        frame = image[int(y+height/2-frame_height/2):int(y+height/2+frame_height/2),
-                int(x+width/2-frame_width/2):int(x+width/2+frame_width/2)] # is there a third dimension?
+        roi = (x + width / 2 - frame_width / 2, y + height / 2 - frame_height / 2,
+               frame_width, frame_height)
+        frame = self.camera.grab(fresh_after=time(), roi=roi)
         # Mean intensity and contrast of the image
         mean = mean0 = frame.mean()
         std = std0 = frame.std()
@@ -93,10 +92,7 @@ class ParameciumDropletController(TaskController):
             #self.calibrated_unit.wait_until_still(2)
             sleep(0.2)
             #self.microscope.wait_until_still()
-            image = self.camera.snap()
-            frame = image[int(y + height / 2 - frame_height / 2):int(y + height / 2 + frame_height / 2),
-                    int(x + width / 2 - frame_width / 2):int(
-                        x + width / 2 + frame_width / 2)]  # is there a third dimension?
+            frame = self.camera.grab(fresh_after=time(), roi=roi)
             # Mean intensity and contrast of the image
             mean = frame.mean()
             std = frame.std()
@@ -1,11 +1,10 @@
-import time
-
 import numpy as np
 from holypipette.devices.amplifier.amplifier import Amplifier
 from holypipette.devices.manipulator.calibratedunit import CalibratedUnit
 from holypipette.devices.manipulator.microscope import Microscope
 
 from holypipette.config import Config
+from holypipette.utils import clock
 
 from .base import TaskController
 
@@ -150,13 +149,13 @@ class AutoPatcher(TaskController):
                 if R > oldR * 1.15:  # R increases: near cell?
                     self.debug("Sealing, R = " + str(self.amplifier.resistance()/1e6))
                     self.pressure.set_pressure(self.config.pressure_sealing)
-                    t0 = time.time()
+                    t0 = clock.time()
                     t = t0
                     R = self.amplifier.resistance()
                     while (R < self.config.gigaseal_R) | (t - t0 < self.config.seal_min_time):
                         # Wait at least 15s and until we get a Gigaseal
-                        time.sleep(0.25)
-                        t = time.time()
+                        self.sleep(0.25)
+                        t = clock.time()
                         if t - t0 >= self.config.seal_deadline:
                             # No seal in 90 s
                             self.amplifier.stop_patch()
@@ -299,12 +298,13 @@ class AutoPatcher(TaskController):
                             # Still higher, we are near the cell
                             self.debug("Sealing, R = " + str(self.amplifier.resistance() / 1e6))
                             self.pressure.set_pressure(self.config.pressure_sealing)
-                            t0 = time.time()
+                            t0 = clock.time()
                             t = t0
                             R = self.amplifier.resistance()
                             while (R < self.config.gigaseal_R) | (t - t0 < self.config.seal_min_time):
                                 # Wait at least 15s and until we get a Gigaseal
-                                t = time.time()
+                                self.sleep(0.25)
+                                t = clock.time()
                                 if t - t0 < self.config.Vramp_duration:
                                     # Ramp to -70 mV in 10 s (default)
                                     self.amplifier.set_holding(
@@ -1,4 +1,4 @@
-from holypipette.devices.camera import WorldModel
+from holypipette.devices.camera import WorldModel, PipetteState
 
 import numpy as np
 import math
@@ -7,17 +7,20 @@ import time
 __all__ = ['FakeDAQ']
 
 class FakeDAQ:
-    def __init__(self, worldModel):
+    def __init__(self, worldModel, rng=None):
         self.worldModel: WorldModel = worldModel
+        #random number generator for the measurement noise
+        self.rng : np.random.Generator = rng if rng is not None else np.random.default_rng()
 
     def getDataFromSquareWave(self, wave_freq, samplesPerSec, dutyCycle, amplitude, recordingTime):
         
-        if self.worldModel.isBrokenIn() or self.worldModel.isSealed():
+        state = self.worldModel.state()  #a consistent snapshot of the simulation
+        if state.pipette_state in (PipetteState.TIP_BROKEN_IN, PipetteState.TIP_SEALED):
             #first order break-in response
                         #1st order RC response
-            res_steady_state = self.worldModel.getResistance()
-            res_peak = self.worldModel.getResistancePeak()
-            tau = self.worldModel.getTau()
+            res_steady_state = state.resistance
+            res_peak = state.resistance_peak
+            tau = state.tau
 
             I_peak = 0.01 / res_peak
             I_ss = 0.01 / res_steady_state
@@ -39,11 +42,11 @@ class FakeDAQ:
 
             #add a bit of noise
             noise_level = 5 * 1e-12
-            data += np.random.normal(0, noise_level, data.shape)
+            data += self.rng.normal(0, noise_level, data.shape)
 
         else:
             #Ohmic, squarewave response
-            resistance = self.worldModel.getResistance()
+            resistance = state.resistance
             amplitude = 0.01 / resistance
 
             data = np.zeros(int(samplesPerSec * recordingTime))
@@ -52,7 +55,7 @@ class FakeDAQ:
 
             #add a bit of noise
             noise_level = 5 * 1e-12
-            data += np.random.normal(0, noise_level, data.shape)
+            data += self.rng.normal(0, noise_level, data.shape)
 
         xdata = np.linspace(0, recordingTime, len(data), dtype=float)
 
@@ -4,15 +4,17 @@ from .camera import Camera
 import numpy as np
 import cv2
 import time
-import random
 import imageio
 import sys
 import os
+import threading
+from collections import OrderedDict, namedtuple
 from holypipette.utils.supabaseDBstuff import supabase
+from holypipette.utils import clock
 
 
 from PIL import Image, ImageDraw, ImageFilter, ImageEnhance
-from enum import Enum
+from enum import Enum, IntEnum
 
 class PipetteState(Enum):
     TIP_NORMAL = 0
@@ -23,9 +25,129 @@ class PipetteState(Enum):
     TIP_BROKEN_IN = 5
 
 
+class CellState(IntEnum):
+    INTACT = 0
+    SEALED = 1 #sealed (or sealing) to the pipette
+    PATCHED = 2 #broken in (whole-cell configuration)
+    DAMAGED = 3 #lost its seal, cannot be sealed again
+    DEAD = 4
+
+
+class CellTable():
+    '''
+    The cells of the simulated sample, built once from the connected
+    components of the cell annotation image. Every cell has a centroid and
+    a radius (in annotation pixels), a health between 0 and 1, and a
+    `CellState`. The properties are stored as arrays with one entry per cell
+    and are updated for all cells at once.
+
+    Parameters
+    ----------
+    annotations : `~numpy.ndarray`
+        The annotation image (non-zero pixels belong to cells).
+    rng : `numpy.random.Generator`, optional
+        The random number generator for the initial health of the cells.
+    '''
+    #: Connected components with fewer pixels are not considered as cells
+    min_area = 20
+    #: Health lost per second in whole-cell configuration
+    patched_decay = 0.002
+    #: Positive pressure (in mbar) that damages cells touching the pipette
+    damaging_pressure = 50
+    #: Health lost per second and mbar above `damaging_pressure`
+    pressure_damage = 0.0005
+    #: Distance (in annotation pixels) from a cell's edge at which the pipette touches it
+    contact_distance = 5
+
+    def __init__(self, annotations, rng=None):
+        if rng is None:
+            rng = np.random.default_rng()
+        n_labels, labels, stats, centroids = cv2.connectedComponentsWithStats((annotations > 0).astype(np.uint8),
+                                                                            connectivity=8)
+        keep = stats[1:, cv2.CC_STAT_AREA] >= self.min_area
+        n_cells = int(np.count_nonzero(keep))
+        #cell index for every label (-1 for the background and discarded components)
+        index = np.full(n_labels, -1, dtype=np.int16 if n_cells < 2**15 else np.int32)
+        index[1:][keep] = np.arange(n_cells)
+        #: Cell index for every pixel of the annotation image (-1 outside of cells)
+        self.labels = index[labels]
+        self.shape = self.labels.shape
+        self.centroids = centroids[1:][keep]  # (x, y)
+        self.radii = np.sqrt(stats[1:, cv2.CC_STAT_AREA][keep] / np.pi)
+        self.health = rng.uniform(0.5, 1., n_cells)
+        self.states = np.full(n_cells, CellState.INTACT, dtype=np.int8)
+
+    def __len__(self):
+        return len(self.states)
+
+    def cell_at(self, x, y):
+        '''The index of the cell at pixel ``(x, y)`` (with wrap-around), or -1.'''
+        return int(self.labels[int(y) % self.shape[0], int(x) % self.shape[1]])
+
+    def can_seal(self, cell):
+        '''Whether a pipette can seal to a cell (intact and alive).'''
+        return cell >= 0 and self.states[cell] == CellState.INTACT and self.health[cell] > 0
+
+    def distances(self, x, y):
+        '''
+        The distances of all cell centroids from pixel ``(x, y)``, on the
+        periodic sample.
+        '''
+        height, width = self.shape
+        dx = (self.centroids[:, 0] - x + width / 2) % width - width / 2
+        dy = (self.centroids[:, 1] - y + height / 2) % height - height / 2
+        return np.hypot(dx, dy)
+
+    def update(self, dt, position=None, pressure=0):
+        '''
+        Update the health and state of all cells.
+
+        Parameters
+        ----------
+        dt : float
+            The time step (in seconds).
+        position : tuple, optional
+            The position ``(x, y)`` of the pipette tip in annotation pixels,
+            or ``None`` if the tip is not close to the cells.
+        pressure : float, optional
+            The pressure (in mbar) at the pipette.
+        '''
+        health = self.health
+        health[self.states == CellState.PATCHED] -= dt * self.patched_decay
+        if position is not None and pressure > self.damaging_pressure:
+            touching = self.distances(*position) < self.radii + self.contact_distance
+            health[touching] -= dt * self.pressure_damage * (pressure - self.damaging_pressure)
+        np.clip(health, 0, 1, out=health)
+        self.states[health <= 0] = CellState.DEAD
+
+    def counts(self):
+        '''The number of cells in each `CellState`, as a dictionary.'''
+        counts = np.bincount(self.states, minlength=len(CellState))
+        return {state.name: int(counts[state]) for state in CellState}
+
+
+WorldState = namedtuple('WorldState', ['time', 'pipette_state', 'resistance',
+                                       'resistance_peak', 'tau', 'is_near_cell',
+                                       'cell'])
+WorldState.__doc__ = '''
+Immutable snapshot of the simulated world (see `WorldModel.state`), with the
+time of the simulation step, the state of the pipette, the steady-state and
+the peak resistances (in Ohms), the time constant (in seconds), whether
+the pipette is close to a cell, and the index of the cell the pipette is
+sealed to (-1 if none, see `WorldModel.cells`).
+'''
+
+
 class WorldModel():
-    def __init__(self, pipette: Manipulator, pressure: PressureController, pixels_per_micron=1, pipette_img_size=[1016, 354]):
+    #: The duration of a simulation step (in seconds)
+    step = 0.05
+    #: The probability of starting a gigaseal for each step close to a cell (without positive pressure)
+    seal_probability = 0.05
+
+    def __init__(self, pipette: Manipulator, pressure: PressureController, pixels_per_micron=1, pipette_img_size=[1016, 354], rng=None):
         self.pipette = pipette
+        #random number generator for all random draws (cell and pipette properties, seal formation)
+        self.rng : np.random.Generator = rng if rng is not None else np.random.default_rng()
         self.pressure = pressure
         self.pixels_per_micron = pixels_per_micron
         self.pipette_img_size = pipette_img_size
@@ -38,6 +160,8 @@ class WorldModel():
             self.src_folder = "holypipette/devices/camera/FakeMicroscopeImgs"
 
         self.annotations = cv2.imread(self.src_folder + "/annotation.png", cv2.IMREAD_GRAYSCALE)
+        self.cells = CellTable(self.annotations, rng=self.rng)
+        self.cell = -1 #the cell the pipette is sealed to
         self.pipette_state = PipetteState.TIP_NORMAL
 
         #setup pipette contants
@@ -45,32 +169,78 @@ class WorldModel():
         self.pipetteResistanceNoise = 0.1e6 #0.1 Mohm
 
         self.tau_range = [5 * 1e-3, 10 * 1e-3] #valid tau range
-        self.tau = np.random.uniform(self.tau_range[0], self.tau_range[1])
+        self.tau = self.rng.uniform(self.tau_range[0], self.tau_range[1])
 
         self.axis_resistance_range = [5 * 1e6, 30 * 1e6] #valid axis resistances between 5, 30 Mohm
-        self.axis_resistance = np.random.uniform(self.axis_resistance_range[0], self.axis_resistance_range[1])
+        self.axis_resistance = self.rng.uniform(self.axis_resistance_range[0], self.axis_resistance_range[1])
 
         self.seal_location = None
         self.seal_time = None
         self.time_to_seal = 5 #seconds
         self.is_near_cell = False
+        self._distFromSlip = None
 
         self.telemetry = Telemetry(is_enabled=True) #disable for packaging into exe
-    
+
+        #the simulation advances in fixed steps, readers get the snapshot of the last step
+        self._lock = threading.RLock()
+        self._start_time = self._step_time = clock.time()
+        self._steps = 0
+        self._state = None
+        #telemetry events of the steps, logged after releasing the lock (network and file I/O)
+        self._events = []
+        self._publish()
+        #with a simulated clock, advance with the clock (independent of the readers)
+        clock.get_clock().add_listener(self.advance)
+
     def _setupPipetteResistances(self):
-        self.normalResistance = np.random.randint(4e6, 7e6, dtype=np.int64) #4-7 Mohm
-        self.crashedResistance = np.random.randint(0.3e6, 2e6, dtype=np.int64) #0.3-2 Mohm
-        self.sealedResistance = np.random.randint(1e9, 2.5e9, dtype=np.int64)
-        self.brokenInResistance = np.random.randint(50e6, 250e6, dtype=np.int64) #50-250 Mohm
+        self.normalResistance = self.rng.integers(4e6, 7e6, dtype=np.int64) #4-7 Mohm
+        self.crashedResistance = self.rng.integers(0.3e6, 2e6, dtype=np.int64) #0.3-2 Mohm
+        self.sealedResistance = self.rng.integers(1e9, 2.5e9, dtype=np.int64)
+        self.brokenInResistance = self.rng.integers(50e6, 250e6, dtype=np.int64) #50-250 Mohm
+
+    def state(self):
+        '''
+        The current state of the simulation, as an immutable `WorldState`.
+        Advances the simulation first if a step is due.
+        '''
+        if clock.time() >= self._step_time + self.step * (1 - 1e-9):
+            self.advance()
+        return self._state
+
+    def advance(self, now=None):
+        '''
+        Advance the simulation in fixed steps up to the given time (defaults to
+        the current time of the `.clock`). The result only depends on the
+        times of the steps, not on how often the simulation is advanced.
+        '''
+        if now is None:
+            now = clock.time()
+        with self._lock:
+            #step times are multiples of the step (without accumulating rounding errors)
+            steps = int((now - self._start_time) / self.step + 1e-9)
+            while self._steps < steps:
+                self._steps += 1
+                self._step_time = self._start_time + self._steps * self.step
+                self._step(self._step_time)
+                self._publish()
+            events, self._events = self._events, []
+        for event in events:
+            self.telemetry.logEvent(event)
+
+    def _set_state(self, pipette_state):
+        with self._lock:
+            self.pipette_state = pipette_state
+            self._publish()
 
     def isTipBroken(self):
-        return self.pipette_state == PipetteState.TIP_BROKEN
+        return self.state().pipette_state == PipetteState.TIP_BROKEN
         
     def isSealed(self):
-        return self.pipette_state == PipetteState.TIP_SEALED
+        return self.state().pipette_state == PipetteState.TIP_SEALED
     
     def isBrokenIn(self):
-        return self.pipette_state == PipetteState.TIP_BROKEN_IN
+        return self.state().pipette_state == PipetteState.TIP_BROKEN_IN
     
     def logPressureAmbient(self):
         self.telemetry.logEvent(TelemetryEvent.PRESSURE_AMBIENT)
@@ -82,132 +252,168 @@ class WorldModel():
         self.telemetry.logEvent(TelemetryEvent.PRESSURE_BREAK_IN)
         
     def replacePipette(self):
-        self._setupPipetteResistances() #new pipette, new resistances!
+        with self._lock:
+            self._releaseCell()
+            self._setupPipetteResistances() #new pipette, new resistances!
+            self._set_state(PipetteState.TIP_NORMAL)
         self.telemetry.logEvent(TelemetryEvent.PIPETTE_REPLACED)
-        self.pipette_state = PipetteState.TIP_NORMAL
         print('PIPETTE NORMAL!')
     
     def breakPipette(self):
+        self._set_state(PipetteState.TIP_BROKEN)
         self.telemetry.logEvent(TelemetryEvent.PIPETTE_BROKEN)
-        self.pipette_state = PipetteState.TIP_BROKEN
         print('PIPETTE BROKEN!')
 
     def cleanPipette(self):
         self.telemetry.logEvent(TelemetryEvent.PIPETTE_CLEANED)
-        if self.pipette_state == PipetteState.TIP_CLOGGED:
-            self.pipette_state = PipetteState.TIP_NORMAL
-            print('PIPETTE CLEANED!')
+        with self._lock:
+            if self.pipette_state == PipetteState.TIP_CLOGGED:
+                self._set_state(PipetteState.TIP_NORMAL)
+                print('PIPETTE CLEANED!')
 
     def getTau(self):
-        return self.tau
+        return self.state().tau
 
     def getResistance(self):
         '''Get a simulated "steady-state" resistance for the pipette / system (in Ohms)
         '''
-        res = self._standardPipetteResistance()
+        return self.state().resistance
+
+    def getResistancePeak(self):
+        '''Get a axis ("peak") resistance for the pipette / system (in Ohms)
+        '''
+        return self.state().resistance_peak
+
+    def _releaseCell(self):
+        '''The pipette leaves the cell it was sealed to, the cell cannot be sealed again.'''
+        if self.cell >= 0:
+            if self.cells.states[self.cell] != CellState.DEAD:
+                self.cells.states[self.cell] = CellState.DAMAGED
+            self.cell = -1
+
+    def _step(self, t):
+        '''Advance the state of the pipette and the cells by one step, ending at time ``t``.'''
+        pipettePos = np.array(self.pipette.position())
+        distFromSlip = self._distFromSlip = pipettePos[2]
+
+        #update all cells (the pipette only touches cells when it is close to the cover slip)
+        touching = self.annotationPos(pipettePos) if 0 <= distFromSlip <= 20 else None
+        self.cells.update(self.step, touching, self.pressure.get_pressure())
+
+        if self.pipette_state != PipetteState.TIP_BROKEN and distFromSlip < 0:
+            #the pipette crashed into the cover slip (a clogged pipette breaks as well)
+            #and tears off the cell it was sealed to
+            self._releaseCell()
+            self.pipette_state = PipetteState.TIP_BROKEN
+            self._events.append(TelemetryEvent.PIPETTE_BROKEN)
+            print('PIPETTE BROKEN!')
 
         if self.pipette_state == PipetteState.TIP_BROKEN or self.pipette_state == PipetteState.TIP_CLOGGED:
-            return res
-        
-        pipettePos = self.pipette.position()
-        distFromSlip = pipettePos[2]
+            return
 
         if self.pipette_state == PipetteState.TIP_SEALED or self.pipette_state == PipetteState.TIP_SEALING or self.pipette_state == PipetteState.TIP_BROKEN_IN:
-            seal_dist = np.linalg.norm(np.array(self.seal_location) - np.array(pipettePos))
-            if distFromSlip > 20 or self.pressure.get_pressure() > 10 or seal_dist > 20:
-                #moved too far away from the cell, lose seal
+            seal_dist = np.linalg.norm(np.array(self.seal_location) - pipettePos)
+            cell_died = self.cell >= 0 and self.cells.states[self.cell] == CellState.DEAD
+            if distFromSlip > 20 or self.pressure.get_pressure() > 10 or seal_dist > 20 or cell_died:
+                #moved too far away from the cell (or the cell died), lose seal
+                self._releaseCell()
                 self.pipette_state = PipetteState.TIP_CLOGGED
-                self.telemetry.logEvent(TelemetryEvent.PIPETTE_CLOGGED)
+                self._events.append(TelemetryEvent.PIPETTE_CLOGGED)
                 print('PIPETTE CLOGGED!')
             
             if self.pressure.get_pressure() < -90 and self.pipette_state == PipetteState.TIP_SEALED:
                 #break in
                 self.pipette_state = PipetteState.TIP_BROKEN_IN
-                self.telemetry.logEvent(TelemetryEvent.BROKEN_IN)
+                self.cells.states[self.cell] = CellState.PATCHED
+                self._events.append(TelemetryEvent.BROKEN_IN)
                 print('BREAK IN!')
             
             if self.pipette_state == PipetteState.TIP_SEALING:
                 #we're in the process of sealing
-                if time.time() - self.seal_time > self.time_to_seal:
+                if t - self.seal_time > self.time_to_seal:
                     self.pipette_state = PipetteState.TIP_SEALED
-                    self.telemetry.logEvent(TelemetryEvent.GIGASEAL)
+                    self._events.append(TelemetryEvent.GIGASEAL)
                     self.seal_time = None
                     print('SEALED!')
-                    return self._standardPipetteResistance()
             elif self.seal_time is not None:
                 self.seal_time = None
-
-            return res
+            return
 
         if distFromSlip > 20 or 0 > distFromSlip:
             #we're not in the position range for patching (either broken or too far away)
-            return res
+            self.is_near_cell = False
+            return
         
-        #add a bit of resistance if we're close to a cell
-        if self.isCellAtPos((pipettePos[0], pipettePos[1])):
-            res += 0.1e6 * (20 - distFromSlip)
-
+        cell = self.cellAtPos(pipettePos)
+        if cell >= 0:
             if not self.is_near_cell:
                 self.is_near_cell = True
-                self.telemetry.logEvent(TelemetryEvent.CELL_APPROACHED)
+                self._events.append(TelemetryEvent.CELL_APPROACHED)
                 print('NEAR CELL!')
 
-            if self.pressure.get_pressure() <= 0 and random.random() < 0.05: #5% chance of gigaseal per frame
+            #cells that have been sealed before (or are dead) cannot be sealed again, unhealthy cells seal less easily
+            if (self.pressure.get_pressure() <= 0 and self.cells.can_seal(cell) and
+                    self.rng.random() < self.seal_probability * self.cells.health[cell]):
                 #gigaseal
-                self.tau = np.random.uniform(self.tau_range[0], self.tau_range[1])
-                self.axis_resistance = np.random.uniform(self.axis_resistance_range[0], self.axis_resistance_range[1])
-                self.seal_location = pipettePos.copy()
-                self.seal_time = time.time()
+                self.cell = cell
+                self.cells.states[cell] = CellState.SEALED
+                self.tau = self.rng.uniform(self.tau_range[0], self.tau_range[1])
+                self.axis_resistance = self.rng.uniform(self.axis_resistance_range[0], self.axis_resistance_range[1])
+                self.seal_location = pipettePos
+                self.seal_time = t
                 self.pipette_state = PipetteState.TIP_SEALING
                 print('Sealing to Cell!')
         
         else:
             self.is_near_cell = False
 
-        return res
+    def _publish(self):
+        '''Calculate the resistances for the current state and publish a new snapshot.'''
+        res = self._standardPipetteResistance()
+        if self.pipette_state == PipetteState.TIP_NORMAL and self.is_near_cell:
+            #add a bit of resistance if we're close to a cell
+            res += 0.1e6 * (20 - self._distFromSlip)
 
-    def getResistancePeak(self):
-        '''Get a axis ("peak") resistance for the pipette / system (in Ohms)
-        '''
         if self.pipette_state == PipetteState.TIP_BROKEN_IN:
-            return self.axis_resistance
+            peak = self.axis_resistance
         elif self.pipette_state == PipetteState.TIP_SEALED:
-            return self.getResistance() * 0.2
+            peak = res * 0.2
         else:
-            return self.getResistance()
+            peak = res
+        self._state = WorldState(self._step_time, self.pipette_state, res, peak,
+                                 self.tau, self.is_near_cell, self.cell)
         
     def _standardPipetteResistance(self):
         '''The resistance of the pipette without any cells
         '''
-        if self.isTipBroken():
-            return self.crashedResistance + np.random.random() * self.pipetteResistanceNoise
-        elif self.isSealed():
-            return self.sealedResistance + np.random.random() * self.pipetteResistanceNoise
-        elif self.isBrokenIn():
-            return self.brokenInResistance + np.random.random() * self.pipetteResistanceNoise
+        if self.pipette_state == PipetteState.TIP_BROKEN:
+            return self.crashedResistance + self.rng.random() * self.pipetteResistanceNoise
+        elif self.pipette_state == PipetteState.TIP_SEALED:
+            return self.sealedResistance + self.rng.random() * self.pipetteResistanceNoise
+        elif self.pipette_state == PipetteState.TIP_BROKEN_IN:
+            return self.brokenInResistance + self.rng.random() * self.pipetteResistanceNoise
         elif self.pipette_state == PipetteState.TIP_CLOGGED:
-            return self.normalResistance * 1.25 + np.random.random() * self.pipetteResistanceNoise
+            return self.normalResistance * 1.25 + self.rng.random() * self.pipetteResistanceNoise
         elif self.pipette_state == PipetteState.TIP_SEALING:
             #ramp up resistance as we seal
-            percent_sealed = (time.time() - self.seal_time) / self.time_to_seal
-            return self.normalResistance * 3 + 0.5 * 1e9 * percent_sealed**2 + np.random.random() * self.pipetteResistanceNoise
+            percent_sealed = (self._step_time - self.seal_time) / self.time_to_seal
+            return self.normalResistance * 3 + 0.5 * 1e9 * percent_sealed**2 + self.rng.random() * self.pipetteResistanceNoise
 
         else:
-            return self.normalResistance + np.random.random() * self.pipetteResistanceNoise
-
+            return self.normalResistance + self.rng.random() * self.pipetteResistanceNoise
 
     def _isCellAtPos(self, x, y):
-
-        #image indexing must be ints
-        x = int(x)
-        y = int(y)
-
-        if self.annotations[y, x] > 0:
-            return True
-        else:
-            return False
+        return self.cells.cell_at(x, y) >= 0
         
     def isCellAtPos(self, pipette_pos, screen_size=[1024, 1024]):
+        return self._isCellAtPos(*self.annotationPos(pipette_pos, screen_size))
+
+    def cellAtPos(self, pipette_pos, screen_size=[1024, 1024]):
+        '''The index of the cell at the pipette position (in `cells`), or -1.'''
+        return self.cells.cell_at(*self.annotationPos(pipette_pos, screen_size))
+
+    def annotationPos(self, pipette_pos, screen_size=[1024, 1024]):
+        '''The pixel ``(x, y)`` of the annotation image at the pipette position.'''
 
         #get pipette micron coords
         pipette_x = pipette_pos[0]
@@ -231,7 +437,7 @@ class WorldModel():
         while pipette_img_y < 0:
             pipette_img_y = screen_size[0] + pipette_img_y
 
-        return self._isCellAtPos(pipette_img_x, pipette_img_y)
+        return pipette_img_x, pipette_img_y
 
 
 class TelemetryEvent(Enum):
@@ -259,19 +465,56 @@ class Telemetry():
         
         time_str = time.strftime("%Y%m%d-%H%M%S")
         self.fileName = "telemetry/telemetry_" + time_str + ".csv"
-        self.initTime = time.time()
+        self.initTime = clock.time()
 
     def logEvent(self, event:TelemetryEvent):
         if not self.is_enabled:
             return
         
-        time_since_init = time.time() - self.initTime
+        time_since_init = clock.time() - self.initTime
         supabase.table("telemetry").insert({"event": event.value, "time": time_since_init}).execute()
         with open(self.fileName, 'a') as f:
             f.write(f'{time_since_init}, {event.value}\n')
 
+class FakeNoise():
+    '''
+    Camera noise for simulated frames: uniformly distributed integers in
+    ``[0, amplitude)`` added to every pixel.
+
+    Instead of generating noise for every frame (or storing many noise
+    frames), a single noise field slightly larger than the frame is generated
+    once, and every frame uses a window of it at a random offset.
+
+    The random stream is given by ``seed``, either an integer or a
+    `numpy.random.Generator`.
+    '''
+    def __init__(self, shape, amplitude=30, padding=128, seed=None):
+        self.shape = tuple(shape)
+        self.padding = padding
+        self.rng = np.random.default_rng(seed)
+        self.field = self.rng.integers(0, amplitude, (self.shape[0] + padding, self.shape[1] + padding),
+                                       dtype=np.uint8)
+
+    def add(self, frame):
+        '''
+        Add noise to a ``uint8`` frame, in place (saturating at 255).
+        '''
+        offset_y, offset_x = self.rng.integers(0, self.padding + 1, 2)
+        noise = self.field[offset_y:offset_y + frame.shape[0], offset_x:offset_x + frame.shape[1]]
+        return cv2.add(frame, noise, dst=frame)
+
+
 class FakeCalCamera(Camera):
-    def __init__(self, stageManip=None, pipetteManip=None, image_z=0, targetFramerate=40, worldModel=None):
+    #: The size of the (Gaussian) blur kernel for out of focus images
+    blur_size = 63
+    #: Blur levels (sigma) are rounded to multiples of this value
+    blur_step = 0.1
+    #: Number of fully blurred backgrounds that are kept in memory
+    blur_cache_size = 8
+    #: Number of consecutive frames at the same blur level before the whole background is blurred
+    blur_settle_frames = 5
+
+    def __init__(self, stageManip=None, pipetteManip=None, image_z=0, targetFramerate=40, worldModel=None, rng=None):
         super(FakeCalCamera, self).__init__()
         self.width : int = 1024
         self.height : int = 1024
@@ -294,21 +537,34 @@ class FakeCalCamera(Camera):
 
         self.frame = cv2.imread(self.src_folder + "/background.png", cv2.IMREAD_GRAYSCALE)
         self.frame = cv2.resize(self.frame, dsize=(self.width * 2, self.height * 2), interpolation=cv2.INTER_NEAREST)
+        self.frame.flags.writeable = False  #frames can be views of the background
 
         self.last_img = None
         self.last_stage_pos = None
 
-        #creating large noise arrays slows down fps, create 100 arrays at startup instead
-        self.noiseArrs = []
-        for _ in range(100):
-            self.noiseArrs.append((np.random.random((self.width, self.height)) * 30).astype(np.uint16))
+        #blurred versions of the whole background, by blur level (most recently used last)
+        self.blurred_frames = OrderedDict()
+        self.last_blur_level = None
+        self.blur_level_frames = 0
+        #reused buffers for crops that wrap around the background, by margin
+        self.crop_buffers = {}
+
+        #generating noise for every frame slows down fps, use windows of a pregenerated noise field instead
+        self.noise = FakeNoise((self.height, self.width), seed=rng)
+
+        #rendering frames is expensive, slow down when nothing happens: the image only
+        #changes when the stage or the pipette move (or the pipette breaks)
+        self.adaptive_rate.enabled = True
+        if self.stageManip is not None:
+            self.adaptive_rate.add_signature(lambda: self.stageManip.position_group([1, 2, 3]))
+        if self.pipetteManip is not None:
+            self.adaptive_rate.add_signature(self.pipetteManip.position)
+        if self.worldModel is not None:
+            self.adaptive_rate.add_signature(self.worldModel.isTipBroken)
 
         #start image recording thread
         self.start_acquisition()
 
-    def normalize(self):
-        print('normalize not implemented for FakeCalCamera')
-
     def set_exposure(self, value):
         if 0 < value <= 200:
             self.exposure_time = value
@@ -316,26 +572,95 @@ class FakeCalCamera(Camera):
     def get_exposure(self):
         return self.exposure_time
 
-    def get_microscope_image(self, x, y):
-        if self.last_img is None or self.last_stage_pos[0] != x or self.last_stage_pos[1] != y:
+    @staticmethod
+    def _wrapped_slices(start, length, size):
+        '''
+        Split the range ``start:start+length`` of a periodic axis of the
+        given size into (source, target) slice pairs.
+        '''
+        start = start % size
+        first = min(length, size - start)
+        slices = [(slice(start, start + first), slice(0, first))]
+        if first < length:
+            slices.append((slice(0, length - first), slice(first, length)))
+        return slices
+
+    def _crop_background(self, background, x, y, margin=0):
+        '''
+        The part of the (periodic) background that is visible at the image
+        position ``(x, y)``, with an additional ``margin`` on each side.
+        Equivalent to rolling the background by ``(y, x)`` and cropping its
+        center, but without copying the background: if the crop does not
+        wrap around, a view is returned, otherwise the (up to four) blocks
+        are copied into a reused buffer.
+        '''
+        height, width = self.height + 2*margin, self.width + 2*margin
+        rows = self._wrapped_slices(self.height//2 - margin - int(y), height, background.shape[0])
+        columns = self._wrapped_slices(self.width//2 - margin - int(x), width, background.shape[1])
+        if len(rows) == 1 and len(columns) == 1:
+            return background[rows[0][0], columns[0][0]]
+        crop = self.crop_buffers.get(margin)
+        if crop is None:
+            crop = self.crop_buffers[margin] = np.empty((height, width), dtype=background.dtype)
+        for source_rows, target_rows in rows:
+            for source_columns, target_columns in columns:
+                crop[target_rows, target_columns] = background[source_rows, source_columns]
+        return crop
+
+    def _blur_level(self, focusFactor):
+        '''The blur level (sigma) rounded to `blur_step`.'''
+        return max(int(round(focusFactor / self.blur_step)), 1) * self.blur_step
+
+    def _blurred_background(self, level):
+        '''
+        The whole background blurred with a given level. The background is
+        periodic, so it is padded with its opposite side before blurring.
+        '''
+        blurred = self.blurred_frames.get(level)
+        if blurred is None:
+            margin = self.blur_size // 2
+            padded = np.pad(self.frame, margin, mode='wrap')
+            blurred = cv2.GaussianBlur(padded, (self.blur_size, self.blur_size), level)
+            blurred = blurred[margin:-margin, margin:-margin]
+            blurred.flags.writeable = False  #frames can be views of the background
+            self.blurred_frames[level] = blurred
+            while len(self.blurred_frames) > self.blur_cache_size:
+                self.blurred_frames.popitem(last=False)
+        else:
+            self.blurred_frames.move_to_end(level)
+        return blurred
+
+    def get_microscope_image(self, x, y, focusFactor=0.1):
+        '''
+        The (blurred) background at the image position ``(x, y)``.
+        '''
+        level = self._blur_level(focusFactor)
+        if level == self.last_blur_level:
+            self.blur_level_frames += 1
+        else:
+            self.last_blur_level = level
+            self.blur_level_frames = 1
+        if self.last_img is None or self.last_stage_pos != [x, y, level]:
             #we need to recalculate what the stage sees
-            frame = np.roll(self.frame, int(y), axis=0)
-            frame = np.roll(frame, int(x), axis=1)
-            frame = frame[self.height//2:self.height//2+self.height,
-                        self.width//2:self.width//2+self.width]
-            
+            if level in self.blurred_frames or self.blur_level_frames >= self.blur_settle_frames:
+                #the focus does not change (anymore): blur the whole background
+                #once, later frames at this focus are only crops
+                frame = self._crop_background(self._blurred_background(level), x, y)
+            else:
+                #the focus is changing: only blur the visible part
+                margin = self.blur_size // 2
+                frame = self._crop_background(self.frame, x, y, margin)
+                frame = cv2.GaussianBlur(frame, (self.blur_size, self.blur_size), level)
+                frame = frame[margin:-margin, margin:-margin]
+
             #update cached frame
-            self.last_stage_pos = [x, y]
+            self.last_stage_pos = [x, y, level]
             self.last_img = frame
         else:
             frame = self.last_img
-            
-        self.frameno += 1
-        return Image.fromarray(frame)
 
-    def get_16bit_image(self):
-        #Note: use float 32 rather than int16 for opencv sobel filter compatability (focus score)
-        return (self.raw_snap().astype(np.float32) / 255) * 65535 
+        self.frameno += 1
+        return frame
 
     def get_frame_no(self):
         return self.frameno
@@ -357,26 +682,20 @@ class FakeCalCamera(Camera):
         #get background at current stage position
         img_x = -stage_x * self.pixels_per_micron
         img_y = -stage_y * self.pixels_per_micron
-        frame = self.get_microscope_image(img_x, img_y)
-
         #blur cover slip proportionally to how far stage_z is from 0 (being focused in the img plane)
         focusFactor = abs(stage_z - self.image_z) / 10
-        if focusFactor == 0:
-            focusFactor = 0.1 #prevent division by zero
-
-        frame = cv2.GaussianBlur(np.array(frame), (63,63), focusFactor)
-        frame = Image.fromarray(frame)
+        frame = self.get_microscope_image(img_x, img_y, focusFactor)
+        frame = frame.copy()  #the background is cached
 
         #add pipette to image
         frame = self.pipette.add_pipette_to_img(frame, [stage_x, stage_y, stage_z])
 
         #add noise, exposure
         exposure_factor = self.exposure_time/30.
+        if exposure_factor != 1:
+            frame = cv2.convertScaleAbs(frame, alpha=exposure_factor)
 
-        frame = frame + self.noiseArrs[self.frameno % len(self.noiseArrs)] #use pregenerated noise to increase fps
-        frame[np.where(frame >= 255)] = 255
-        frame[np.where(frame < 0)] = 0
-        frame = frame.astype(np.uint8)
+        self.noise.add(frame)
 
         dt = time.time() - start
         if dt < (1/self.targetFramerate):
@@ -385,6 +704,12 @@ class FakeCalCamera(Camera):
         return frame
     
 class FakePipette():
+    #: The size of the (Gaussian) blur kernel for an out of focus pipette
+    blur_size = 63
+    #: Blur levels (sigma) are rounded to multiples of this value
+    blur_step = 0.1
+    #: Number of blurred sprites (pipette or broken pipette at one blur level) kept in memory
+    sprite_cache_size = 64
 
     def __init__(self, manipulator:Manipulator, microscope_pixels_per_micron, stage_to_pipette=np.eye(4,4), worldModel=None):
 
@@ -411,8 +736,11 @@ class FakePipette():
         self.pipetteImageBroken = Image.open(self.src_folder + "/pipette_crashed.png").convert("L")
         self.pipetteImageBroken, self.alphaMaskBroken = self._processPipetteImage(self.pipetteImageBroken)
 
-        
-    
+        #blurred sprites by (broken, blur level), most recently used last
+        self.sprites = OrderedDict()
+        #reused buffer for the alpha blending
+        self.blend_buffer = None
+
     def _processPipetteImage(self, image):
         image = image.resize((image.size[0] * 4, image.size[1] * 2), Image.Resampling.BILINEAR)
         filter = ImageEnhance.Brightness(image)
@@ -423,7 +751,71 @@ class FakePipette():
         alphaMask = filter.enhance(1.2)
         return image, alphaMask
 
-    def add_pipette_to_img(self, frame:Image, stagePos:list):
+    def _sprite(self, broken, focusFactor):
+        '''
+        The pipette sprite blurred for a given focus factor, as a tuple of the
+        alpha-weighted image (``sprite * alpha``) and the complementary alpha
+        (``255 - alpha``), both as ``uint16``.
+        '''
+        level = max(int(round(focusFactor / self.blur_step)), 1) * self.blur_step
+        key = (broken, level)
+        sprite = self.sprites.get(key)
+        if sprite is not None:
+            self.sprites.move_to_end(key)
+            return sprite
+        if broken:
+            pipetteImg, alphaMask = self.pipetteImageBroken, self.alphaMaskBroken
+        else:
+            pipetteImg, alphaMask = self.pipetteImg, self.alphaMask
+        size = (self.blur_size, self.blur_size)
+        pipetteImg = cv2.GaussianBlur(np.array(pipetteImg), size, level)
+        alphaMask = cv2.GaussianBlur(np.array(alphaMask), size, level / 2)
+        alphaMask = (alphaMask / 1.3).astype(np.uint16)
+        sprite = (pipetteImg * alphaMask, 255 - alphaMask)
+        self.sprites[key] = sprite
+        while len(self.sprites) > self.sprite_cache_size:
+            self.sprites.popitem(last=False)
+        return sprite
+
+    def draw_pipette(self, frame, x, y, focusFactor, broken=False):
+        '''
+        Blend the (blurred) pipette sprite into a frame, in place.
+
+        Parameters
+        ----------
+        frame : `~numpy.ndarray`
+            The ``uint8`` frame.
+        x, y : int
+            The position of the upper left corner of the sprite in the frame
+            (can be outside of the frame).
+        focusFactor : float
+            The blur level (sigma of the Gaussian blur).
+        broken : bool, optional
+            Whether to draw the broken pipette. Defaults to ``False``.
+        '''
+        weighted, inverse = self._sprite(broken, focusFactor)
+        #only blend the part of the sprite that is within the frame
+        top, left = max(y, 0), max(x, 0)
+        bottom = min(y + weighted.shape[0], frame.shape[0])
+        right = min(x + weighted.shape[1], frame.shape[1])
+        if bottom <= top or right <= left:
+            return frame
+        target = frame[top:bottom, left:right]
+        sprite_rows = slice(top - y, bottom - y)
+        sprite_columns = slice(left - x, right - x)
+
+        if self.blend_buffer is None or self.blend_buffer.shape != weighted.shape:
+            self.blend_buffer = np.empty(weighted.shape, dtype=np.uint16)
+        blended = self.blend_buffer[:bottom - top, :right - left]
+        #(frame * (255 - alpha) + sprite * alpha) / 255, rounded
+        np.multiply(target, inverse[sprite_rows, sprite_columns], out=blended)
+        blended += weighted[sprite_rows, sprite_columns]
+        blended += 127
+        blended //= 255
+        np.copyto(target, blended, casting='unsafe')
+        return frame
+
+    def add_pipette_to_img(self, frame:np.ndarray, stagePos:list):
 
         # print(self.manipulator.position(), self.manipulator.raw_position())
         #get stage micron coords
@@ -441,9 +833,6 @@ class FakePipette():
         pipette_pos_stage_coords_h = np.matmul(self.pipette_to_stage, pipette_pos_h.T)
         pipette_pos_stage_coords = pipette_pos_stage_coords_h[0:3] / pipette_pos_stage_coords_h[3]
 
-        if not self.worldModel.isTipBroken() and pipette_pos_stage_coords[2] < 0:
-            self.worldModel.breakPipette()
-
         #get pipette position in image coordinates
         pipette_pos_img_coords = pipette_pos_stage_coords * self.pixels_per_micron
 
@@ -453,26 +842,7 @@ class FakePipette():
 
         #blur pipette proportionally to distance between stage_z and pipette_z
         focusFactor = abs(stage_z - pipette_pos_stage_coords[2]) / 10
-        if focusFactor == 0:
-            focusFactor = 0.1 #resolve divide by 0 error
 
-        if self.worldModel.isTipBroken():
-            pipetteImg = self.pipetteImageBroken
-            alphaMask = self.alphaMaskBroken
-        else:
-            pipetteImg = self.pipetteImg
-            alphaMask = self.alphaMask
-
-        #blur img
-        pipetteImg = cv2.GaussianBlur(np.array(pipetteImg), (63,63), focusFactor)
-        pipetteImg = Image.fromarray(pipetteImg)
-
-        #blur alpha channel
-        alphaMask = cv2.GaussianBlur(np.array(alphaMask), (63,63), focusFactor / 2)
-        alphaMask = alphaMask / 1.3
-        alphaMask = Image.fromarray(alphaMask.astype(np.uint8))
-
-        #add pipette to frame
-        frame.paste(pipetteImg, (pipette_img_x, pipette_img_y), alphaMask)
-        frame = np.array(frame) #convert back to numpy for opencv support
-        return frame
\ No newline at end of file
+        #add pipette to frame (blurred sprites are cached by blur level)
+        return self.draw_pipette(frame, pipette_img_x, pipette_img_y, focusFactor,
+                                 broken=self.worldModel.isTipBroken())
\ No newline at end of file
@@ -1,3 +1,13 @@
 from __future__ import absolute_import
 from .camera import *
+from .framepool import *
+from .subscription import *
+from .recording import *
+from .overlay import *
+from .pipelinestats import *
+from .autoexposure import *
+from .displaylut import *
+from .flatfield import *
+from .adaptiverate import *
+from .processcamera import *
 from .FakeCalCamera import *
@@ -0,0 +1,179 @@
+'''
+Adaptive acquisition rate: slow down the acquisition when nothing happens.
+
+As long as the devices do not move, the image does not change, and nobody
+needs frames at the full rate (e.g. a recording, or a running task), the
+acquisition thread only acquires frames at a low idle rate. It returns to the
+full rate as soon as any of these conditions changes. Explicit activity (a
+command from the user, a request for a fresh frame) wakes the acquisition
+immediately, changes detected in the device positions or in the image are
+noticed with the next idle frame.
+
+The policy is disabled by default: for a hardware camera, skipping frames
+saves nothing, and small changes in the image (e.g. drift) would only show up
+in the live view with a delay. `.FakeCalCamera`, which spends most of its
+time rendering frames, enables it.
+'''
+import contextlib
+import threading
+import time
+
+import numpy as np
+
+__all__ = ['AdaptiveRate']
+
+
+class AdaptiveRate(object):
+    '''
+    The adaptive acquisition rate policy of a `.Camera` (see
+    `.Camera.adaptive_rate`).
+
+    Parameters
+    ----------
+    idle_rate : float, optional
+        The frame rate (in Hz) when idle. Defaults to 2.
+    idle_after : float, optional
+        The time (in seconds) without any activity before the acquisition
+        switches to the idle rate. Defaults to 2.
+    scene_threshold : float, optional
+        The mean absolute change of the image (at 1/8 resolution, as a
+        fraction of the full intensity range) that is considered as activity.
+        Defaults to 0.01.
+    scene_interval : float, optional
+        The minimum time (in seconds) between two comparisons of the image.
+        Defaults to 0.25.
+    enabled : bool, optional
+        Whether the acquisition rate is adapted at all. Defaults to ``False``.
+    '''
+    def __init__(self, idle_rate=2., idle_after=2., scene_threshold=0.01,
+                 scene_interval=0.25, enabled=False):
+        self.idle_rate = idle_rate
+        self.idle_after = idle_after
+        self.scene_threshold = scene_threshold
+        self.scene_interval = scene_interval
+        self.enabled = enabled
+        self._condition = threading.Condition()
+        self._last_activity = time.time()
+        self._demands = 0
+        self._signatures = []
+        self._last_signature = None
+        self._last_scene = None
+        self._last_scene_check = 0
+        self._subscribers_demand = False
+        #: Number of frames acquired at the idle rate
+        self.idle_frames = 0
+
+    def wake(self):
+        '''
+        Signal activity: return to the full rate immediately (also if the
+        acquisition thread is currently waiting for the next idle frame).
+        '''
+        with self._condition:
+            self._last_activity = time.time()
+            self._condition.notify_all()
+
+    def demand_full_rate(self):
+        '''
+        Acquire at the full rate until the matching call of
+        `release_full_rate` (calls can be nested).
+        '''
+        with self._condition:
+            self._demands += 1
+            self._last_activity = time.time()
+            self._condition.notify_all()
+
+    def release_full_rate(self):
+        '''End a demand for the full rate made with `demand_full_rate`.'''
+        with self._condition:
+            self._demands = max(self._demands - 1, 0)
+            self._last_activity = time.time()
+
+    @contextlib.contextmanager
+    def full_rate(self):
+        '''Context manager acquiring at the full rate while it is active.'''
+        self.demand_full_rate()
+        try:
+            yield
+        finally:
+            self.release_full_rate()
+
+    def add_signature(self, signature):
+        '''
+        Add a function describing the state of a device (e.g. returning its
+        position). It is called for every frame, whenever its return value
+        changes, this is considered as activity.
+        '''
+        self._signatures.append(signature)
+
+    @property
+    def idle(self):
+        '''Whether the acquisition currently runs at the idle rate.'''
+        return (self.enabled and not self._demands and
+                not self._subscribers_demand and
+                time.time() - self._last_activity > self.idle_after)
+
+    def _scene_changed(self, frame):
+        image = frame.downsampled(3, 'raw')
+        if image is None:
+            return False
+        previous = self._last_scene
+        if previous is None or previous.shape != image.shape:
+            self._last_scene = image.astype(np.float32)
+            return False
+        change = np.mean(np.abs(image - previous))
+        if np.issubdtype(image.dtype, np.integer):
+            change /= np.iinfo(image.dtype).max
+        if change > self.scene_threshold:
+            self._last_scene = image.astype(np.float32)
+            return True
+        return False
+
+    def update(self, frame, subscribers_demand=False):
+        '''
+        Check a new frame (and the device signatures) for activity. Called by
+        the acquisition thread for every frame.
+
+        Parameters
+        ----------
+        frame : `.PooledFrame`
+            The new frame.
+        subscribers_demand : bool, optional
+            Whether a subscription demands the full rate.
+        '''
+        if not self.enabled:
+            return
+        self._subscribers_demand = subscribers_demand
+        # Copies, since devices might return the same (updated) array
+        signature = [np.array(s()) for s in self._signatures]
+        active = False
+        if self._last_signature is not None:
+            active = any(np.any(old != new) for old, new in zip(self._last_signature,
+                                                                signature))
+        self._last_signature = signature
+        now = time.time()
+        if self.idle:
+            self.idle_frames += 1
+        if now - self._last_scene_check > self.scene_interval or self.idle:
+            self._last_scene_check = now
+            active = self._scene_changed(frame) or active
+        if active:
+            with self._condition:
+                self._last_activity = now
+
+    def wait(self, frame_start):
+        '''
+        Wait until the next frame should be acquired (returns immediately at
+        the full rate, or if `wake` is called while waiting).
+
+        Parameters
+        ----------
+        frame_start : float
+            The time (as returned by `time.time`) the acquisition of the last
+            frame started.
+        '''
+        with self._condition:
+            if not self.idle:
+                return
+            delay = frame_start + 1. / self.idle_rate - time.time()
+            if delay > 0:
+                self._condition.wait(delay)
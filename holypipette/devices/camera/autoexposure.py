@@ -0,0 +1,237 @@
+'''
+Auto exposure from frame statistics.
+
+Instead of searching for the right exposure with a new acquisition for every
+candidate value, the exposure is predicted from the histogram of a single
+(subsampled) frame: the camera response is close to linear in the exposure
+time, so the exposure that brings a given percentile of the intensities to
+the target level follows directly from the current exposure and the current
+value of that percentile. Deviations from linearity (offset, saturation) are
+corrected by repeating the prediction with the next two or three frames.
+
+The same prediction, damped and with a tolerance band, is used by
+`AutoExposureThread` to continuously follow changes in illumination.
+'''
+import threading
+import time
+
+import numpy as np
+
+__all__ = ['frame_percentile', 'predict_exposure', 'AutoExposure',
+           'AutoExposureThread']
+
+
+def frame_percentile(image, percentile=50, step=4, max_value=None):
+    '''
+    The intensity at a given percentile of an image, calculated from the
+    histogram of a subsampled version of the image.
+
+    Parameters
+    ----------
+    image : `~numpy.ndarray`
+        The image (all channels of color images are taken into account).
+    percentile : float, optional
+        The percentile (between 0 and 100). Defaults to 50 (the median).
+    step : int, optional
+        Only every ``step``-th pixel in each direction is used. Defaults to 4.
+    max_value : int, optional
+        The saturation level of the camera. Defaults to the maximum value of
+        the image's data type.
+
+    Returns
+    -------
+    value : float
+        The intensity at the given percentile.
+    saturated : float
+        The fraction of pixels at the saturation level.
+    '''
+    sample = np.asarray(image)[::step, ::step]
+    if max_value is None:
+        max_value = (np.iinfo(sample.dtype).max
+                     if np.issubdtype(sample.dtype, np.integer) else 1.)
+    if sample.dtype.kind != 'u' or sample.dtype.itemsize > 2:
+        # No cheap histogram for signed, float, or 32bit images
+        values = sample.ravel()
+        return (float(np.percentile(values, percentile)),
+                float(np.count_nonzero(values >= max_value)) / values.size)
+    histogram = np.bincount(sample.ravel(), minlength=int(max_value) + 1)
+    cumulative = np.cumsum(histogram)
+    total = cumulative[-1]
+    value = np.searchsorted(cumulative, percentile / 100. * total)
+    saturated = histogram[int(max_value):].sum()
+    return float(min(value, max_value)), float(saturated / total)
+
+
+def predict_exposure(exposure, value, target, max_value, max_ratio=4.):
+    '''
+    Predict the exposure that brings an intensity to the target level,
+    assuming a linear camera response.
+
+    Parameters
+    ----------
+    exposure : float
+        The exposure of the frame.
+    value : float
+        The intensity measured in the frame (e.g. with `frame_percentile`).
+    target : float
+        The target intensity.
+    max_value : float
+        The saturation level of the camera. The response of saturated frames
+        is unknown, their exposure is reduced by ``max_ratio``.
+    max_ratio : float, optional
+        The maximum factor by which the exposure changes. Defaults to 4.
+
+    Returns
+    -------
+    exposure : float
+        The predicted exposure.
+    '''
+    if value >= max_value:
+        ratio = 1. / max_ratio
+    elif value <= 0:
+        ratio = max_ratio
+    else:
+        ratio = min(max(target / value, 1. / max_ratio), max_ratio)
+    return exposure * ratio
+
+
+class AutoExposure(object):
+    '''
+    Parameters of the statistics-based auto exposure (see `.Camera.auto_exposure`
+    and `.Camera.start_auto_exposure`).
+
+    Parameters
+    ----------
+    target : float, optional
+        The target intensity as a fraction of the saturation level. Defaults
+        to 0.5.
+    percentile : float, optional
+        The percentile of the intensities that is brought to the target.
+        Defaults to 50 (the median).
+    tolerance : float, optional
+        The relative deviation from the target that is accepted. Defaults to
+        0.05.
+    min_exposure, max_exposure : float, optional
+        The range of exposures (in ms). Defaults to 0.1ms and 100ms.
+    step : int, optional
+        The subsampling of the frames (see `frame_percentile`). Defaults to 4.
+    max_value : int, optional
+        The saturation level of the camera. Defaults to the maximum value of
+        the frames' data type.
+    roi : tuple, optional
+        A region of interest ``(x, y, width, height)`` used for the
+        statistics. Defaults to the full frame.
+    '''
+    def __init__(self, target=0.5, percentile=50, tolerance=0.05,
+                 min_exposure=0.1, max_exposure=100., step=4, max_value=None,
+                 roi=None):
+        self.target = target
+        self.percentile = percentile
+        self.tolerance = tolerance
+        self.min_exposure = min_exposure
+        self.max_exposure = max_exposure
+        self.step = step
+        self.max_value = max_value
+        self.roi = roi
+
+    def evaluate(self, image):
+        '''
+        The current and the target intensity for an image.
+
+        Returns
+        -------
+        value, target, max_value : float
+            The intensity at the percentile, the target intensity, and the
+            saturation level.
+        '''
+        max_value = self.max_value
+        if max_value is None:
+            max_value = (np.iinfo(image.dtype).max
+                         if np.issubdtype(image.dtype, np.integer) else 1.)
+        value, _ = frame_percentile(image, self.percentile, step=self.step,
+                                    max_value=max_value)
+        return value, self.target * max_value, max_value
+
+    def next_exposure(self, exposure, image, gain=1.):
+        '''
+        The exposure for the next frame.
+
+        Parameters
+        ----------
+        exposure : float
+            The exposure the image was acquired with.
+        image : `~numpy.ndarray`
+            The image.
+        gain : float, optional
+            The fraction of the predicted change (on a logarithmic scale)
+            that is applied, values below 1 damp the adjustment. Defaults to 1.
+
+        Returns
+        -------
+        exposure : float or None
+            The new exposure, or ``None`` if the image is within the tolerance
+            (or the exposure cannot change any further).
+        '''
+        value, target, max_value = self.evaluate(image)
+        if abs(value - target) <= self.tolerance * target:
+            return None
+        predicted = predict_exposure(exposure, value, target, max_value)
+        if gain != 1:
+            predicted = exposure * (predicted / exposure) ** gain
+        predicted = min(max(predicted, self.min_exposure), self.max_exposure)
+        if predicted == exposure:
+            return None
+        return predicted
+
+
+class AutoExposureThread(threading.Thread):
+    '''
+    Continuously adjusts the exposure of a camera to follow changes in
+    illumination. The statistics are calculated for a few frames per second
+    only, and frames acquired before the last change of exposure are ignored.
+
+    Parameters
+    ----------
+    camera : `.Camera`
+        The camera.
+    auto_exposure : `AutoExposure`
+        The parameters of the auto exposure.
+    rate : float, optional
+        The maximum number of frames per second that are evaluated. Defaults
+        to 5.
+    gain : float, optional
+        The fraction of the predicted change that is applied for every
+        frame. Defaults to 0.5.
+    '''
+    def __init__(self, camera, auto_exposure, rate=5., gain=0.5):
+        self.camera = camera
+        self.auto_exposure = auto_exposure
+        self.gain = gain
+        self.running = True
+        self.subscription = camera.subscribe('rate_hz', rate=rate, maxlen=1,
+                                             roi=auto_exposure.roi)
+        threading.Thread.__init__(self, name='auto_exposure_thread', daemon=True)
+
+    def run(self):
+        last_change = 0
+        try:
+            while self.running:
+                frame = self.subscription.get(timeout=0.5)
+                if frame is None:
+                    if self.subscription.closed:
+                        break
+                    continue
+                with frame:
+                    if frame.timestamp < last_change:
+                        continue  # acquired with the previous exposure
+                    exposure = self.camera.get_exposure()
+                    if exposure <= 0:
+                        break
+                    new_exposure = self.auto_exposure.next_exposure(exposure,
+                                                                    frame.image,
+                                                                    gain=self.gain)
+                if new_exposure is not None:
+                    last_change = time.time()
+                    self.camera.set_exposure(new_exposure)
+        finally:
+            self.subscription.unsubscribe()
@@ -8,9 +8,10 @@ from __future__ import print_function
 import collections
 import os
 import datetime
+import numbers
 import time
 import threading
-import imageio
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont
@@ -18,37 +19,110 @@ from scipy.ndimage.filters import gaussian_filter
 from scipy.ndimage import fourier_gaussian
 import warnings
 import traceback
-from scipy.optimize import brentq
 try:
     import cv2
 except:
     warnings.warn('OpenCV not available')
 from PIL import Image
 
+from .framepool import FramePool, downsample, processed_format
+from .subscription import FrameSubscription, roi_slices
+from .recording import RecordingWriter, RECORDING_EXTENSION, compress_frame
+from .overlay import FrameOverlay, draw_overlay
+from .pipelinestats import PipelineStats
+from .autoexposure import AutoExposure, AutoExposureThread
+from .displaylut import DisplayLUT
+from .flatfield import FlatFieldCorrection
+from .adaptiverate import AdaptiveRate
+
 __all__ = ['Camera', 'FakeCamera', 'RecordedVideoCamera']
 
 
-class FileWriteThread(threading.Thread): # saves frames individually
+class FileWriteThread(threading.Thread): # saves frames to a single recording file
+    '''
+    Writes the frames of a subscription to a recording file. If ``workers`` is
+    larger than 0, frames are compressed in parallel by a pool of worker
+    threads and then written to the file in their original order.
+    '''
     def __init__(self, *args, **kwds):
-        self.queue = kwds.pop('queue')
+        self.subscription = kwds.pop('subscription')
         self.debug_write_delay = kwds.pop('debug_write_delay', 0)
         self.directory = kwds.pop('directory')
         self.file_prefix = kwds.pop('file_prefix')
         self.skip_frames = kwds.pop('skip_frames', 0)
+        self.compression = kwds.pop('compression', None)
+        self.compression_level = kwds.pop('compression_level', None)
+        self.workers = kwds.pop('workers', 0)
         threading.Thread.__init__(self, *args, **kwds)
         self.first_frame = None
         self.start_time = None
         self.last_report = None
         self.written_frames = 0
+        #: Total number of frames written to the file
+        self.total_written = 0
+        #: Total number of frames skipped (see ``skip_frames``)
+        self.total_skipped = 0
         self.running = True
         self.skipped = -1
+        self.writer = None
+        self.file_name = os.path.join(self.directory,
+                                      (self.file_prefix or 'recording') + RECORDING_EXTENSION)
+        self._executor = None
+        # Frames handed to the compression workers, in recording order
+        self._pending = collections.deque()
+        self._worker_stats = {}
+        self._last_worker_stats = {}
+        self._stats_lock = threading.Lock()
 
-    def write_frame(self):
-        frame_number, creation_time, elapsed_time, frame = self.queue.popleft()
-        if frame_number is None:
-            # Marker for end of recording
-            return False
-        
+    def _compress(self, frame):
+        start = time.time()
+        image = frame.image
+        data = compress_frame(image, self.compression, self.compression_level)
+        name = threading.current_thread().name
+        with self._stats_lock:
+            stats = self._worker_stats.setdefault(name, {'frames': 0,
+                                                         'raw_bytes': 0,
+                                                         'compressed_bytes': 0,
+                                                         'busy_time': 0.})
+            stats['frames'] += 1
+            stats['raw_bytes'] += image.nbytes
+            stats['compressed_bytes'] += len(data)
+            stats['busy_time'] += time.time() - start
+        return data
+
+    def worker_stats(self):
+        '''
+        Statistics about the frames compressed by each worker (the writer
+        thread itself if there are no workers).
+
+        Returns
+        -------
+        stats : dict
+            A dictionary mapping the worker name to a dictionary with the
+            number of frames (``'frames'``), the total size before and after
+            compression (``'raw_bytes'`` and ``'compressed_bytes'``), and the
+            time spent compressing (``'busy_time'``).
+        '''
+        with self._stats_lock:
+            return {name: dict(stats) for name, stats in self._worker_stats.items()}
+
+    def report_worker_stats(self, interval):
+        stats = self.worker_stats()
+        for name in sorted(stats):
+            last = self._last_worker_stats.get(name, {'frames': 0,
+                                                      'raw_bytes': 0,
+                                                      'compressed_bytes': 0})
+            frames = stats[name]['frames'] - last['frames']
+            raw_bytes = stats[name]['raw_bytes'] - last['raw_bytes']
+            compressed_bytes = stats[name]['compressed_bytes'] - last['compressed_bytes']
+            ratio = raw_bytes / compressed_bytes if compressed_bytes else 0
+            print('  {}: {:.1f} fps, compression ratio {:.2f}'.format(name,
+                                                                      frames / interval,
+                                                                      ratio))
+        self._last_worker_stats = stats
+
+    def write_frame(self, frame):
+        frame_number = frame.number
         # Make all frame numbers relative to the first frame
         if self.first_frame is None:
             self.first_frame = frame_number
@@ -57,51 +131,110 @@ class FileWriteThread(threading.Thread): # saves frames individually
         frame_number -= self.first_frame
         # If desired, skip frames
         self.skipped += 1
-        if self.skipped >= self.skip_frames:
-            self.skipped = -1
-            fname = os.path.join(self.directory, '{}_{:05d}.tiff'.format(self.file_prefix, frame_number))
-            with imageio.get_writer(fname, software='holypipette') as writer:
-                writer.append_data(frame, meta={'datetime': creation_time,
-                                                'description': 'Time since start of recording: {}'.format(repr(elapsed_time))})
-            self.written_frames += 1
-            time.sleep(self.debug_write_delay)
-            if time.time() - self.last_report > 1:
-                frame_rate = self.written_frames / (time.time() - self.last_report)
-                print('Writing {:.1f} fps (total frames written: {})'.format(frame_rate, frame_number))
-                self.last_report = time.time()
-                self.written_frames = 0
+        if self.skipped < self.skip_frames:
+            self.total_skipped += 1
+            frame.release()
+            return
+        self.skipped = -1
+        if self._executor is not None:
+            self._pending.append((frame, frame_number,
+                                  self._executor.submit(self._compress, frame)))
+            # Do not let the workers get too far ahead of the writer
+            self._write_compressed(block=len(self._pending) > 2*self.workers)
+        else:
+            try:
+                data = self._compress(frame) if self.compression is not None else None
+                self._store(frame, frame_number, data)
+            finally:
+                # Give the frame back to the pool
+                frame.release()
 
-        return True
+    def _write_compressed(self, block=False):
+        '''
+        Write the frames whose compression has finished, in recording order. If
+        ``block`` is set, waits for the oldest frame to be compressed.
+        '''
+        while self._pending and (block or self._pending[0][2].done()):
+            frame, frame_number, future = self._pending.popleft()
+            block = False
+            try:
+                self._store(frame, frame_number, future.result())
+            finally:
+                # Give the frame back to the pool
+                frame.release()
+
+    def _store(self, frame, frame_number, data):
+        overlay = frame.overlay
+        self.writer.write(frame.image, frame_number, frame.timestamp,
+                          frame.elapsed_time, frame.creation_time, data=data,
+                          metadata=overlay.to_dict() if overlay is not None else None)
+        self.subscription.camera.timing.record_latency('write', frame.timestamp)
+        self.written_frames += 1
+        self.total_written += 1
+        time.sleep(self.debug_write_delay)
+        if time.time() - self.last_report > 1:
+            interval = time.time() - self.last_report
+            frame_rate = self.written_frames / interval
+            print('Writing {:.1f} fps (total frames written: {})'.format(frame_rate, frame_number))
+            if self.compression is not None:
+                self.report_worker_stats(interval)
+            self.last_report = time.time()
+            self.written_frames = 0
 
     def run(self):
         self.running = True
         if not os.path.exists(self.directory):
             os.makedirs(self.directory)
-        
-        while self.running:
-            try:
-                if len(self.queue) > self.queue.maxlen // 2:
-                    print('WARNING: FileWriteThread queue is getting full ({}/{})'.format(len(self.queue),
-                                                                                          self.queue.maxlen))
-                if not self.write_frame():
-                    break
-            except IndexError:
-                # queue is emtpy, wait
-                time.sleep(0.01)
-                # TODO: Store image metadata to file as well?
-
-        if len(self.queue):
-            print('Still need to write {} images to disk.'.format(len(self.queue)))
-            while len(self.queue):
-                if not self.write_frame():
+        self.writer = RecordingWriter(self.file_name,
+                                      metadata={'software': 'holypipette',
+                                                'skip_frames': self.skip_frames},
+                                      compression=self.compression,
+                                      level=self.compression_level)
+        if self.workers > 0 and self.compression is not None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                thread_name_prefix='compression_worker')
+        try:
+            while self.running:
+                queued = len(self.subscription) - self.subscription.spill_waiting
+                if queued > self.subscription.maxlen // 2 and self.subscription.spilled == 0:
+                    print('WARNING: FileWriteThread queue is getting full ({}/{})'.format(queued,
+                                                                                          self.subscription.maxlen))
+                frame = self.subscription.get(timeout=0.1)
+                if frame is None:
+                    if self.subscription.closed:
+                        break  # end of recording
+                    self._write_compressed()
+                    continue
+                self.write_frame(frame)
+
+            if len(self.subscription):
+                print('Still need to write {} images to disk.'.format(len(self.subscription)))
+            while True:
+                frame = self.subscription.get(timeout=0)
+                if frame is None:
                     break
+                self.write_frame(frame)
+            while self._pending:
+                self._write_compressed(block=True)
+        finally:
+            for frame, _, _ in self._pending:
+                frame.release()
+            self._pending.clear()
+            if self._executor is not None:
+                self._executor.shutdown()
+            self.writer.close()
+            # Release frames that could not be written and remove the spill file
+            self.subscription.unsubscribe()
 
 
 class AcquisitionThread(threading.Thread):
-    def __init__(self, camera, queues, raw_queues):
+    '''
+    Continuously acquires frames into the camera's `.FramePool`, and offers
+    each new frame to the camera's subscriptions. When nothing happens, the
+    acquisition slows down to an idle rate (see `.Camera.adaptive_rate`).
+    '''
+    def __init__(self, camera):
         self.camera = camera
-        self.queues = queues
-        self.raw_queues = raw_queues
         self.running = True
 
         threading.Thread.__init__(self, name='image_acquire_thread', daemon=True)
@@ -110,36 +243,60 @@ class AcquisitionThread(threading.Thread):
         self.running = True
 
         start_time = time.time()
-        last_report = start_time
-        acquired_frames = 0
         last_frame = 0
+        timing = self.camera.timing
+        adaptive_rate = self.camera.adaptive_rate
+        # Whether the camera provides a hardware frame counter
+        has_counter = True
         while self.running:
             snap_time = time.time()
             try:
-                raw, processed = self.camera.snap()
+                slot = self.camera._snap_into_pool()
             except Exception as ex:
                 print('something went wrong acquiring an image, waiting for 100ms: ')
                 traceback.print_exception(type(ex), ex, ex.__traceback__)
 
                 time.sleep(.1)
                 continue
-            # Put image into queues for disk storage and display
-            for queue in self.queues:
-                queue.append((last_frame, datetime.datetime.now(), snap_time - start_time, processed))
-            for queue in self.raw_queues:
-                queue.append((last_frame, datetime.datetime.now(), snap_time - start_time, raw))
+            if slot is None:
+                # The frame pool is exhausted (reported by the pool)
+                continue
+            frame_time, frame_number = self.camera._acquisition_info(slot, snap_time,
+                                                                     last_frame)
+            timing.record_latency('snap', frame_time)
+            pool = self.camera._frame_pool
+            flat_field = self.camera.flat_field
+            if flat_field.active:
+                correct_start = time.time()
+                if flat_field.apply(pool.buffer(slot)):
+                    timing.record_latency('correct', correct_start)
+            counter = None
+            if has_counter:
+                try:
+                    counter = self.camera.get_frame_no()
+                except NotImplementedError:
+                    has_counter = False
+            timing.record_frame(frame_time, counter)
+            # Note that the frame is not preprocessed here, this is only done
+            # when a consumer asks for the processed frame
+            frame = pool.publish(slot, frame_number, frame_time, frame_time - start_time,
+                                 datetime.datetime.now(),
+                                 overlay=self.camera.overlay_state())
+            # Hand the frame to the subscribers (display, disk storage, ...)
+            enqueue_start = time.time()
+            for subscription in self.camera._subscriptions:
+                subscription._offer(frame)
+            timing.record_latency('enqueue', enqueue_start)
+            adaptive_rate.update(frame, any(subscription.full_rate
+                                            for subscription in self.camera._subscriptions))
+            self.camera._set_latest_frame(frame)
 
             last_frame += 1
-            acquired_frames += 1
-            if snap_time - last_report > 1:
-                frame_rate = acquired_frames / (snap_time - last_report)
-                # print('Acquiring {:.1f} fps'.format(frame_rate))
-                last_report = snap_time
-                acquired_frames = 0
-        
-        # Put the end marker into the queues
-        for queue in self.queues:
-            queue.append((None, None, None, None))
+            self.camera._wait_for_next_frame(snap_time)
+
+        # Signal the end of the stream to all subscribers
+        for subscription in self.camera._subscriptions:
+            subscription.close()
 
 
 class Camera(object):
@@ -150,85 +307,636 @@ class Camera(object):
     """
     def __init__(self):
         super(Camera, self).__init__()
-        self._file_queue = None
-        self._last_frame_queue = collections.deque(maxlen=1)
-        self.raw_frame_queue = collections.deque(maxlen=1)
+        self._file_subscription = None
         self._acquisition_thread = None
         self._file_thread = None
+        self._auto_exposure_thread = None
         self._debug_write_delay = 0
         self.width = 1000
         self.height = 1000
         self.flipped = False # Horizontal flip
 
+        # Preallocated buffers for acquired frames (created with the first frame)
+        self.frame_pool_size = 8
+        self._frame_pool = None
+        self._latest_frame = None
+        self._latest_lock = threading.Lock()
+        # Notified whenever a new frame becomes the latest frame
+        self._frame_condition = threading.Condition(self._latest_lock)
+        self._new_frame_checked = None
+        # Replaced (not modified) when subscriptions are added or removed, so
+        # that the acquisition thread can iterate over it without locking
+        self._subscriptions = ()
+        self._subscriptions_lock = threading.Lock()
+        # Frames dropped by subscriptions that have been closed
+        self._subscriptions_dropped = 0
+        #: The region ``(x, y, width, height)`` of the sensor that is read out
+        #: (see `set_hardware_roi`), or ``None`` for the full sensor
+        self.hardware_roi = None
+        # Whether the frame pool has to be recreated for a new frame size
+        self._reset_frame_pool = False
+
         self.stop_show_time = 0
         self.point_to_show = None
         self.cell_list = []
+
+        #: Timing statistics of the acquisition pipeline (see `pipeline_stats`)
+        self.timing = PipelineStats()
+        #: Mapping of frames to 8 bits for display (16-bit frames are
+        #: displayed with automatic contrast)
+        self.display_lut = DisplayLUT(auto=True)
+        #: Dark-frame and flat-field correction, applied in place to the raw
+        #: frames (see `capture_dark_frame` and `capture_flat_frame`)
+        self.flat_field = FlatFieldCorrection()
+        #: Policy slowing down the acquisition when the devices and the image
+        #: are static, and nobody needs the full frame rate (disabled by
+        #: default, enabled by `.FakeCalCamera`)
+        self.adaptive_rate = AdaptiveRate()
     
     def show_point(self, point, color=(255, 0, 0), radius=10, duration=1.5):
         self.point_to_show = [point, radius, color]
         self.stop_show_time = time.time() + duration
 
     def start_acquisition(self):
-        self._acquisition_thread = AcquisitionThread(camera=self,
-                                                     queues=[self._last_frame_queue],
-                                                     raw_queues=[self.raw_frame_queue])
+        self._acquisition_thread = AcquisitionThread(camera=self)
         self._acquisition_thread.start()
     
     def stop_acquisition(self):
         self._acquisition_thread.running = False
 
-    def start_recording(self, directory='', file_prefix='', skip_frames=0, queue_size=1000):
-        if len(self._acquisition_thread.queues) > 1:
-            del self._acquisition_thread.queues[1]
-        self._file_queue = collections.deque(maxlen=queue_size)
-        self._acquisition_thread.queues.append(self._file_queue)
-        self._file_thread = FileWriteThread(queue=self._file_queue,
+    def subscribe(self, policy='latest', maxlen=None, kind='raw', n=None,
+                  rate=None, held=0, spill=False, spill_directory=None,
+                  roi=None, level=0, full_rate=None):
+        '''
+        Subscribe to the stream of acquired frames.
+
+        Parameters
+        ----------
+        policy : str, optional
+            Which frames to deliver and how to handle a subscriber that does
+            not keep up: ``'latest'`` (default), ``'lossless'``,
+            ``'every_nth'``, or ``'rate_hz'``. See `.FrameSubscription` for
+            details.
+        maxlen : int, optional
+            The maximum number of frames waiting in the subscription. Always
+            1 for the ``'latest'`` policy, defaults to 100 otherwise. Only a
+            few of them (`.FrameSubscription.pooled_frames`) hold a slot of
+            the frame pool, the others are copies.
+        kind : str, optional
+            Whether `.PooledFrame.image` returns the ``'raw'`` (default) or
+            the ``'processed'`` image.
+        n : int, optional
+            The frame interval for the ``'every_nth'`` policy.
+        rate : float, optional
+            The maximum frame rate (in Hz) for the ``'rate_hz'`` policy.
+        held : int, optional
+            The number of frames the consumer keeps after retrieving them
+            from the subscription (reserved in the frame pool).
+        spill : bool, optional
+            Whether a ``'lossless'`` subscription copies frames to a
+            temporary file instead of dropping them when it is full.
+        spill_directory : str, optional
+            The directory for the temporary file. Defaults to the system's
+            directory for temporary files.
+        roi : tuple, optional
+            Only deliver this region ``(x, y, width, height)`` of the frames,
+            in sensor pixels (e.g. from `.CalibratedUnit.camera_roi`). The
+            region is copied into small buffers owned by the subscription.
+        level : int, optional
+            Deliver images downsampled to 1/2, 1/4, or 1/8 of their width and
+            height (level 1, 2, or 3). The downsampled images are calculated
+            once per frame and shared by all subscriptions.
+        full_rate : bool, optional
+            Whether the subscription needs frames at the full rate, i.e.
+            prevents the acquisition from slowing down when nothing happens
+            (see `adaptive_rate`). Defaults to ``True`` for the
+            ``'lossless'`` policy, and to ``False`` otherwise.
+
+        Returns
+        -------
+        subscription : `.FrameSubscription`
+            The subscription. Can be iterated over, or queried with
+            `.FrameSubscription.get`. Should be ended with
+            `.FrameSubscription.unsubscribe` (or used as a context manager).
+        '''
+        if maxlen is None:
+            maxlen = 1 if policy == 'latest' else 100
+        subscription = FrameSubscription(self, policy=policy, maxlen=maxlen,
+                                         kind=kind, n=n, rate=rate, held=held,
+                                         spill=spill,
+                                         spill_directory=spill_directory,
+                                         roi=roi, level=level,
+                                         full_rate=full_rate)
+        with self._subscriptions_lock:
+            self._subscriptions = self._subscriptions + (subscription, )
+        if subscription.full_rate:
+            self.adaptive_rate.wake()
+        if self._frame_pool is not None:
+            # Make sure the pool can hold all frames waiting in the subscriptions
+            self._frame_pool.grow(self._required_pool_size())
+        return subscription
+
+    def _remove_subscription(self, subscription):
+        with self._subscriptions_lock:
+            if subscription in self._subscriptions:
+                self._subscriptions_dropped += subscription.dropped
+            self._subscriptions = tuple(s for s in self._subscriptions
+                                        if s is not subscription)
+        pool = self._frame_pool
+        if pool is not None:
+            # Give back the slots that were reserved for the subscription
+            pool.shrink(self._required_pool_size())
+
+    def _required_pool_size(self):
+        # Larger backlogs of subscriptions are copied out of the pool
+        return self.frame_pool_size + sum(s.pool_slots
+                                          for s in self._subscriptions)
+
+    def set_hardware_roi(self, roi):
+        '''
+        Restrict the readout of the camera to a region of the sensor, if the
+        camera supports it. Smaller frames can usually be acquired at a
+        higher rate. Regions of interest of subscriptions and of `grab` are
+        still given in full sensor coordinates.
+
+        Parameters
+        ----------
+        roi : tuple or None
+            The region ``(x, y, width, height)`` in sensor pixels, or ``None``
+            to read out the full sensor.
+
+        Returns
+        -------
+        supported : bool
+            Whether the camera applied the region. If not, frames still cover
+            the full sensor.
+        '''
+        if roi is not None:
+            roi = tuple(int(round(v)) for v in roi)
+        if not self._set_hardware_roi(roi):
+            return False
+        self.hardware_roi = roi
+        self._reset_frame_pool = True
+        return True
+
+    def _set_hardware_roi(self, roi):
+        '''
+        Apply a hardware region of interest (see `set_hardware_roi`). Has to
+        be implemented by camera drivers that support it, and return ``True``
+        if the region has been applied.
+        '''
+        return False
+
+    def roi_offset(self):
+        '''
+        The position ``(x, y)`` of the frames' top-left corner on the sensor.
+        '''
+        if self.hardware_roi is None:
+            return (0, 0)
+        return self.hardware_roi[:2]
+
+    def _crop(self, image, roi, level=0):
+        '''
+        Returns a copy of the region of interest ``(x, y, width, height)`` of
+        an image (in sensor coordinates, clipped to the image borders), or of
+        the full image if ``roi`` is ``None``. For images from the pyramid
+        level ``level``, the region is scaled accordingly.
+        '''
+        if roi is not None:
+            scale = 2**level
+            offset = [o / scale for o in self.roi_offset()]
+            image = image[roi_slices([v / scale for v in roi], image.shape, offset)]
+        return image.copy()
+
+    def start_recording(self, directory='', file_prefix='', skip_frames=0, queue_size=1000,
+                        compression=None, compression_level=None, workers=0,
+                        lossless=False, spill_directory=None):
+        '''
+        Start recording the raw frames to a file in ``directory``. The overlay
+        state of each frame (see `overlay_state`) is stored as frame metadata,
+        so that overlays can be drawn on playback with `.draw_overlay`.
+
+        Parameters
+        ----------
+        directory : str, optional
+            The directory for the recording file (created if necessary).
+        file_prefix : str, optional
+            The name of the recording file (without extension).
+        skip_frames : int, optional
+            The number of frames to skip after each recorded frame.
+        queue_size : int, optional
+            The maximum number of frames waiting to be written in memory.
+        compression : str, optional
+            A lossless compression method (see `.COMPRESSIONS`). Frames are
+            stored uncompressed by default.
+        compression_level : int, optional
+            The compression level. Defaults to the default level of the method.
+        workers : int, optional
+            The number of threads compressing frames in parallel. By default,
+            frames are compressed by the thread writing the file.
+        lossless : bool, optional
+            Whether frames that do not fit into the queue are copied to a
+            temporary file (and written later), instead of being dropped.
+            Defaults to ``False``.
+        spill_directory : str, optional
+            The directory for the temporary file used in ``lossless`` mode.
+            Defaults to the system's directory for temporary files.
+        '''
+        if self._file_subscription is not None:
+            self._file_subscription.close()
+        # Frames being compressed are no longer in the queue, but still use
+        # space in the frame pool
+        held = 2*workers + 1 if compression is not None else 0
+        self._file_subscription = self.subscribe(policy='lossless',
+                                                 maxlen=queue_size,
+                                                 kind='raw',
+                                                 held=held,
+                                                 spill=lossless,
+                                                 spill_directory=spill_directory)
+        self._file_thread = FileWriteThread(subscription=self._file_subscription,
                                             directory=directory,
                                             file_prefix=file_prefix,
                                             skip_frames=skip_frames,
+                                            compression=compression,
+                                            compression_level=compression_level,
+                                            workers=workers,
                                             debug_write_delay=self._debug_write_delay)
         self._file_thread.start()
 
+    def recording_stats(self):
+        '''
+        Frame counts for the current (or the last) recording.
+
+        Returns
+        -------
+        stats : dict or None
+            A dictionary with the number of frames acquired during the
+            recording (``'acquired'``), written to the file (``'written'``),
+            skipped because of ``skip_frames`` (``'skipped'``), copied to
+            the spill file (``'spilled'``), dropped (``'dropped'``), and still
+            waiting to be written (``'waiting'``), as well as whether the
+            file is still being written (``'active'``). ``None`` if nothing
+            has been recorded yet.
+        '''
+        if self._file_thread is None:
+            return None
+        subscription = self._file_thread.subscription
+        return {'acquired': subscription.received,
+                'written': self._file_thread.total_written,
+                'skipped': self._file_thread.total_skipped,
+                'spilled': subscription.spilled,
+                'dropped': subscription.dropped,
+                'waiting': len(subscription),
+                'active': self._file_thread.is_alive()}
+
     def stop_recording(self):
+        if self._file_subscription is not None:
+            # No new frames, the remaining ones will be written by the thread
+            self._file_subscription.close()
+            self._file_subscription = None
         if self._file_thread:
             self._file_thread.running = False
 
     def flip(self):
         self.flipped = not self.flipped
 
-    def preprocess(self, img):
-        #convert to rgb
-        if len(img.shape)==2:
-            img = cv2.cvtColor(img.copy(), cv2.COLOR_GRAY2RGB)
-        else:
-            img = img.copy()
+    def overlay_state(self):
+        '''
+        The current overlay state (calibration point, cell outlines, and
+        horizontal flip), stored with every acquired frame.
 
-        #draw a temporary point if needed (used to show pipette tip during cal)
+        Returns
+        -------
+        overlay : `.FrameOverlay`
+        '''
         if time.time() - self.stop_show_time < 0:
-            if self.point_to_show is not None:
-                img = cv2.circle(img, self.point_to_show[0], self.point_to_show[1], self.point_to_show[2], 3)
+            point_to_show = self.point_to_show
+        else:
+            point_to_show = None
+        return FrameOverlay(tuple(self.cell_list), point_to_show, self.flipped)
 
-        #draw cell outlines
-        for cell in self.cell_list:
-            img = cv2.circle(img, cell, 10, (0, 255, 0), 3)
-        
-        if self.flipped:
-            if len(img.shape)==2:
-                return np.array(img[:,::-1])
-            else:
-                return np.array(img[:,::-1,:])
+    def preprocess(self, img, out=None, overlay=None):
+        '''
+        Converts the image to 8-bit RGB (see `display_lut`) and draws the
+        overlays (calibration point, cell outlines) on it.
+
+        Parameters
+        ----------
+        img : `~numpy.ndarray`
+            The raw image.
+        out : `~numpy.ndarray`, optional
+            A ``uint8`` buffer for the result, of shape ``img.shape`` (color
+            images) or ``img.shape + (3,)`` (grayscale images). If not
+            provided, a new array is allocated.
+        overlay : `.FrameOverlay`, optional
+            The overlay state to draw. Defaults to the current state (see
+            `overlay_state`).
+
+        Returns
+        -------
+        processed : `~numpy.ndarray`
+            The processed image (``out``, if provided).
+        '''
+        if overlay is None:
+            overlay = self.overlay_state()
+        if not self.display_lut.is_identity(img.dtype):
+            # Map to 8 bits with a single table lookup
+            img = self.display_lut.apply(img, out=self.display_lut.buffer(img.shape))
+        return draw_overlay(img, overlay, out=out)
+
+    def average_frames(self, n_frames=16, timeout=5.):
+        '''
+        The average of the next ``n_frames`` raw frames from the acquisition
+        stream, without flat-field correction.
+
+        Returns
+        -------
+        average : `~numpy.ndarray`
+            The average frame (as ``float32``).
+        '''
+        enabled = self.flat_field.enabled
+        self.flat_field.enabled = False
+        try:
+            # Frames already in the pipeline might still be corrected
+            after = self.wait_for_frame(timeout=timeout)
+            if after is None:
+                raise TimeoutError('No frame received from the camera within '
+                                   '{}s'.format(timeout))
+            after.release()
+            total = None
+            with self.subscribe('lossless', maxlen=n_frames) as subscription:
+                for _ in range(n_frames):
+                    frame = subscription.get(timeout=timeout)
+                    if frame is None:
+                        raise TimeoutError('No frame received from the camera '
+                                           'within {}s'.format(timeout))
+                    with frame:
+                        if total is None:
+                            total = np.zeros(frame.raw.shape, dtype=np.float64)
+                        total += frame.raw
+        finally:
+            self.flat_field.enabled = enabled
+        return (total / n_frames).astype(np.float32)
+
+    def capture_dark_frame(self, n_frames=16):
+        '''
+        Acquires the dark frame for the flat-field correction, averaged over
+        ``n_frames`` frames. The light path has to be closed.
+        '''
+        self.flat_field.set_dark(self.average_frames(n_frames))
+
+    def capture_flat_frame(self, n_frames=16):
+        '''
+        Acquires the flat frame for the flat-field correction, averaged over
+        ``n_frames`` frames. The illumination has to be on, with an empty
+        field of view (or a slightly defocused, uniform sample).
+        '''
+        self.flat_field.set_flat(self.average_frames(n_frames))
+
+    def normalize(self):
+        '''
+        Stretches the contrast of the displayed images to the intensity
+        distribution of the current frame (see `.DisplayLUT.auto_contrast`).
+        '''
+        self.display_lut.auto_contrast(self.grab())
+
+    def _process_frame(self, raw, out, overlay):
+        '''
+        Calculates the processed version of a frame in the frame pool (called
+        lazily by the pool), with the overlay state at acquisition time.
+        '''
+        start = time.time()
+        self.preprocess(raw, out=out, overlay=overlay)
+        self.timing.record_latency('preprocess', start)
+
+    def _snap_into_pool(self):
+        '''
+        Acquires a new frame into a free slot of the frame pool. The pool is
+        created (or recreated, if the frame shape changed) from the first
+        frame.
+
+        Returns
+        -------
+        slot : int or None
+            The slot containing the new frame, or ``None`` if the pool is
+            exhausted (the frame is dropped in this case).
+        '''
+        pool = self._frame_pool
+        if pool is None or self._reset_frame_pool:
+            self._reset_frame_pool = False
+            raw = self.raw_snap()
+            processed_shape, processed_dtype = processed_format(raw.shape,
+                                                                raw.dtype)
+            pool = self._frame_pool = FramePool(raw.shape, raw.dtype,
+                                                size=self._required_pool_size(),
+                                                processor=self._process_frame,
+                                                processed_shape=processed_shape,
+                                                processed_dtype=processed_dtype)
+            slot = pool.acquire()
+            np.copyto(pool.buffer(slot), raw)
+            return slot
+        slot = pool.acquire()
+        if slot is None:
+            # Keep the camera going, but drop the frame
+            self.raw_snap()
+            return None
+        try:
+            self.raw_snap_into(pool.buffer(slot))
+        except Exception:
+            pool.discard(slot)
+            if self._reset_frame_pool:
+                return None  # the frame size changed during the acquisition
+            raise
+        return slot
+
+    def _acquisition_info(self, slot, snap_time, frame_number):
+        '''
+        The acquisition time and the frame number of the frame that
+        `_snap_into_pool` has just written into ``slot``. By default, the time
+        the frame was requested and the number of frames acquired before it.
+        Cameras that acquire frames elsewhere (e.g. in another process) can
+        report their own values.
+        '''
+        return snap_time, frame_number
+
+    def _wait_for_next_frame(self, frame_start):
+        '''
+        Wait until the acquisition thread should acquire the next frame, i.e.
+        slow down to the idle rate of `adaptive_rate` if nothing happens.
+        Cameras that acquire frames elsewhere (e.g. in another process) have
+        to slow down the acquisition there instead.
+        '''
+        self.adaptive_rate.wait(frame_start)
+
+    def _set_latest_frame(self, frame):
+        '''
+        Replaces the most recent frame (takes over the reference held by
+        ``frame``).
+        '''
+        with self._latest_lock:
+            previous = self._latest_frame
+            self._latest_frame = frame
+            self._frame_condition.notify_all()
+        if previous is not None:
+            previous.release()
+
+    def wait_for_frame(self, after=None, timeout=None):
+        '''
+        Wait for a new frame, without polling.
+
+        Parameters
+        ----------
+        after : int, optional
+            Wait for a frame with a number larger than ``after``. Defaults
+            to the number of the current frame, i.e. waits for the next
+            frame. If a newer frame is already available, it is returned
+            immediately.
+        timeout : float, optional
+            The maximum time to wait (in seconds). Waits indefinitely if not
+            specified.
+
+        Returns
+        -------
+        frame : `.PooledFrame` or None
+            The most recent frame (which has to be released with
+            `.PooledFrame.release`), or ``None`` if no new frame arrived
+            before the timeout.
+        '''
+        # Do not wait for the next idle frame
+        self.adaptive_rate.wake()
+        with self._frame_condition:
+            if after is None:
+                after = self._latest_frame.number if self._latest_frame is not None else -1
+            if not self._frame_condition.wait_for(lambda: (self._latest_frame is not None and
+                                                           self._latest_frame.number > after),
+                                                  timeout=timeout):
+                return None
+            return self._latest_frame.borrow()
+
+    def borrow_last_frame(self):
+        '''
+        Get a reference to the most recent frame. The frame is guaranteed not
+        to be overwritten before it is released with `.PooledFrame.release`.
+
+        Returns
+        -------
+        frame : `.PooledFrame` or None
+            The most recent frame, or ``None`` if no frame has been acquired
+            yet.
+        '''
+        with self._latest_lock:
+            if self._latest_frame is None:
+                return None
+            return self._latest_frame.borrow()
+
+    def frame_pool_stats(self):
+        '''
+        Usage statistics of the frame pool (see `.FramePool.stats`), including
+        the number of frames dropped because a subscription was full
+        (``'subscription_dropped'``).
+        '''
+        if self._frame_pool is None:
+            stats = {'size': 0, 'in_use': 0, 'exhausted': 0}
         else:
-            return img
+            stats = self._frame_pool.stats()
+        stats['subscription_dropped'] = (self._subscriptions_dropped +
+                                         sum(s.dropped for s in self._subscriptions))
+        return stats
+
+    def pipeline_stats(self):
+        '''
+        Timing statistics for the stages of the acquisition pipeline (acquiring,
+        correcting, preprocessing, and handing frames to subscribers, as well as the
+        latency until frames are displayed and written to disk), and gaps in
+        the hardware frame counter. See `.PipelineStats.summary` for details.
+        '''
+        return self.timing.summary()
 
     def new_frame(self):
         '''
-        Returns True if a new frame is available
+        Returns True if a new frame has been acquired since the last call of
+        this function.
         '''
+        latest = self._latest_frame
+        if latest is None:
+            return False
+        number = latest.number
+        if number == self._new_frame_checked:
+            return False
+        self._new_frame_checked = number
         return True
 
+    def grab(self, fresh_after=None, roi=None, processed=False, level=0,
+             timeout=5.):
+        '''
+        Returns a copy of a frame from the acquisition stream. Contrary to
+        `snap`, this does not acquire an additional image, but waits for the
+        acquisition thread if necessary.
+
+        Parameters
+        ----------
+        fresh_after : float or int, optional
+            If a float, return the first frame whose acquisition started at or
+            after this time (as returned by `time.time`), e.g. to get an image
+            taken after a movement. If an integer, return the first frame with
+            a number larger than this. By default, returns the most recent
+            frame.
+        roi : tuple, optional
+            A region of interest ``(x, y, width, height)`` in sensor pixels.
+            Only this part of the image (clipped to the image borders) is
+            copied.
+        processed : bool, optional
+            Whether to return the processed image (see `preprocess`) instead
+            of the raw image. Defaults to ``False``.
+        level : int, optional
+            Return the image downsampled to 1/2, 1/4, or 1/8 of its width and
+            height (level 1, 2, or 3), from the pyramid shared by all
+            consumers of the frame (see `.PooledFrame.downsampled`). Defaults
+            to 0 (full size).
+        timeout : float, optional
+            The maximum time to wait for the frame (in seconds). Defaults to
+            5s.
+
+        Returns
+        -------
+        image : `~numpy.ndarray`
+            A copy of the (part of the) image.
+        '''
+        if self._acquisition_thread is None or not self._acquisition_thread.is_alive():
+            # No acquisition stream, acquire the image directly
+            image = self.raw_snap()
+            if processed:
+                image = self.preprocess(image)
+            for _ in range(level):
+                image = downsample(image)
+            return self._crop(image, roi, level)
+        if fresh_after is None:
+            frame = self.borrow_last_frame()
+        else:
+            frame = None
+        deadline = time.time() + timeout
+        by_number = isinstance(fresh_after, numbers.Integral)
+        after = fresh_after if by_number else -1
+        while frame is None:
+            frame = self.wait_for_frame(after=after,
+                                        timeout=max(0, deadline - time.time()))
+            if frame is None:
+                raise TimeoutError('No frame received from the camera within '
+                                   '{}s'.format(timeout))
+            if fresh_after is not None and not by_number and frame.timestamp < fresh_after:
+                # Acquisition started too early
+                after = frame.number
+                frame.release()
+                frame = None
+        with frame:
+            image = frame.downsampled(level, 'processed' if processed else 'raw')
+            return self._crop(image, roi, level)
+
     def snap(self):
         '''
-        Returns a processed and a raw image
+        Returns a raw and a processed image. Note that this acquires a new
+        image independent of the acquisition thread, and always preprocesses
+        it. Use `grab` to get an image from the acquisition stream instead.
         '''
         raw = self.raw_snap()
         return raw, self.preprocess(raw)
@@ -236,25 +944,38 @@ class Camera(object):
     def raw_snap(self):
         return None
 
+    def raw_snap_into(self, out):
+        '''
+        Acquires a new image directly into the given buffer. By default, this
+        copies the result of `raw_snap`, cameras that can write into an
+        existing buffer should overwrite it.
+        '''
+        np.copyto(out, self.raw_snap())
+
     def get_16bit_image(self):
         '''
-        Returns the current image as a 16-bit color image
+        Returns a copy of the most recent frame as a 16-bit image (8-bit
+        frames are scaled to the full 16-bit range).
         '''
-        return None
+        image = self.grab()
+        if image.dtype == np.uint8:
+            return np.multiply(image, 257, dtype=np.uint16)
+        return image
 
     def last_frame(self):
         '''
-        Get the last snapped frame and its number
+        Get the last snapped frame and its number. The returned image is a
+        read-only view on the frame pool, use `borrow_last_frame` to make sure
+        that it is not overwritten while it is used.
 
         Returns
         -------
         (frame_number, frame)
         '''
-        try:
-            last_entry = self._last_frame_queue[0]
-            return last_entry[0], last_entry[-1]
-        except IndexError:  # no frame (yet)
+        latest = self._latest_frame
+        if latest is None:  # no frame (yet)
             return None
+        return latest.number, latest.processed
 
     def close(self):
         """Shut down the camera device, free resources, etc."""
@@ -271,21 +992,82 @@ class Camera(object):
         if self.get_exposure() > 0:
             self.set_exposure(self.get_exposure() + change)
 
-    def auto_exposure(self):
+    def auto_exposure(self, max_iterations=3, **kwds):
         '''
-        Auto exposure assumes frames are 8 bits.
+        Adjusts the exposure so that the median intensity of the frames is at
+        half of the saturation level (by default). The exposure is predicted
+        from the histogram of the current frame, and refined with the
+        following frames (see `.AutoExposure`).
+
+        Parameters
+        ----------
+        max_iterations : int, optional
+            The maximum number of adjustments. Defaults to 3.
+        kwds
+            Parameters for `.AutoExposure` (``target``, ``percentile``,
+            ``tolerance``, ...).
+
+        Returns
+        -------
+        exposure : float or None
+            The final exposure, or ``None`` if the camera does not support
+            setting the exposure.
+        '''
+        exposure = self.get_exposure()
+        if exposure <= 0:
+            return None
+        auto_exposure = AutoExposure(**kwds)
+        # a frame acquired with the current exposure
+        image = self.grab(fresh_after=time.time(), roi=auto_exposure.roi,
+                          timeout=1 + .001*exposure)
+        for _ in range(max_iterations):
+            new_exposure = auto_exposure.next_exposure(exposure, image)
+            if new_exposure is None:
+                break
+            change_time = time.time()
+            self.set_exposure(new_exposure)
+            exposure = self.get_exposure()
+            # wait for a frame that was acquired with the updated value
+            image = self.grab(fresh_after=change_time, roi=auto_exposure.roi,
+                              timeout=1 + .001*exposure)
+        return exposure
+
+    def start_auto_exposure(self, rate=5., gain=0.5, **kwds):
         '''
-        mean_luminance = 127
+        Continuously adjusts the exposure to changes in illumination, until
+        `stop_auto_exposure` is called.
+
+        Parameters
+        ----------
+        rate : float, optional
+            The maximum number of frames per second that are evaluated.
+            Defaults to 5.
+        gain : float, optional
+            The fraction of the predicted change that is applied for every
+            evaluated frame. Defaults to 0.5.
+        kwds
+            Parameters for `.AutoExposure` (``target``, ``percentile``,
+            ``tolerance``, ...).
+        '''
+        self.stop_auto_exposure()
+        if self.get_exposure() <= 0:
+            return
+        self._auto_exposure_thread = AutoExposureThread(self, AutoExposure(**kwds),
+                                                        rate=rate, gain=gain)
+        self._auto_exposure_thread.start()
+
+    def stop_auto_exposure(self):
+        '''Stops the continuous auto exposure.'''
+        if self._auto_exposure_thread is not None:
+            self._auto_exposure_thread.running = False
+            self._auto_exposure_thread.subscription.close()
+            self._auto_exposure_thread = None
 
-        def f(value):
-            self.set_exposure(value)
-            time.sleep(.2+.001*value) # wait for new frame with updated value
-            while not self.new_frame():
-                time.sleep(0.05)
-            m = self.snap().mean()
-            return m-mean_luminance
-        exposure = brentq(f, 0.1,100., rtol=0.1)
-        self.set_exposure(exposure)
+    @property
+    def continuous_auto_exposure(self):
+        '''Whether the exposure is continuously adjusted.'''
+        return (self._auto_exposure_thread is not None and
+                self._auto_exposure_thread.is_alive())
 
     def get_frame_rate(self):
         return -1
@@ -0,0 +1,187 @@
+'''
+Mapping of camera frames with more than 8 bits to 8-bit images for display.
+
+The mapping (window/level) is stored as a lookup table with one entry per
+possible pixel value (65536 entries for 16-bit frames), so that converting a
+frame is a single `numpy.take` into a preallocated buffer.
+
+With automatic contrast, the window is set from percentiles of a subsampled
+histogram of the frames. The table is only recalculated when the distribution
+of intensities changes noticeably, not for every frame.
+'''
+import threading
+
+import numpy as np
+
+__all__ = ['DisplayLUT']
+
+
+class DisplayLUT(object):
+    '''
+    Window/level mapping of raw frames to 8-bit display images.
+
+    Parameters
+    ----------
+    window : tuple, optional
+        The raw intensities ``(low, high)`` that are mapped to 0 and 255.
+        Defaults to the full range of the frames' data type.
+    auto : bool, optional
+        Whether the window automatically follows the intensity distribution
+        of 16-bit frames (see `update`). 8-bit frames are only mapped if a
+        window has been set. Defaults to ``False``.
+    low_percentile, high_percentile : float, optional
+        The percentiles of the intensities used as the window with automatic
+        contrast. Default to 0.5 and 99.5.
+    step : int, optional
+        Only every ``step``-th pixel in each direction is used for the
+        histogram. Defaults to 8.
+    threshold : float, optional
+        The change of the intensity distribution (maximum difference of the
+        cumulative distributions) that triggers a new window with automatic
+        contrast. Defaults to 0.02.
+    '''
+    def __init__(self, window=None, auto=False, low_percentile=0.5,
+                 high_percentile=99.5, step=8, threshold=0.02):
+        self.auto = auto
+        self.low_percentile = low_percentile
+        self.high_percentile = high_percentile
+        self.step = step
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._window = None
+        # Cumulative distribution the current window is based on
+        self._reference = None
+        # Lookup tables for the current window, by data type
+        self._tables = {}
+        # Reused output buffers (one per thread)
+        self._buffers = threading.local()
+        #: Number of times the window has been recalculated automatically
+        self.updates = 0
+        if window is not None:
+            self.set_window(*window)
+
+    @property
+    def window(self):
+        '''The raw intensities ``(low, high)`` mapped to 0 and 255, or ``None``.'''
+        return self._window
+
+    def set_window(self, low, high):
+        '''Map the raw intensities between ``low`` and ``high`` to 0-255.'''
+        if high <= low:
+            high = low + 1
+        with self._lock:
+            self._window = (low, high)
+            self._tables = {}
+
+    def reset(self):
+        '''Map the full range of the data type, without automatic contrast.'''
+        with self._lock:
+            self.auto = False
+            self._window = None
+            self._reference = None
+            self._tables = {}
+
+    def is_identity(self, dtype):
+        '''Whether frames of this data type are displayed unchanged.'''
+        return np.dtype(dtype) == np.uint8 and self._window is None
+
+    def _cumulative(self, image):
+        sample = np.asarray(image)[::self.step, ::self.step]
+        histogram = np.bincount(sample.ravel(),
+                                minlength=np.iinfo(sample.dtype).max + 1)
+        cumulative = np.cumsum(histogram, dtype=np.float64)
+        cumulative /= cumulative[-1]
+        return cumulative
+
+    def _set_from_cumulative(self, cumulative):
+        low, high = np.searchsorted(cumulative, [self.low_percentile / 100.,
+                                                 self.high_percentile / 100.])
+        self.set_window(int(low), int(high))
+        self._reference = cumulative
+
+    def auto_contrast(self, image):
+        '''
+        Set the window from the percentiles of an image, and keep it fixed
+        for later frames (switches off `auto`).
+        '''
+        self.auto = False
+        self._set_from_cumulative(self._cumulative(image))
+
+    def update(self, image):
+        '''
+        Recalculate the window for a new 16-bit frame if automatic contrast is
+        enabled and the intensity distribution changed since the window was
+        last calculated.
+
+        Returns
+        -------
+        updated : bool
+            Whether the window has been recalculated.
+        '''
+        if not self.auto or image.dtype != np.uint16:
+            return False
+        cumulative = self._cumulative(image)
+        reference = self._reference
+        if (reference is not None and len(reference) == len(cumulative) and
+                np.abs(cumulative - reference).max() <= self.threshold):
+            return False
+        self._set_from_cumulative(cumulative)
+        self.updates += 1
+        return True
+
+    def table(self, dtype):
+        '''
+        The lookup table for the current window.
+
+        Parameters
+        ----------
+        dtype : `~numpy.dtype`
+            The data type of the raw frames (8 or 16 bit unsigned integers).
+
+        Returns
+        -------
+        table : `~numpy.ndarray`
+            The ``uint8`` lookup table, with one entry per value.
+        '''
+        dtype = np.dtype(dtype)
+        with self._lock:
+            table = self._tables.get(dtype)
+            if table is not None:
+                return table
+            n_values = np.iinfo(dtype).max + 1
+            low, high = self._window if self._window is not None else (0, n_values - 1)
+            values = np.arange(n_values, dtype=np.float32)
+            table = np.clip((values - low) * (255. / (high - low)) + 0.5,
+                            0, 255).astype(np.uint8)
+            self._tables[dtype] = table
+        return table
+
+    def buffer(self, shape):
+        '''
+        A ``uint8`` buffer of the given shape that is reused for all calls
+        from the same thread (as long as the shape does not change).
+        '''
+        buf = getattr(self._buffers, 'buffer', None)
+        if buf is None or buf.shape != tuple(shape):
+            buf = self._buffers.buffer = np.empty(shape, dtype=np.uint8)
+        return buf
+
+    def apply(self, image, out=None):
+        '''
+        Map a raw frame to an 8-bit image.
+
+        Parameters
+        ----------
+        image : `~numpy.ndarray`
+            The raw frame (8 or 16 bit unsigned integers).
+        out : `~numpy.ndarray`, optional
+            A ``uint8`` buffer for the result (e.g. from `buffer`). If not
+            provided, a new array is allocated.
+
+        Returns
+        -------
+        mapped : `~numpy.ndarray`
+            The 8-bit image (``out``, if provided).
+        '''
+        self.update(image)
+        return np.take(self.table(image.dtype), image, out=out)
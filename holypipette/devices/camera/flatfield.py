@@ -0,0 +1,145 @@
+'''
+Flat-field and dark-frame correction of raw camera frames.
+
+A dark frame (acquired without light) and a flat frame (acquired with the
+illumination on, but without a sample in the field of view) are averaged
+over several acquisitions. From these, a gain map is calculated that
+equalizes the illumination::
+
+    corrected = (raw - dark) * mean(flat - dark) / (flat - dark)
+
+The gain map is stored in fixed point, so that the correction is applied in
+place with integer arithmetic only (a multiplication, a subtraction, a shift
+and a clip per pixel), without converting frames to floating point.
+'''
+import threading
+
+import numpy as np
+
+__all__ = ['FlatFieldCorrection']
+
+
+class FlatFieldCorrection(object):
+    '''
+    Dark-frame and flat-field correction (see `.Camera.capture_dark_frame`
+    and `.Camera.capture_flat_frame`). The correction is applied to every
+    frame as soon as a dark or a flat frame is available and `enabled` is
+    set.
+
+    Parameters
+    ----------
+    max_gain : float, optional
+        The maximum gain applied to a pixel. Pixels with a higher (or an
+        undefined) gain are not corrected. Defaults to 4.
+    '''
+    #: Number of fractional bits of the fixed-point gain map
+    shift = 12
+
+    def __init__(self, max_gain=4.):
+        self.max_gain = max_gain
+        #: Whether the correction is applied (if reference frames are available)
+        self.enabled = True
+        self._lock = threading.Lock()
+        self.dark = None
+        self.flat = None
+        # Fixed-point gain map, and the dark frame multiplied with the gain
+        # (minus the rounding offset)
+        self._gain = None
+        self._offset = None
+        # Intermediate result (allocated with the first frame)
+        self._work = None
+
+    @property
+    def active(self):
+        '''Whether frames are corrected.'''
+        return self.enabled and self._gain is not None
+
+    def set_dark(self, dark):
+        '''
+        Set the dark frame (average of frames acquired without light).
+        '''
+        self.dark = np.asarray(dark, dtype=np.float32)
+        self._update()
+
+    def set_flat(self, flat):
+        '''
+        Set the flat frame (average of frames of an empty, illuminated field
+        of view).
+        '''
+        self.flat = np.asarray(flat, dtype=np.float32)
+        self._update()
+
+    def clear(self):
+        '''Remove the reference frames.'''
+        self.dark = self.flat = None
+        self._update()
+
+    def _update(self):
+        if self.dark is None and self.flat is None:
+            gain = offset = None
+        else:
+            dark = self.dark if self.dark is not None else 0
+            if self.flat is not None:
+                if self.dark is not None and self.dark.shape != self.flat.shape:
+                    raise ValueError('Dark frame and flat frame differ in size '
+                                     '({} and {})'.format(self.dark.shape,
+                                                          self.flat.shape))
+                signal = self.flat - dark
+                valid = signal > 0
+                gain = np.ones(signal.shape, dtype=np.float32)
+                gain[valid] = signal[valid].mean() / signal[valid]
+                gain[gain > self.max_gain] = 1
+            else:
+                gain = np.ones(self.dark.shape, dtype=np.float32)
+            scale = 1 << self.shift
+            offset = np.rint(dark * gain * scale).astype(np.int32) - scale // 2
+            offset = np.broadcast_to(offset, gain.shape)
+            gain = np.rint(gain * scale).astype(np.int32)
+            offset = np.ascontiguousarray(offset)
+        with self._lock:
+            self._gain, self._offset = gain, offset
+
+    def apply(self, image):
+        '''
+        Correct a raw frame in place.
+
+        Parameters
+        ----------
+        image : `~numpy.ndarray`
+            The frame (8 or 16 bit unsigned integers), of the same shape as
+            the reference frames.
+
+        Returns
+        -------
+        corrected : bool
+            Whether the frame has been corrected (``False`` if no reference
+            frames are available, or if their size does not match the frame).
+        '''
+        with self._lock:
+            gain, offset = self._gain, self._offset
+        if not self.enabled or gain is None or gain.shape != image.shape:
+            return False
+        work = self._work
+        if work is None or work.shape != image.shape:
+            work = self._work = np.empty(image.shape, dtype=np.int32)
+        # (raw - dark)*gain, in fixed point and rounded
+        np.multiply(image, gain, out=work)
+        work -= offset
+        work >>= self.shift
+        np.clip(work, 0, np.iinfo(image.dtype).max, out=work)
+        np.copyto(image, work, casting='unsafe')
+        return True
+
+    def save(self, filename):
+        '''Store the reference frames in a ``.npz`` file.'''
+        frames = {name: frame for name, frame in (('dark', self.dark),
+                                                 ('flat', self.flat))
+                  if frame is not None}
+        np.savez_compressed(filename, **frames)
+
+    def load(self, filename):
+        '''Load the reference frames stored with `save`.'''
+        with np.load(filename) as frames:
+            self.dark = frames['dark'] if 'dark' in frames else None
+            self.flat = frames['flat'] if 'flat' in frames else None
+        self._update()
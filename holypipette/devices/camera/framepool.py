@@ -0,0 +1,586 @@
+'''
+A pool of preallocated frame buffers, shared between the acquisition thread
+and the consumers of its frames.
+
+The acquisition thread claims a free slot with `FramePool.acquire`, writes the
+new image directly into the slot's buffer and publishes it as a `PooledFrame`.
+Consumers get read-only views on the buffer and keep the slot alive by
+holding a reference (`PooledFrame.borrow`) until they call
+`PooledFrame.release`. A slot is only reused once all its references have been
+released, so no frame is ever overwritten while somebody is still looking at
+it, and no memory is allocated per frame. Free slots are reused in last-in,
+first-out order, so that a steady stream of frames keeps cycling through the
+same few (cache-warm) buffers, and the pool gives back the memory of slots it
+no longer needs when it shrinks (see `FramePool.shrink`).
+
+The processed version of a frame (e.g. converted to RGB, with overlays) is
+only calculated when a consumer asks for it, and is cached until the slot is
+reused for a new frame (only for the most recently requested frames, see
+`FramePool.processed_cache`). The same holds for downsampled versions of the raw
+and processed frames (an image pyramid with levels of 1/2, 1/4, and 1/8 of the
+original size), which are shared by all consumers of a frame.
+'''
+import collections
+import logging
+import threading
+import time
+
+import numpy as np
+try:
+    import cv2
+except:
+    import warnings
+    warnings.warn('OpenCV not available')
+
+__all__ = ['FramePool', 'PooledFrame']
+
+#: The number of downsampled levels of the image pyramid
+PYRAMID_LEVELS = 3
+
+
+def downsample(image, out=None):
+    '''
+    Halves the size of an image by averaging blocks of 2x2 pixels (an odd
+    last row or column is dropped).
+
+    Parameters
+    ----------
+    image : `~numpy.ndarray`
+        The image (grayscale or color).
+    out : `~numpy.ndarray`, optional
+        A buffer for the result, of the same type as ``image``. If not
+        provided, a new array is allocated.
+
+    Returns
+    -------
+    downsampled : `~numpy.ndarray`
+        The downsampled image (``out``, if provided).
+    '''
+    height, width = image.shape[0] // 2, image.shape[1] // 2
+    if out is None:
+        out = np.empty((height, width) + image.shape[2:], dtype=image.dtype)
+    return cv2.resize(image[:2*height, :2*width], (width, height), dst=out,
+                      interpolation=cv2.INTER_AREA)
+
+
+def processed_format(shape, dtype):
+    '''
+    The shape and data type of processed frames (see `.Camera.preprocess`) for
+    raw frames of the given shape and data type.
+    '''
+    if len(shape) == 2:
+        shape = tuple(shape) + (3,)  # converted to RGB
+    if np.dtype(dtype).itemsize == 2:
+        dtype = np.uint8  # mapped to 8 bits for display
+    return tuple(shape), np.dtype(dtype)
+
+
+class FramePool(object):
+    '''
+    A reference-counted pool of preallocated frame buffers.
+
+    Parameters
+    ----------
+    shape : tuple
+        The shape of a single (raw) frame.
+    dtype : `~numpy.dtype`
+        The data type of a single (raw) frame.
+    size : int, optional
+        The initial number of slots in the pool. Defaults to 8.
+    processor : function, optional
+        A function ``processor(raw, out, overlay)`` that writes the processed
+        version of the ``raw`` frame into the buffer ``out``, using the
+        overlay state stored with the frame. It is called lazily, at most once
+        per frame.
+    processed_shape : tuple, optional
+        The shape of the processed frames. Defaults to ``shape``.
+    processed_dtype : `~numpy.dtype`, optional
+        The data type of the processed frames. Defaults to ``dtype``.
+    buffers : list of `~numpy.ndarray`, optional
+        Existing buffers to use for the slots (e.g. in shared memory), instead
+        of allocating them. The pool cannot grow beyond these buffers, and
+        ``size`` is ignored.
+    on_free : function, optional
+        A function ``on_free(slot)`` that is called whenever the last
+        reference to a slot has been released.
+    '''
+    #: Minimum time (in seconds) between two warnings about pool exhaustion
+    warning_interval = 5.
+    #: The maximum number of processed frames kept in memory (and of unused
+    #: buffers kept for processing new frames)
+    processed_cache = 4
+
+    def __init__(self, shape, dtype, size=8, processor=None,
+                 processed_shape=None, processed_dtype=None, buffers=None,
+                 on_free=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.processor = processor
+        if processed_shape is None:
+            processed_shape = self.shape
+        self.processed_shape = tuple(processed_shape)
+        if processed_dtype is None:
+            processed_dtype = self.dtype
+        self.processed_dtype = np.dtype(processed_dtype)
+        self._lock = threading.Lock()
+        self._process_lock = threading.Lock()
+        self._buffers = []
+        # Processed frames as (frame number, buffer) for each slot, the most
+        # recently requested frame last, and spare buffers for new ones
+        self._processed = collections.OrderedDict()
+        self._spare_processed = []
+        # Downsampled images for each slot, by kind and level, and the frame
+        # numbers they were calculated for
+        self._pyramids = []
+        self._pyramid_numbers = []
+        self._pyramid_lock = threading.Lock()
+        self._refcounts = np.zeros(0, dtype=np.int32)
+        self._numbers = np.zeros(0, dtype=np.int64)
+        self._timestamps = np.zeros(0, dtype=np.float64)
+        self._elapsed = np.zeros(0, dtype=np.float64)
+        self._creation_times = []
+        self._overlays = []
+        # Free slots, the most recently freed slot last
+        self._free = []
+        # The number of slots the pool should have (see `shrink`)
+        self._target = 0
+        #: Number of times that `acquire` failed because all slots were in use
+        self.exhausted = 0
+        self._last_warning = None
+        self.on_free = on_free
+        self._external = buffers
+        if buffers is not None:
+            for buf in buffers:
+                if not self.matches(buf.shape, buf.dtype):
+                    raise ValueError('Buffers have to be of shape {} and type '
+                                     '{}'.format(self.shape, self.dtype))
+            size = len(buffers)
+        self.grow(size)
+
+    @property
+    def size(self):
+        '''The number of slots in the pool (that have a buffer).'''
+        return sum(buf is not None for buf in self._buffers)
+
+    def in_use(self):
+        '''The number of slots that are currently referenced.'''
+        with self._lock:
+            return int(np.count_nonzero(self._refcounts))
+
+    def matches(self, shape, dtype):
+        '''Whether frames of the given shape and type fit into this pool.'''
+        return tuple(shape) == self.shape and np.dtype(dtype) == self.dtype
+
+    def grow(self, size):
+        '''
+        Make sure that the pool has at least ``size`` slots. Existing slots (and
+        references to them) are left untouched. Pools using external buffers
+        cannot grow beyond the number of buffers.
+        '''
+        with self._lock:
+            if self._external is not None and size > len(self._external):
+                if len(self._buffers) == len(self._external):
+                    logging.getLogger(__name__).warning('Frame pool cannot grow to {} slots, '
+                                                        'it is limited to {} external '
+                                                        'buffers'.format(size, len(self._external)))
+                size = len(self._external)
+            if size <= self._target:
+                return
+            self._target = size
+            # Give slots that have been removed by `shrink` a new buffer
+            for slot in range(min(size, len(self._buffers))):
+                if self._buffers[slot] is None:
+                    self._buffers[slot] = np.zeros(self.shape, dtype=self.dtype)
+                    self._free.append(slot)
+            n_new = size - len(self._buffers)
+            if n_new <= 0:
+                return
+            first = len(self._buffers)
+            if self._external is not None:
+                self._buffers.extend(self._external[first:size])
+            else:
+                self._buffers.extend(np.zeros(self.shape, dtype=self.dtype)
+                                     for _ in range(n_new))
+            self._pyramids.extend({} for _ in range(n_new))
+            self._pyramid_numbers.extend({} for _ in range(n_new))
+            self._creation_times.extend([None] * n_new)
+            self._overlays.extend([None] * n_new)
+            self._refcounts = np.concatenate([self._refcounts,
+                                              np.zeros(n_new, dtype=np.int32)])
+            self._numbers = np.concatenate([self._numbers,
+                                            np.full(n_new, -1, dtype=np.int64)])
+            self._timestamps = np.concatenate([self._timestamps,
+                                               np.zeros(n_new)])
+            self._elapsed = np.concatenate([self._elapsed, np.zeros(n_new)])
+            # The first new slot is used first
+            self._free.extend(reversed(range(first, size)))
+
+    def shrink(self, size):
+        '''
+        Reduce the pool to ``size`` slots (but never below the number of
+        slots in use), giving back the memory of the removed slots. Slots
+        that are still referenced are removed when they are released. Pools
+        using external buffers keep all their buffers.
+        '''
+        if self._external is not None:
+            return
+        with self._lock:
+            self._target = size
+            for slot in [slot for slot in self._free if slot >= size]:
+                self._free.remove(slot)
+                self._drop_slot(slot)
+
+    def _drop_slot(self, slot):
+        # Free the memory of a slot that is no longer needed (called with the
+        # lock held, the slot is not referenced)
+        self._buffers[slot] = None
+        with self._process_lock:
+            self._processed.pop(slot, None)
+        self._pyramids[slot] = {}
+        self._pyramid_numbers[slot] = {}
+        self._overlays[slot] = None
+        self._creation_times[slot] = None
+
+    def acquire(self):
+        '''
+        Claim a free slot for writing a new frame. The most recently freed
+        slot is reused first.
+
+        Returns
+        -------
+        slot : int or None
+            The index of the claimed slot, or ``None`` if all slots are
+            currently referenced (the pool is exhausted).
+        '''
+        with self._lock:
+            n_slots = self.size
+            if self._free:
+                slot = self._free.pop()
+                self._refcounts[slot] = 1  # reference held by the writer
+                self._numbers[slot] = -1
+                self._recycle_processed(slot)
+                return slot
+            self.exhausted += 1
+        now = time.time()
+        if self._last_warning is None or now - self._last_warning > self.warning_interval:
+            self._last_warning = now
+            logging.getLogger(__name__).warning('Frame pool exhausted: all {} slots are in use '
+                                                '({} frames dropped so far)'.format(n_slots,
+                                                                                    self.exhausted))
+        return None
+
+    def claim(self, slot):
+        '''
+        Claim a specific free slot for writing a new frame (instead of letting
+        `acquire` choose it), e.g. when frames are written by another process.
+        '''
+        with self._lock:
+            if self._refcounts[slot] != 0:
+                raise ValueError('Frame slot {} is still in use'.format(slot))
+            self._free.remove(slot)
+            self._refcounts[slot] = 1  # reference held by the writer
+            self._numbers[slot] = -1
+            self._recycle_processed(slot)
+
+    def _recycle_processed(self, slot):
+        # The processed frame of a reused slot is outdated, keep its buffer
+        # for processing new frames (nobody references the slot anymore)
+        with self._process_lock:
+            entry = self._processed.pop(slot, None)
+            if (entry is not None and
+                    len(self._spare_processed) < self.processed_cache):
+                self._spare_processed.append(entry[1])
+
+    def buffer(self, slot):
+        '''
+        The writable buffer of a slot. Should only be used by the writer that
+        claimed the slot with `acquire`, before publishing it.
+        '''
+        return self._buffers[slot]
+
+    def processed(self, slot):
+        '''
+        The processed version of the frame in a slot. It is calculated with
+        ``processor`` on first request, and then cached for later requests
+        (only the `processed_cache` most recently requested frames are kept,
+        older ones are calculated again if needed). The caller has to hold a
+        reference to the slot.
+
+        Returns
+        -------
+        processed : `~numpy.ndarray` or None
+            The processed frame, or ``None`` if the pool does not have a
+            ``processor``.
+        '''
+        if self.processor is None:
+            return None
+        with self._process_lock:
+            number = self._numbers[slot]
+            entry = self._processed.pop(slot, None)
+            if entry is not None and entry[0] == number:
+                buf = entry[1]
+            else:
+                if entry is not None:
+                    buf = entry[1]
+                elif self._spare_processed:
+                    buf = self._spare_processed.pop()
+                else:
+                    buf = np.zeros(self.processed_shape, dtype=self.processed_dtype)
+                self.processor(self._buffers[slot], buf, self._overlays[slot])
+            self._processed[slot] = (number, buf)
+            while len(self._processed) > self.processed_cache:
+                # The frame may still be referenced (and its processed image
+                # used), so its buffer cannot be reused
+                self._processed.popitem(last=False)
+        return buf
+
+    def pyramid(self, slot, level, kind='raw'):
+        '''
+        A downsampled version of the raw or processed frame in a slot, with
+        ``1/2**level`` of its width and height. Each level is calculated from
+        the previous level on first request, and then cached for later
+        requests. The caller has to hold a reference to the slot.
+
+        Parameters
+        ----------
+        slot : int
+            The slot.
+        level : int
+            The pyramid level (between 0 for the full image and
+            `PYRAMID_LEVELS`).
+        kind : str, optional
+            Whether to downsample the ``'raw'`` (default) or the
+            ``'processed'`` frame.
+
+        Returns
+        -------
+        downsampled : `~numpy.ndarray` or None
+            The downsampled frame, or ``None`` for processed frames if the pool
+            does not have a ``processor``.
+        '''
+        if not 0 <= level <= PYRAMID_LEVELS:
+            raise ValueError('Pyramid level has to be between 0 and '
+                             '{}'.format(PYRAMID_LEVELS))
+        image = self._buffers[slot] if kind == 'raw' else self.processed(slot)
+        if level == 0 or image is None:
+            return image
+        with self._pyramid_lock:
+            number = self._numbers[slot]
+            pyramid = self._pyramids[slot]
+            numbers = self._pyramid_numbers[slot]
+            for current in range(1, level + 1):
+                key = (kind, current)
+                buf = pyramid.get(key)
+                if numbers.get(key) != number or buf is None:
+                    shape = ((image.shape[0] // 2, image.shape[1] // 2) +
+                             image.shape[2:])
+                    if buf is None or buf.shape != shape:
+                        buf = pyramid[key] = np.empty(shape, dtype=image.dtype)
+                    downsample(image, out=buf)
+                    numbers[key] = number
+                image = buf
+        return image
+
+    def publish(self, slot, frame_number, timestamp, elapsed_time,
+                creation_time, overlay=None):
+        '''
+        Store the metadata of a slot that has been written to, and hand over
+        the writer's reference to a new `PooledFrame`.
+        '''
+        with self._lock:  # metadata arrays are replaced in `grow`
+            self._numbers[slot] = frame_number
+            self._timestamps[slot] = timestamp
+            self._elapsed[slot] = elapsed_time
+            self._creation_times[slot] = creation_time
+            self._overlays[slot] = overlay
+        return PooledFrame(self, slot)
+
+    def discard(self, slot):
+        '''Give back a slot claimed with `acquire` without publishing it.'''
+        self.release(slot)
+
+    def borrow(self, slot):
+        '''Add a reference to a slot.'''
+        with self._lock:
+            if self._refcounts[slot] <= 0:
+                raise ValueError('Cannot borrow frame slot {}: it has already '
+                                 'been released'.format(slot))
+            self._refcounts[slot] += 1
+
+    def release(self, slot):
+        '''Remove a reference from a slot.'''
+        with self._lock:
+            if self._refcounts[slot] <= 0:
+                raise ValueError('Frame slot {} released more often than it '
+                                 'was borrowed'.format(slot))
+            self._refcounts[slot] -= 1
+            freed = self._refcounts[slot] == 0
+            if freed:
+                if slot >= self._target and self._external is None:
+                    # The pool has been shrunk in the meantime
+                    self._drop_slot(slot)
+                else:
+                    self._free.append(slot)
+        if freed and self.on_free is not None:
+            self.on_free(slot)
+
+    def stats(self):
+        '''
+        Usage statistics of the pool.
+
+        Returns
+        -------
+        stats : dict
+            A dictionary with the number of slots (``'size'``), the number of
+            slots currently in use (``'in_use'``), and the number of frames
+            that could not be stored because the pool was exhausted
+            (``'exhausted'``).
+        '''
+        return {'size': self.size,
+                'in_use': self.in_use(),
+                'exhausted': self.exhausted}
+
+
+class PooledFrame(object):
+    '''
+    A reference to a frame stored in a `FramePool`. The image data is exposed
+    as read-only views. Every `PooledFrame` has to be released with `release`
+    (or by using it as a context manager) once it is no longer needed, and
+    has to be borrowed with `borrow` if it is handed on to another consumer.
+    The ``kind`` of the reference (``'raw'`` or ``'processed'``) and its
+    pyramid ``level`` (see `downsampled`) determine which image is returned by
+    `image`.
+    '''
+    __slots__ = ['pool', 'slot', 'kind', 'level', '_released']
+
+    def __init__(self, pool, slot, kind='raw', level=0):
+        self.pool = pool
+        self.slot = slot
+        self.kind = kind
+        self.level = level
+        self._released = False
+
+    @property
+    def number(self):
+        '''The frame number.'''
+        return int(self.pool._numbers[self.slot])
+
+    @property
+    def timestamp(self):
+        '''The time (as returned by `time.time`) the frame was requested.'''
+        return float(self.pool._timestamps[self.slot])
+
+    @property
+    def elapsed_time(self):
+        '''The time since the start of the acquisition (in seconds).'''
+        return float(self.pool._elapsed[self.slot])
+
+    @property
+    def creation_time(self):
+        '''The `~datetime.datetime` the frame was stored.'''
+        return self.pool._creation_times[self.slot]
+
+    @property
+    def overlay(self):
+        '''
+        The overlay state (`.FrameOverlay`) at the time the frame was
+        acquired.
+        '''
+        return self.pool._overlays[self.slot]
+
+    @property
+    def raw(self):
+        '''A read-only view on the raw camera image.'''
+        view = self.pool._buffers[self.slot].view()
+        view.flags.writeable = False
+        return view
+
+    @property
+    def processed(self):
+        '''
+        A read-only view on the processed image (calculated on first access).
+        '''
+        buf = self.pool.processed(self.slot)
+        if buf is None:
+            return None
+        view = buf.view()
+        view.flags.writeable = False
+        return view
+
+    def downsampled(self, level, kind=None):
+        '''
+        A read-only view on the image downsampled to ``1/2**level`` of its
+        width and height (calculated at most once per frame, and shared with
+        all other references to the frame).
+
+        Parameters
+        ----------
+        level : int
+            The pyramid level: 1, 2, or 3 for 1/2, 1/4, or 1/8 of the original
+            size (0 for the full image).
+        kind : str, optional
+            ``'raw'`` or ``'processed'``. Defaults to the kind of this
+            reference.
+
+        Returns
+        -------
+        image : `~numpy.ndarray` or None
+            The downsampled image, or ``None`` if the processed image is not
+            available.
+        '''
+        buf = self.pool.pyramid(self.slot, level, kind or self.kind)
+        if buf is None:
+            return None
+        view = buf.view()
+        view.flags.writeable = False
+        return view
+
+    @property
+    def image(self):
+        '''
+        The raw or the processed image, depending on ``kind``, at the
+        reference's pyramid ``level``.
+        '''
+        if self.level:
+            return self.downsampled(self.level)
+        if self.kind == 'processed':
+            return self.processed
+        return self.raw
+
+    def borrow(self, kind=None, level=None):
+        '''
+        Get a new, independent reference to the same frame.
+
+        Parameters
+        ----------
+        kind : str, optional
+            The kind of the new reference. Defaults to the kind of this
+            reference.
+        level : int, optional
+            The pyramid level of the new reference. Defaults to the level of
+            this reference.
+
+        Returns
+        -------
+        frame : `PooledFrame`
+        '''
+        if self._released:
+            raise ValueError('Cannot borrow a frame that has been released')
+        if kind is None:
+            kind = self.kind
+        if level is None:
+            level = self.level
+        self.pool.borrow(self.slot)
+        return PooledFrame(self.pool, self.slot, kind, level)
+
+    def release(self):
+        '''Give the frame back to the pool. Calling it twice has no effect.'''
+        if not self._released:
+            self._released = True
+            self.pool.release(self.slot)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
@@ -0,0 +1,123 @@
+'''
+Overlays (calibration point, cell outlines) drawn on top of camera frames.
+
+The overlay state is captured for every frame at acquisition time, so that
+frames are always drawn with the overlays that were visible when they were
+taken -- also when a recording is played back later.
+'''
+import collections
+
+import numpy as np
+try:
+    import cv2
+except:
+    import warnings
+    warnings.warn('OpenCV not available')
+
+__all__ = ['FrameOverlay', 'draw_overlay']
+
+#: Radius and color of the cell outlines
+CELL_RADIUS = 10
+CELL_COLOR = (0, 255, 0)
+
+
+class FrameOverlay(collections.namedtuple('FrameOverlay',
+                                          ['cell_list', 'point_to_show', 'flipped'])):
+    '''
+    The overlay state of a frame.
+
+    Parameters
+    ----------
+    cell_list : tuple
+        The ``(x, y)`` positions of the cells that are outlined.
+    point_to_show : tuple or None
+        The temporary point that is shown as ``(point, radius, color)``, or
+        ``None``.
+    flipped : bool
+        Whether the image is flipped horizontally.
+    '''
+    __slots__ = ()
+
+    def translated(self, x, y):
+        '''
+        The overlay state for a crop of the frame, with its top-left corner at
+        ``(x, y)``.
+        '''
+        if self.point_to_show is not None:
+            point, radius, color = self.point_to_show
+            point_to_show = ((point[0] - x, point[1] - y), radius, color)
+        else:
+            point_to_show = None
+        return FrameOverlay(tuple((cell[0] - x, cell[1] - y) for cell in self.cell_list),
+                            point_to_show, self.flipped)
+
+    def to_dict(self):
+        '''A JSON-serializable version of the overlay state.'''
+        if self.point_to_show is not None:
+            point, radius, color = self.point_to_show
+            point_to_show = {'point': [int(p) for p in point],
+                             'radius': int(radius),
+                             'color': [int(c) for c in color]}
+        else:
+            point_to_show = None
+        return {'cell_list': [[int(c) for c in cell] for cell in self.cell_list],
+                'point_to_show': point_to_show,
+                'flipped': bool(self.flipped)}
+
+    @staticmethod
+    def from_dict(d):
+        '''Create the overlay state from the result of `to_dict`.'''
+        point_to_show = d['point_to_show']
+        if point_to_show is not None:
+            point_to_show = (tuple(point_to_show['point']),
+                             point_to_show['radius'],
+                             tuple(point_to_show['color']))
+        return FrameOverlay(tuple(tuple(cell) for cell in d['cell_list']),
+                            point_to_show, d['flipped'])
+
+
+def draw_overlay(img, overlay, out=None):
+    '''
+    Converts a raw image to RGB and draws the overlays on it.
+
+    Parameters
+    ----------
+    img : `~numpy.ndarray`
+        The raw image.
+    overlay : `FrameOverlay` or None
+        The overlay state. If ``None``, the image is only converted to RGB.
+    out : `~numpy.ndarray`, optional
+        A buffer for the result, of shape ``img.shape`` (color images) or
+        ``img.shape + (3,)`` (grayscale images). If not provided, a new array
+        is allocated.
+
+    Returns
+    -------
+    processed : `~numpy.ndarray`
+        The processed image (``out``, if provided).
+    '''
+    #convert to rgb
+    if len(img.shape)==2:
+        img = cv2.cvtColor(img, cv2.COLOR_GRAY2RGB, dst=out)
+    elif out is not None:
+        np.copyto(out, img)
+        img = out
+    else:
+        img = img.copy()
+
+    if overlay is None:
+        return img
+
+    #draw a temporary point if needed (used to show pipette tip during cal)
+    if overlay.point_to_show is not None:
+        point, radius, color = overlay.point_to_show
+        img = cv2.circle(img, tuple(point), radius, color, 3)
+
+    #draw cell outlines
+    for cell in overlay.cell_list:
+        img = cv2.circle(img, tuple(cell), CELL_RADIUS, CELL_COLOR, 3)
+
+    if overlay.flipped:
+        # in-place horizontal flip
+        img = cv2.flip(img, 1, dst=img)
+    return img
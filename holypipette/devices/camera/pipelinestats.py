@@ -0,0 +1,170 @@
+'''
+Timing statistics for the stages of the acquisition pipeline.
+
+Every stage (acquisition, correction, preprocessing, handing frames to
+subscribers, display, writing to disk) records one duration per frame into a rolling
+window, from which percentiles are calculated on request. Recording a
+duration is cheap (a single array assignment), so it can be done for every
+frame.
+'''
+import threading
+import time
+
+import numpy as np
+
+__all__ = ['RollingStats', 'PipelineStats']
+
+
+class RollingStats(object):
+    '''
+    Durations of the most recent events, in a fixed-size ring buffer.
+
+    Parameters
+    ----------
+    size : int, optional
+        The number of durations that are kept. Defaults to 1000.
+    '''
+    def __init__(self, size=1000):
+        self._values = np.zeros(size)
+        self._next = 0
+        self.count = 0
+
+    def add(self, duration):
+        self._values[self._next] = duration
+        self._next = (self._next + 1) % len(self._values)
+        self.count += 1
+
+    def summary(self):
+        '''
+        Summary statistics of the durations in the window (in seconds).
+
+        Returns
+        -------
+        summary : dict
+            The total number of events (``'count'``), and the mean, median
+            (``'p50'``), 95th and 99th percentile (``'p95'``, ``'p99'``) and
+            maximum of the durations in the window. All statistics are
+            ``nan`` if no event has been recorded.
+        '''
+        values = self._values[:min(self.count, len(self._values))]
+        if not len(values):
+            return {'count': 0, 'mean': np.nan, 'p50': np.nan, 'p95': np.nan,
+                    'p99': np.nan, 'max': np.nan}
+        p50, p95, p99 = np.percentile(values, [50, 95, 99])
+        return {'count': self.count, 'mean': float(values.mean()),
+                'p50': float(p50), 'p95': float(p95), 'p99': float(p99),
+                'max': float(values.max())}
+
+
+class PipelineStats(object):
+    '''
+    Timing statistics for all stages of a camera's acquisition pipeline.
+
+    The following stages are recorded by the `.Camera` and its consumers:
+
+    ``'snap'``
+        The time to acquire a frame from the camera.
+    ``'correct'``
+        The time to apply the flat-field correction (see
+        `.FlatFieldCorrection`), if enabled.
+    ``'preprocess'``
+        The time to calculate the processed version of a frame.
+    ``'enqueue'``
+        The time to hand a frame to all subscriptions.
+    ``'display'``
+        The latency between the start of the acquisition and the display of a
+        frame.
+    ``'write'``
+        The latency between the start of the acquisition and the moment a
+        frame has been written to disk.
+
+    In addition, gaps in the hardware frame counter (see
+    `.Camera.get_frame_no`) are counted for cameras that provide one.
+
+    Parameters
+    ----------
+    size : int, optional
+        The number of durations that are kept per stage. Defaults to 1000.
+    '''
+    stages = ('snap', 'correct', 'preprocess', 'enqueue', 'display', 'write')
+
+    def __init__(self, size=1000):
+        self.size = size
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        '''Forget all recorded durations and frame counter gaps.'''
+        with self._lock:
+            self._stats = {stage: RollingStats(self.size) for stage in self.stages}
+            #: Number of times that the hardware frame counter skipped frames
+            self.gaps = 0
+            #: Total number of frames skipped by the hardware frame counter
+            self.missed_frames = 0
+            self._last_counter = None
+            self._frame_times = RollingStats(self.size)
+            self._last_frame_time = None
+
+    def record(self, stage, duration):
+        '''
+        Record the duration of a stage for a single frame.
+
+        Parameters
+        ----------
+        stage : str
+            The name of the stage (one of `stages`).
+        duration : float
+            The duration (in seconds).
+        '''
+        with self._lock:
+            self._stats[stage].add(duration)
+
+    def record_latency(self, stage, timestamp):
+        '''
+        Record the time since ``timestamp`` (as returned by `time.time`) for a
+        stage.
+        '''
+        self.record(stage, time.time() - timestamp)
+
+    def record_frame(self, timestamp, counter=None):
+        '''
+        Record a new frame from the camera.
+
+        Parameters
+        ----------
+        timestamp : float
+            The time of the acquisition (as returned by `time.time`).
+        counter : int, optional
+            The hardware frame counter for this frame, if available.
+        '''
+        with self._lock:
+            if self._last_frame_time is not None:
+                self._frame_times.add(timestamp - self._last_frame_time)
+            self._last_frame_time = timestamp
+            if counter is not None:
+                if self._last_counter is not None and counter > self._last_counter + 1:
+                    self.gaps += 1
+                    self.missed_frames += counter - self._last_counter - 1
+                self._last_counter = counter
+
+    def summary(self):
+        '''
+        Summary statistics for all stages.
+
+        Returns
+        -------
+        summary : dict
+            A dictionary mapping each stage to its statistics (see
+            `RollingStats.summary`), as well as the average frame rate over
+            the window (``'frame_rate'``), and the number of gaps in the
+            hardware frame counter and of frames missed in these gaps
+            (``'gaps'`` and ``'missed_frames'``).
+        '''
+        with self._lock:
+            summary = {stage: stats.summary()
+                       for stage, stats in self._stats.items()}
+            interval = self._frame_times.summary()['mean']
+            summary['frame_rate'] = 1/interval if interval > 0 else np.nan
+            summary['gaps'] = self.gaps
+            summary['missed_frames'] = self.missed_frames
+        return summary
@@ -0,0 +1,373 @@
+'''
+Runs a camera and its acquisition loop in a separate process.
+
+The child process writes frames into a ring of buffers in shared memory
+(`multiprocessing.shared_memory`), which is directly used as the frame pool of
+the camera object in the main process: `.Camera.last_frame`, subscriptions,
+and recordings therefore get views on the shared memory, frames are never
+copied between processes. Camera drivers or simulations that spend a lot of
+time in Python code (e.g. `.FakeCalCamera`) no longer compete for the GIL with
+the GUI and the controllers.
+
+Ownership of the ring slots is coordinated without locks: every slot has a
+sequence counter (odd while the child writes to it, even when it is complete)
+and a "free" flag. Only the child clears the flag (when it starts writing to
+the slot), and only the main process sets it (when the last reference to the
+frame has been released). The child also stores the time each frame was
+acquired and its frame number in the control block, so that frames are not
+timestamped when the main process gets around to receiving them. In the other
+direction, the main process stores the minimum interval between two frames
+(when the `.AdaptiveRate` of the camera is idle) in the control block, so that
+the child slows down its acquisition loop.
+'''
+import logging
+import multiprocessing
+import threading
+import time
+import traceback
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from .camera import Camera
+from .framepool import FramePool, processed_format
+
+__all__ = ['ProcessCamera']
+
+
+class SharedFrameRing(object):
+    '''
+    Views on the shared memory used by `ProcessCamera`: the frame buffers, and
+    a control block with the sequence counter, free flag, frame number, and
+    acquisition time of every slot, global counters of written and dropped
+    frames, and the minimum interval between two frames (0 for the full
+    rate).
+    '''
+    def __init__(self, data_name, control_name, size, shape, dtype):
+        self.size = size
+        self.data_memory = shared_memory.SharedMemory(name=data_name)
+        self.control_memory = shared_memory.SharedMemory(name=control_name)
+        frame_bytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        self.buffers = [np.ndarray(shape, dtype=dtype,
+                                   buffer=self.data_memory.buf,
+                                   offset=slot*frame_bytes)
+                        for slot in range(size)]
+        control = np.ndarray(self.control_size(size) // 8, dtype=np.int64,
+                             buffer=self.control_memory.buf)
+        self.sequence = control[:size]
+        self.free = control[size:2*size]
+        self.written = control[2*size:2*size + 1]
+        self.dropped = control[2*size + 1:2*size + 2]
+        self.numbers = control[2*size + 2:3*size + 2]
+        self.timestamps = np.ndarray(size, dtype=np.float64,
+                                     buffer=self.control_memory.buf,
+                                     offset=(3*size + 2) * 8)
+        self.interval = np.ndarray(1, dtype=np.float64,
+                                   buffer=self.control_memory.buf,
+                                   offset=(4*size + 2) * 8)
+
+    @staticmethod
+    def control_size(size):
+        return (4*size + 3) * 8
+
+    def close(self):
+        # Views on the memory have to be deleted before it can be closed
+        self.buffers = self.sequence = self.free = None
+        self.written = self.dropped = None
+        self.numbers = self.timestamps = self.interval = None
+        for memory in (self.data_memory, self.control_memory):
+            try:
+                memory.close()
+            except BufferError:
+                pass  # still referenced somewhere, will be closed at exit
+
+
+def _camera_process(camera_class, args, kwds, command_conn, frame_conn,
+                    ring_size):
+    '''
+    The main function of the camera process: creates the camera, and
+    acquires frames into the shared ring until it receives the ``'stop'``
+    command.
+    '''
+    camera = camera_class(*args, **kwds)
+    # The camera's own acquisition thread is replaced by the loop below
+    if camera._acquisition_thread is not None:
+        camera.stop_acquisition()
+        camera._acquisition_thread.join()
+    first = np.asarray(camera.raw_snap())
+    command_conn.send(('frame', first.shape, first.dtype.str,
+                       camera.width, camera.height))
+    data_name, control_name = command_conn.recv()
+    ring = SharedFrameRing(data_name, control_name, ring_size, first.shape,
+                           first.dtype)
+    running = True
+    next_slot = 0
+    frame_number = 0
+    last_snap = 0
+    try:
+        while running:
+            while command_conn.poll():
+                command, name, cmd_args, cmd_kwds = command_conn.recv()
+                if command == 'stop':
+                    running = False
+                    break
+                try:
+                    if command == 'call':
+                        result = getattr(camera, name)(*cmd_args, **cmd_kwds)
+                    elif command == 'get':
+                        result = getattr(camera, name)
+                    else:  # 'set'
+                        setattr(camera, name, cmd_args[0])
+                        result = None
+                    command_conn.send(('result', result))
+                except Exception as ex:
+                    command_conn.send(('error', ex))
+            if not running:
+                break
+            # Slow down to the idle rate requested by the main process (but
+            # keep answering commands)
+            delay = last_snap + ring.interval[0] - time.time()
+            if delay > 0:
+                time.sleep(min(delay, 0.01))
+                continue
+            last_snap = time.time()
+            # Find a free slot in ring order
+            for offset in range(ring_size):
+                slot = (next_slot + offset) % ring_size
+                if ring.free[slot]:
+                    break
+            else:
+                # All frames are still used by the main process, keep the
+                # camera going, but drop the frame
+                camera.raw_snap()
+                ring.dropped[0] += 1
+                frame_number += 1
+                continue
+            ring.free[slot] = 0
+            ring.sequence[slot] += 1  # odd: being written
+            snap_time = time.time()
+            try:
+                camera.raw_snap_into(ring.buffers[slot])
+            except Exception:
+                traceback.print_exc()
+                ring.sequence[slot] += 1
+                ring.free[slot] = 1
+                time.sleep(.1)
+                continue
+            ring.timestamps[slot] = snap_time
+            ring.numbers[slot] = frame_number
+            frame_number += 1
+            ring.sequence[slot] += 1  # even: complete
+            ring.written[0] += 1
+            next_slot = (slot + 1) % ring_size
+            frame_conn.send(slot)
+    finally:
+        ring.close()
+        camera.close()
+
+
+class ProcessCamera(Camera):
+    '''
+    A camera whose driver and acquisition loop run in a child process.
+
+    The camera is created in the child process (with the ``spawn`` method) by
+    calling ``camera_class(*args, **kwds)``, all arguments therefore have to be
+    picklable. Note that the camera object in the child process does not
+    share any state with the main process: methods of the camera that need
+    to be executed in the child process have to be called with `call`
+    (`set_exposure`, `get_exposure`, `get_frame_rate`, and `reset` are
+    forwarded automatically). Overlays, display mapping, recordings, and
+    subscriptions are handled by the main process. Simulated cameras that
+    depend on the state of other simulated devices (e.g. `.FakeCalCamera`)
+    only work if that state can be reconstructed in the child process. If
+    `adaptive_rate` is enabled, its idle rate slows down the acquisition loop
+    in the child process, the main process never delays reading frames.
+
+    Parameters
+    ----------
+    camera_class : type
+        The `.Camera` class to run in the child process.
+    args, kwds
+        The arguments for creating the camera.
+    ring_size : int, optional
+        The number of frame buffers in shared memory (the frame pool cannot
+        grow beyond it). Defaults to 32.
+    '''
+    #: The maximum time (in seconds) `close` waits for borrowed frames to be
+    #: released
+    close_timeout = 2.
+
+    def __init__(self, camera_class, *args, ring_size=32, **kwds):
+        super(ProcessCamera, self).__init__()
+        self.ring_size = ring_size
+        context = multiprocessing.get_context('spawn')
+        self._command_conn, child_command_conn = context.Pipe()
+        self._frame_conn, child_frame_conn = context.Pipe(duplex=False)
+        self._command_lock = threading.Lock()
+        self._process = context.Process(target=_camera_process,
+                                        args=(camera_class, args, kwds,
+                                              child_command_conn,
+                                              child_frame_conn, ring_size),
+                                        name='camera_process', daemon=True)
+        self._process.start()
+        # The child process sends the frame format of its camera, the shared
+        # memory is created (and later removed) by the main process
+        _, shape, dtype, self.width, self.height = self._command_conn.recv()
+        dtype = np.dtype(dtype)
+        frame_bytes = int(np.prod(shape)) * dtype.itemsize
+        self._data_memory = shared_memory.SharedMemory(create=True,
+                                                       size=ring_size*frame_bytes)
+        self._control_memory = shared_memory.SharedMemory(create=True,
+                                                          size=SharedFrameRing.control_size(ring_size))
+        self._ring = SharedFrameRing(self._data_memory.name,
+                                     self._control_memory.name, ring_size,
+                                     shape, dtype)
+        self._ring.free[:] = 1
+        self._command_conn.send((self._data_memory.name,
+                                 self._control_memory.name))
+        processed_shape, processed_dtype = processed_format(shape, dtype)
+        self._frame_pool = FramePool(shape, dtype,
+                                     processor=self._process_frame,
+                                     processed_shape=processed_shape,
+                                     processed_dtype=processed_dtype,
+                                     buffers=self._ring.buffers,
+                                     on_free=self._slot_freed)
+        self.start_acquisition()
+
+    def _slot_freed(self, slot):
+        # The child process can write to the slot again (frames can still be
+        # released after `close`, when the ring is gone)
+        free = self._ring.free
+        if free is not None:
+            free[slot] = 1
+
+    def _update_interval(self):
+        # Tell the camera process whether to slow down (see `adaptive_rate`)
+        adaptive_rate = self.adaptive_rate
+        self._ring.interval[0] = 1. / adaptive_rate.idle_rate if adaptive_rate.idle else 0.
+
+    def _wait_for_next_frame(self, frame_start):
+        # The camera process slows down instead, frames are read without delay
+        self._update_interval()
+
+    def _snap_into_pool(self):
+        # Wait for the next frame in short steps, so that the camera process
+        # returns to the full rate as soon as the adaptive rate wakes up
+        for _ in range(10):
+            self._update_interval()
+            if self._frame_conn.poll(0.05):
+                break
+        else:
+            if not self._process.is_alive():
+                raise RuntimeError('The camera process is no longer running')
+            return None
+        slot = self._frame_conn.recv()
+        if self._ring.sequence[slot] % 2:
+            raise RuntimeError('Frame slot {} is still being written'.format(slot))
+        self._frame_pool.claim(slot)
+        return slot
+
+    def _acquisition_info(self, slot, snap_time, frame_number):
+        # Written by the camera process together with the frame
+        return float(self._ring.timestamps[slot]), int(self._ring.numbers[slot])
+
+    def _send_command(self, command, name, args=(), kwds=None):
+        if not self._process.is_alive():
+            raise RuntimeError('The camera process is no longer running')
+        with self._command_lock:
+            self._command_conn.send((command, name, args, kwds or {}))
+            status, result = self._command_conn.recv()
+        if status == 'error':
+            raise result
+        return result
+
+    def call(self, name, *args, **kwds):
+        '''
+        Call a method of the camera in the child process.
+
+        Parameters
+        ----------
+        name : str
+            The name of the method.
+        args, kwds
+            The (picklable) arguments of the method.
+
+        Returns
+        -------
+        result
+            The (pickled) return value of the method.
+        '''
+        return self._send_command('call', name, args, kwds)
+
+    def get_attribute(self, name):
+        '''Get the value of an attribute of the camera in the child process.'''
+        return self._send_command('get', name)
+
+    def set_attribute(self, name, value):
+        '''Set the value of an attribute of the camera in the child process.'''
+        self._send_command('set', name, (value, ))
+
+    def raw_snap(self):
+        '''
+        Returns a copy of the most recent frame written by the camera process.
+        '''
+        frame = self.borrow_last_frame()
+        while frame is None:
+            time.sleep(0.01)
+            frame = self.borrow_last_frame()
+        with frame:
+            return frame.raw.copy()
+
+    def set_exposure(self, value):
+        self.call('set_exposure', value)
+
+    def get_exposure(self):
+        return self.call('get_exposure')
+
+    def get_frame_rate(self):
+        return self.call('get_frame_rate')
+
+    def reset(self):
+        self.call('reset')
+
+    def frame_pool_stats(self):
+        stats = super(ProcessCamera, self).frame_pool_stats()
+        # Frames dropped by the camera process because the ring was full
+        stats['exhausted'] += int(self._ring.dropped[0])
+        return stats
+
+    def close(self):
+        if self._acquisition_thread is not None:
+            self.stop_acquisition()
+            self._acquisition_thread.join()
+        if self._process.is_alive():
+            with self._command_lock:
+                self._command_conn.send(('stop', None, (), {}))
+            self._process.join(5)
+            if self._process.is_alive():
+                logging.getLogger(__name__).warning('Camera process did not stop, terminating it')
+                self._process.terminate()
+        # Release the views on the shared memory before removing it
+        with self._latest_lock:
+            latest, self._latest_frame = self._latest_frame, None
+        if latest is not None:
+            latest.release()
+        # Borrowed frames are views on the shared memory, it cannot be unmapped
+        # before they have been released
+        pool, self._frame_pool = self._frame_pool, None
+        deadline = time.time() + self.close_timeout
+        while pool.in_use() and time.time() < deadline:
+            time.sleep(0.01)
+        if pool.in_use():
+            logging.getLogger(__name__).warning('{} frames of the camera process are still in use, '
+                                                'keeping the shared memory until '
+                                                'exit'.format(pool.in_use()))
+        else:
+            self._ring.close()
+        for memory in (self._data_memory, self._control_memory):
+            try:
+                memory.close()
+            except BufferError:
+                pass
+            memory.unlink()
+        super(ProcessCamera, self).close()
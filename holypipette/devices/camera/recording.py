@@ -0,0 +1,449 @@
+'''
+A single-file container for camera recordings.
+
+A recording (``.hpr`` file) consists of a file header, one chunk per frame,
+and an index table at the end of the file::
+
+    file header | chunk 0 | chunk 1 | ... | chunk N-1 | frame metadata | index | trailer
+
+The file header stores the format version and a JSON description of the
+recording (frame shape, data type, and additional metadata). Every chunk
+starts with a small header containing the frame number, the timestamps and the
+size of the image data that follows it. Chunks are only ever appended to the
+file, and the index table (offsets and metadata of all frames) is written
+once when the recording is closed, so that any frame can be read back with a
+single seek. If a recording has not been closed properly (e.g. after a crash),
+the index is rebuilt by walking through the chunk headers.
+
+Additional per-frame information (e.g. the overlay state, see
+`.FrameOverlay`) is stored in a JSON side table (the frame metadata), which
+only records changes. It is written when the recording is closed.
+
+Frames can optionally be stored with lossless compression (see
+`COMPRESSIONS`), each chunk is compressed independently.
+'''
+import bisect
+import datetime
+import json
+import os
+import struct
+import threading
+import zlib
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+__all__ = ['RecordingWriter', 'RecordingReader', 'RECORDING_EXTENSION',
+           'COMPRESSIONS', 'available_compressions', 'compress_frame']
+
+#: The file extension used for recordings
+RECORDING_EXTENSION = '.hpr'
+
+FORMAT_VERSION = 2  # version 2 added compression
+# magic, format version, length of the JSON description
+_FILE_HEADER = struct.Struct('<6sHI')
+_FILE_MAGIC = b'HPREC\x00'
+# magic, frame number, timestamp, elapsed time, creation time, data size
+_CHUNK_HEADER = struct.Struct('<4sqdddQ')
+_CHUNK_MAGIC = b'FRM\x00'
+# The frame metadata uses the same header, with a different magic
+_METADATA_MAGIC = b'MET\x00'
+# offset of the index, number of frames, magic
+_TRAILER = struct.Struct('<QQ8s')
+_TRAILER_MAGIC = b'HPRINDEX'
+
+#: The structure of the index table, one entry per frame
+INDEX_DTYPE = np.dtype([('frame_number', '<i8'),
+                        ('timestamp', '<f8'),
+                        ('elapsed_time', '<f8'),
+                        ('creation_time', '<f8'),
+                        ('offset', '<u8'),
+                        ('nbytes', '<u8')])
+
+#: Supported compression methods with their default compression level
+COMPRESSIONS = {'deflate': 6, 'zstd': 3, 'lz4': 0}
+
+
+def available_compressions():
+    '''
+    The compression methods that can be used on this system (``'zstd'`` needs
+    the ``zstandard`` package, ``'lz4'`` the ``lz4`` package).
+    '''
+    available = ['deflate']
+    if zstandard is not None:
+        available.append('zstd')
+    if lz4 is not None:
+        available.append('lz4')
+    return available
+
+
+def _check_compression(compression):
+    if compression is None:
+        return
+    if compression not in COMPRESSIONS:
+        raise ValueError('Unknown compression "{}", has to be one of '
+                         '{}'.format(compression, ', '.join(COMPRESSIONS)))
+    if compression not in available_compressions():
+        raise ValueError('Compression "{}" needs a package that is not '
+                         'installed'.format(compression))
+
+
+def compress_frame(image, compression, level=None):
+    '''
+    Compress the data of a single frame. Can be called from several threads
+    in parallel, the compression libraries do not hold the GIL.
+
+    Parameters
+    ----------
+    image : `~numpy.ndarray`
+        The image data.
+    compression : str or None
+        The compression method (one of `COMPRESSIONS`), or ``None`` to not
+        compress the data.
+    level : int, optional
+        The compression level. Defaults to the default level of the method.
+
+    Returns
+    -------
+    data : bytes or `memoryview`
+        The (compressed) data.
+    '''
+    data = memoryview(np.ascontiguousarray(image)).cast('B')
+    if compression is None:
+        return data
+    if level is None:
+        level = COMPRESSIONS[compression]
+    if compression == 'deflate':
+        return zlib.compress(data, level)
+    elif compression == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    elif compression == 'lz4':
+        return lz4.frame.compress(data, compression_level=level)
+    raise ValueError('Unknown compression "{}"'.format(compression))
+
+
+def _decompress_into(data, compression, out):
+    if compression == 'deflate':
+        decompressed = zlib.decompress(data)
+    elif compression == 'zstd':
+        decompressed = zstandard.ZstdDecompressor().decompress(data,
+                                                                max_output_size=out.nbytes)
+    elif compression == 'lz4':
+        decompressed = lz4.frame.decompress(data)
+    else:
+        raise ValueError('Unknown compression "{}"'.format(compression))
+    memoryview(out).cast('B')[:] = decompressed
+
+
+class RecordingWriter(object):
+    '''
+    Appends frames to a new recording file.
+
+    The frame shape and data type are taken from the first frame, all further
+    frames have to match them.
+
+    Parameters
+    ----------
+    filename : str
+        The name of the file. Existing files are overwritten.
+    metadata : dict, optional
+        Additional (JSON-serializable) information stored in the file header.
+    buffer_size : int, optional
+        The size of the write buffer in bytes. Defaults to 8MB.
+    compression : str, optional
+        The compression method (one of `COMPRESSIONS`). Frames are stored
+        uncompressed by default.
+    level : int, optional
+        The compression level. Defaults to the default level of the method.
+    '''
+    def __init__(self, filename, metadata=None, buffer_size=8*1024*1024,
+                 compression=None, level=None):
+        _check_compression(compression)
+        self.filename = filename
+        self.metadata = dict(metadata) if metadata is not None else {}
+        self.compression = compression
+        self.level = level
+        self.shape = None
+        self.dtype = None
+        self._file = open(filename, 'wb', buffering=buffer_size)
+        self._position = 0
+        self._index = []
+        # (position, metadata) for each frame where the metadata changed
+        self._frame_metadata = []
+        self._header_written = False
+
+    def __len__(self):
+        return len(self._index)
+
+    def _write_header(self):
+        description = {'shape': list(self.shape) if self.shape is not None else None,
+                       'dtype': self.dtype.str if self.dtype is not None else None,
+                       'created': datetime.datetime.now().isoformat(),
+                       'compression': self.compression,
+                       'metadata': self.metadata}
+        encoded = json.dumps(description).encode('utf-8')
+        self._file.write(_FILE_HEADER.pack(_FILE_MAGIC, FORMAT_VERSION,
+                                           len(encoded)))
+        self._file.write(encoded)
+        self._position += _FILE_HEADER.size + len(encoded)
+        self._header_written = True
+
+    def write(self, image, frame_number, timestamp, elapsed_time,
+              creation_time=None, data=None, metadata=None):
+        '''
+        Append a frame to the recording.
+
+        Parameters
+        ----------
+        image : `~numpy.ndarray`
+            The image data.
+        frame_number : int
+            The frame number.
+        timestamp : float
+            The time of the acquisition (as returned by `time.time`).
+        elapsed_time : float
+            The time since the start of the acquisition (in seconds).
+        creation_time : `~datetime.datetime`, optional
+            The time the frame was stored. Defaults to ``timestamp``.
+        data : bytes, optional
+            The image data, already compressed with `compress_frame` (using
+            the compression method of the recording). If not specified, the
+            image data is compressed by the writer.
+        metadata : dict, optional
+            JSON-serializable information about the frame, can be retrieved
+            with `RecordingReader.frame_metadata`.
+        '''
+        if self._file is None:
+            raise ValueError('Cannot write to a closed recording')
+        image = np.ascontiguousarray(image)
+        if not self._header_written:
+            self.shape = image.shape
+            self.dtype = image.dtype
+            self._write_header()
+        elif image.shape != self.shape or image.dtype != self.dtype:
+            raise ValueError('Frame with shape {} and type {} does not match '
+                             'the recording (shape {}, type {})'.format(image.shape,
+                                                                        image.dtype,
+                                                                        self.shape,
+                                                                        self.dtype))
+        if creation_time is None:
+            creation_time = timestamp
+        elif isinstance(creation_time, datetime.datetime):
+            creation_time = creation_time.timestamp()
+        if data is None:
+            data = compress_frame(image, self.compression, self.level)
+        nbytes = len(memoryview(data).cast('B'))
+        self._file.write(_CHUNK_HEADER.pack(_CHUNK_MAGIC, frame_number,
+                                            timestamp, elapsed_time,
+                                            creation_time, nbytes))
+        self._file.write(data)
+        if ((metadata is not None or self._frame_metadata) and
+                (not self._frame_metadata or self._frame_metadata[-1][1] != metadata)):
+            self._frame_metadata.append((len(self._index), metadata))
+        self._index.append((frame_number, timestamp, elapsed_time,
+                            creation_time, self._position, nbytes))
+        self._position += _CHUNK_HEADER.size + nbytes
+
+    def flush(self):
+        '''Write all buffered data to disk.'''
+        self._file.flush()
+
+    def close(self):
+        '''Write the index table and close the file.'''
+        if self._file is None:
+            return
+        if not self._header_written:
+            self._write_header()
+        if self._frame_metadata:
+            encoded = json.dumps(self._frame_metadata).encode('utf-8')
+            self._file.write(_CHUNK_HEADER.pack(_METADATA_MAGIC, -1, 0, 0, 0,
+                                                len(encoded)))
+            self._file.write(encoded)
+            self._position += _CHUNK_HEADER.size + len(encoded)
+        index = np.array(self._index, dtype=INDEX_DTYPE)
+        self._file.write(index.tobytes())
+        self._file.write(_TRAILER.pack(self._position, len(index),
+                                       _TRAILER_MAGIC))
+        self._file.close()
+        self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class RecordingReader(object):
+    '''
+    Random access to the frames of a recording file.
+
+    Frames are accessed by their position in the recording, i.e. ``reader[n]``
+    returns the n-th stored frame. The metadata of all frames is available
+    as a structured array in `index` (fields ``frame_number``, ``timestamp``,
+    ``elapsed_time``, ``creation_time``, ``offset``, and ``nbytes``).
+
+    Parameters
+    ----------
+    filename : str
+        The name of the recording file.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, 'rb')
+        self._lock = threading.Lock()
+        header = self._file.read(_FILE_HEADER.size)
+        if len(header) < _FILE_HEADER.size:
+            raise ValueError('"{}" is not a recording file'.format(filename))
+        magic, version, length = _FILE_HEADER.unpack(header)
+        if magic != _FILE_MAGIC:
+            raise ValueError('"{}" is not a recording file'.format(filename))
+        if version > FORMAT_VERSION:
+            raise ValueError('Recording format version {} is not '
+                             'supported'.format(version))
+        self.version = version
+        description = json.loads(self._file.read(length).decode('utf-8'))
+        self.shape = tuple(description['shape']) if description['shape'] is not None else None
+        self.dtype = np.dtype(description['dtype']) if description['dtype'] is not None else None
+        self.created = description['created']
+        self.compression = description.get('compression', None)
+        _check_compression(self.compression)
+        self.metadata = description['metadata']
+        self._data_start = _FILE_HEADER.size + length
+        #: Whether the file was closed properly (otherwise, the index has been
+        #: rebuilt from the chunk headers)
+        self.complete = True
+        self.index = self._read_index()
+        if self.index is None:
+            self.complete = False
+            self.index = self._rebuild_index()
+        self._metadata_positions, self._metadata_values = self._read_frame_metadata()
+
+    def _read_index(self):
+        file_size = os.fstat(self._file.fileno()).st_size
+        if file_size < self._data_start + _TRAILER.size:
+            return None
+        self._file.seek(file_size - _TRAILER.size)
+        index_offset, n_frames, magic = _TRAILER.unpack(self._file.read(_TRAILER.size))
+        if (magic != _TRAILER_MAGIC or
+                index_offset + n_frames*INDEX_DTYPE.itemsize + _TRAILER.size != file_size):
+            return None
+        self._file.seek(index_offset)
+        return np.frombuffer(self._file.read(n_frames*INDEX_DTYPE.itemsize),
+                             dtype=INDEX_DTYPE)
+
+    def _read_frame_metadata(self):
+        # The frame metadata directly follows the last frame
+        if len(self.index):
+            offset = int(self.index[-1]['offset'] + self.index[-1]['nbytes']) + _CHUNK_HEADER.size
+        else:
+            offset = self._data_start
+        self._file.seek(offset)
+        header = self._file.read(_CHUNK_HEADER.size)
+        if len(header) < _CHUNK_HEADER.size:
+            return [], []
+        magic, _, _, _, _, nbytes = _CHUNK_HEADER.unpack(header)
+        if magic != _METADATA_MAGIC:
+            return [], []
+        entries = json.loads(self._file.read(nbytes).decode('utf-8'))
+        return [entry[0] for entry in entries], [entry[1] for entry in entries]
+
+    def frame_metadata(self, n):
+        '''
+        The metadata stored with a frame.
+
+        Parameters
+        ----------
+        n : int
+            The position of the frame in the recording (negative values count
+            from the end).
+
+        Returns
+        -------
+        metadata : dict or None
+            The metadata provided to `RecordingWriter.write`, or ``None``.
+        '''
+        if n < 0:
+            n += len(self)
+        if not 0 <= n < len(self):
+            raise IndexError('Frame {} does not exist'.format(n))
+        entry = bisect.bisect_right(self._metadata_positions, n) - 1
+        if entry < 0:
+            return None
+        return self._metadata_values[entry]
+
+    def _rebuild_index(self):
+        file_size = os.fstat(self._file.fileno()).st_size
+        entries = []
+        offset = self._data_start
+        while offset + _CHUNK_HEADER.size <= file_size:
+            self._file.seek(offset)
+            (magic, frame_number, timestamp, elapsed_time, creation_time,
+             nbytes) = _CHUNK_HEADER.unpack(self._file.read(_CHUNK_HEADER.size))
+            end = offset + _CHUNK_HEADER.size + nbytes
+            if magic != _CHUNK_MAGIC or end > file_size:
+                break  # incomplete last frame
+            entries.append((frame_number, timestamp, elapsed_time,
+                            creation_time, offset, nbytes))
+            offset = end
+        return np.array(entries, dtype=INDEX_DTYPE)
+
+    def __len__(self):
+        return len(self.index)
+
+    def read(self, n, out=None):
+        '''
+        Read a single frame.
+
+        Parameters
+        ----------
+        n : int
+            The position of the frame in the recording (negative values count
+            from the end).
+        out : `~numpy.ndarray`, optional
+            An array (of the recording's shape and type) to read the frame
+            into. If not specified, a new array is allocated.
+
+        Returns
+        -------
+        frame : `~numpy.ndarray`
+            The image data.
+        '''
+        entry = self.index[n]
+        if out is None:
+            out = np.empty(self.shape, dtype=self.dtype)
+        elif out.shape != self.shape or out.dtype != self.dtype:
+            raise ValueError('Output array does not match the shape and type '
+                             'of the recording')
+        with self._lock:
+            self._file.seek(int(entry['offset']) + _CHUNK_HEADER.size)
+            if self.compression is None:
+                self._file.readinto(memoryview(out).cast('B'))
+                return out
+            data = self._file.read(int(entry['nbytes']))
+        _decompress_into(data, self.compression, out)
+        return out
+
+    def __getitem__(self, n):
+        return self.read(n)
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self.read(n)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,645 @@
+'''
+Subscriptions to the frames acquired by a `.Camera`.
+
+Each consumer of the camera stream (display, recording, trackers, analysis)
+gets its own `FrameSubscription`, with a policy that decides which frames it
+receives and what happens if it does not keep up. Subscriptions hold
+references to frames in the camera's `.FramePool`, but only for the first few
+waiting frames (`FrameSubscription.pooled_frames`): a larger backlog (e.g. of a
+recording that cannot keep up) is copied out of the pool, so that it does not
+grow the pool. Lossless subscriptions with a spill file copy frames to a
+temporary file instead of dropping them when they are full.
+
+Subscriptions with a region of interest are the exception to this rule: they
+copy only the requested crop of every frame into a small pool of their own, so
+that they never keep the (much larger) full frames alive.
+
+Processed images are never calculated on the acquisition thread: crops and
+copies of frames for ``'processed'`` subscriptions hold the raw image, which
+is only processed when the consumer asks for it.
+'''
+import collections
+import logging
+import tempfile
+import threading
+
+import numpy as np
+
+from .framepool import (FramePool, PooledFrame, PYRAMID_LEVELS, downsample,
+                        processed_format)
+from .overlay import draw_overlay
+
+__all__ = ['FrameSubscription', 'SpilledFrame', 'roi_slices']
+
+
+def roi_slices(roi, shape, offset=None):
+    '''
+    The index slices for a region of interest, clipped to the image borders.
+
+    Parameters
+    ----------
+    roi : tuple
+        The region of interest ``(x, y, width, height)`` in pixels.
+    shape : tuple
+        The shape of the image.
+    offset : tuple, optional
+        The position ``(x, y)`` of the image's top-left corner in the
+        coordinates of ``roi`` (e.g. for images from a hardware ROI of the
+        camera).
+
+    Returns
+    -------
+    rows, columns : slice
+        The slices selecting the region of interest (possibly empty).
+    '''
+    x, y, width, height = [int(round(v)) for v in roi]
+    if offset is not None:
+        x -= int(round(offset[0]))
+        y -= int(round(offset[1]))
+    x0 = min(max(x, 0), shape[1])
+    y0 = min(max(y, 0), shape[0])
+    x1 = min(max(x + width, x0), shape[1])
+    y1 = min(max(y + height, y0), shape[0])
+    return slice(y0, y1), slice(x0, x1)
+
+
+class SpillFile(object):
+    '''
+    A temporary, append-only file holding frames that did not fit into the
+    queue of a subscription. The file is emptied when all frames have been
+    read back.
+    '''
+    def __init__(self, directory=None):
+        self._file = tempfile.TemporaryFile(prefix='holypipette_spill_',
+                                            dir=directory)
+        self._lock = threading.Lock()
+        #: The number of bytes currently stored
+        self.nbytes = 0
+
+    def write(self, image):
+        data = memoryview(np.ascontiguousarray(image)).cast('B')
+        with self._lock:
+            offset = self.nbytes
+            self._file.seek(offset)
+            self._file.write(data)
+            self.nbytes += data.nbytes
+        return offset
+
+    def read(self, offset, shape, dtype):
+        image = np.empty(shape, dtype=dtype)
+        with self._lock:
+            self._file.seek(offset)
+            self._file.readinto(memoryview(image).cast('B'))
+        return image
+
+    def reset(self):
+        with self._lock:
+            self._file.seek(0)
+            self._file.truncate()
+            self.nbytes = 0
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class SpilledFrame(object):
+    '''
+    A frame that has been copied out of the frame pool, because it waited
+    behind too many other frames of a subscription, or has been read back
+    from the subscription's spill file. It provides the same attributes as a
+    `.PooledFrame`, but holds its own copy of the image (at the
+    subscription's pyramid level), so `release` has no effect. If a
+    ``processor`` is given, ``image`` is the full-size raw image, and the
+    processed image is calculated with ``processor(image, None, overlay)`` on
+    first access.
+    '''
+    def __init__(self, image, kind, number, timestamp, elapsed_time,
+                 creation_time, overlay, level=0, processor=None):
+        image.flags.writeable = False
+        self._image = image
+        self._processor = processor
+        self.kind = kind
+        self.level = level
+        self.number = number
+        self.timestamp = timestamp
+        self.elapsed_time = elapsed_time
+        self.creation_time = creation_time
+        self.overlay = overlay
+
+    @property
+    def image(self):
+        if self._processor is not None:
+            image = self._processor(self._image, None, self.overlay)
+            for _ in range(self.level):
+                image = downsample(image)
+            image.flags.writeable = False
+            self._image, self._processor = image, None
+        return self._image
+
+    @property
+    def raw(self):
+        return self.image if self.kind == 'raw' else None
+
+    @property
+    def processed(self):
+        return self.image if self.kind == 'processed' else None
+
+    def downsampled(self, level, kind=None):
+        if kind is not None and kind != self.kind:
+            raise ValueError('A spilled frame is only available as '
+                             '"{}"'.format(self.kind))
+        if level < self.level:
+            raise ValueError('A spilled frame is only available from pyramid '
+                             'level {}'.format(self.level))
+        image = self.image
+        for _ in range(level - self.level):
+            image = downsample(image)
+        return image
+
+    def borrow(self, kind=None, level=None):
+        if ((kind is not None and kind != self.kind) or
+                (level is not None and level != self.level)):
+            raise ValueError('A spilled frame is only available as '
+                             '"{}" at pyramid level {}'.format(self.kind,
+                                                               self.level))
+        return self
+
+    def release(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+class FrameSubscription(object):
+    '''
+    A stream of frames from a camera. Should not be created directly, but via
+    `.Camera.subscribe`.
+
+    Every frame returned by `get` (or by iterating over the subscription) is
+    a `.PooledFrame` (or a `SpilledFrame`) that has to be released by the
+    consumer. The image selected by ``kind`` is available as
+    `.PooledFrame.image`.
+
+    Parameters
+    ----------
+    camera : `.Camera`
+        The camera delivering the frames.
+    policy : str
+        The policy deciding which frames are delivered:
+
+        ``'latest'``
+            Only the most recent frame is kept, older frames are replaced.
+        ``'lossless'``
+            All frames are kept. If the subscription is full, new frames are
+            copied to the spill file (if ``spill`` is set) and delivered after
+            the queued frames. Without a spill file (or if it exceeds
+            ``spill_limit``), new frames are dropped (and counted in
+            `dropped`), but no queued frame is ever discarded.
+        ``'every_nth'``
+            Every ``n``-th frame is delivered. If the subscription is full,
+            the oldest frame is dropped.
+        ``'rate_hz'``
+            Frames are delivered with a rate of at most ``rate`` frames per
+            second. If the subscription is full, the oldest frame is dropped.
+    maxlen : int
+        The maximum number of frames waiting in the subscription (in memory).
+        Only the first `pooled_frames` of them are kept in the frame pool,
+        the others are copies.
+    kind : str
+        ``'raw'`` or ``'processed'``, the kind of image returned by
+        `.PooledFrame.image`.
+    n : int, optional
+        The frame interval for the ``'every_nth'`` policy.
+    rate : float, optional
+        The maximum frame rate for the ``'rate_hz'`` policy.
+    held : int, optional
+        The number of frames the consumer keeps after retrieving them (e.g.
+        while processing them in parallel). They are taken into account when
+        sizing the frame pool.
+    spill : bool, optional
+        Whether a lossless subscription copies frames to a temporary file
+        when it is full. Defaults to ``False``.
+    spill_directory : str, optional
+        The directory for the spill file. Defaults to the system's directory
+        for temporary files.
+    spill_limit : int, optional
+        The maximum size of the spill file in bytes. Unlimited by default.
+    roi : tuple, optional
+        A region of interest ``(x, y, width, height)`` in sensor pixels. If
+        given, only this part of each frame (clipped to the image borders) is
+        delivered, copied into a contiguous buffer from a small pool owned by
+        the subscription. Frames that arrive while all of these buffers are
+        in use are counted in `dropped`. For ``'processed'`` subscriptions,
+        only the raw crop is copied and processed on first access, with the
+        overlay state (`.PooledFrame.overlay`) moved to the crop.
+    level : int, optional
+        The pyramid level of the delivered images (see
+        `.PooledFrame.downsampled`): 1, 2, or 3 for images with 1/2, 1/4, or
+        1/8 of the original width and height. Defaults to 0 (full size).
+    full_rate : bool, optional
+        Whether the subscription keeps the camera acquiring at its full rate
+        (see `.AdaptiveRate`). Defaults to ``True`` for the ``'lossless'``
+        policy, and to ``False`` otherwise.
+    '''
+    policies = ('latest', 'lossless', 'every_nth', 'rate_hz')
+    kinds = ('raw', 'processed')
+    #: The maximum number of waiting frames that hold a slot of the camera's
+    #: frame pool, further frames are copied
+    pooled_frames = 4
+
+    def __init__(self, camera, policy, maxlen, kind, n=None, rate=None,
+                 held=0, spill=False, spill_directory=None, spill_limit=None,
+                 roi=None, level=0, full_rate=None):
+        if policy not in self.policies:
+            raise ValueError('Unknown policy "{}", has to be one of '
+                             '{}'.format(policy, ', '.join(self.policies)))
+        if kind not in self.kinds:
+            raise ValueError('Unknown kind "{}", has to be one of '
+                             '{}'.format(kind, ', '.join(self.kinds)))
+        if policy == 'every_nth' and (n is None or n < 1):
+            raise ValueError('The "every_nth" policy needs a positive "n"')
+        if policy == 'rate_hz' and (rate is None or rate <= 0):
+            raise ValueError('The "rate_hz" policy needs a positive "rate"')
+        if policy == 'latest':
+            maxlen = 1
+        if maxlen < 1:
+            raise ValueError('"maxlen" has to be at least 1')
+        if spill and policy != 'lossless':
+            raise ValueError('Only "lossless" subscriptions can spill frames '
+                             'to disk')
+        if not 0 <= level <= PYRAMID_LEVELS:
+            raise ValueError('"level" has to be between 0 and '
+                             '{}'.format(PYRAMID_LEVELS))
+        if roi is not None:
+            roi = tuple(int(round(v)) for v in roi)
+            if len(roi) != 4 or roi[2] < 1 or roi[3] < 1:
+                raise ValueError('"roi" has to be (x, y, width, height) with '
+                                 'a positive width and height')
+        self.camera = camera
+        self.policy = policy
+        self.maxlen = maxlen
+        self.kind = kind
+        self.n = n
+        self.rate = rate
+        self.held = held
+        self.roi = roi
+        self.level = level
+        if full_rate is None:
+            full_rate = policy == 'lossless'
+        self.full_rate = full_rate
+        # Pool for the cropped frames (created with the first frame)
+        self._crop_pool = None
+        #: Number of frames handed to the subscription
+        self.delivered = 0
+        #: Number of frames lost because the subscription was full
+        self.dropped = 0
+        #: Number of frames copied to the spill file
+        self.spilled = 0
+        self.spill_limit = spill_limit
+        self._queue = collections.deque()
+        # Number of frames in the queue that hold a slot of the frame pool
+        self._pooled = 0
+        # Metadata of the frames in the spill file (in order)
+        self._spilled = collections.deque()
+        self._spill_readers = 0
+        # Whether a frame is being written to the spill file
+        self._spill_writing = False
+        self._spill = SpillFile(spill_directory) if spill else None
+        self._condition = threading.Condition()
+        self._closed = False
+        self._offered = 0
+        self._last_delivery = None
+
+    @property
+    def closed(self):
+        '''
+        Whether the subscription no longer receives new frames. Frames that
+        are already waiting can still be retrieved.
+        '''
+        return self._closed
+
+    @property
+    def received(self):
+        '''The number of frames offered to the subscription.'''
+        return self._offered
+
+    @property
+    def spill_waiting(self):
+        '''The number of frames waiting in the spill file.'''
+        return len(self._spilled)
+
+    def __len__(self):
+        return len(self._queue) + len(self._spilled)
+
+    @property
+    def pool_slots(self):
+        '''
+        The number of slots of the camera's frame pool the subscription (and
+        its consumer) can hold at the same time.
+        '''
+        if self.roi is not None:
+            return 0  # cropped frames are copies
+        return min(self.maxlen, self.pooled_frames) + self.held
+
+    def _accepts(self, frame):
+        '''Whether the policy wants to receive this frame.'''
+        self._offered += 1
+        if self.policy == 'every_nth':
+            return (self._offered - 1) % self.n == 0
+        elif self.policy == 'rate_hz':
+            timestamp = frame.timestamp
+            if (self._last_delivery is not None and
+                    timestamp - self._last_delivery < 1. / self.rate):
+                return False
+            self._last_delivery = timestamp
+        return True
+
+    def _offer(self, frame):
+        '''
+        Offer a new frame to the subscription (called from the acquisition
+        thread). The subscription borrows its own reference if it takes the
+        frame.
+        '''
+        if self._closed or not self._accepts(frame):
+            return
+        if self.roi is not None:
+            frame = self._crop_frame(frame)
+            if frame is None:
+                with self._condition:
+                    self.dropped += 1
+                return
+        copy = None
+        if (self.roi is None and self._pooled >= self.pooled_frames and
+                (self.policy != 'lossless' or
+                 (len(self._queue) < self.maxlen and not len(self._spilled)))):
+            # Keep the backlog out of the frame pool (only the acquisition
+            # thread adds frames, so there is no need to check this again)
+            copy = self._copy_frame(frame)
+        evicted = None
+        spill = False
+        try:
+            with self._condition:
+                if self._closed:  # closed in the meantime
+                    return
+                if len(self._spilled) or len(self._queue) >= self.maxlen:
+                    if self.policy == 'lossless':
+                        if self._spill is None:
+                            self.dropped += 1
+                            return
+                        spill = self._spill_writing = True
+                    else:
+                        evicted = self._popleft()
+                        if self.policy != 'latest':
+                            self.dropped += 1
+                if not spill:
+                    if copy is None:
+                        copy = frame.borrow(kind=self.kind, level=self.level)
+                        if self.roi is None:
+                            self._pooled += 1
+                    self._queue.append(copy)
+                    self.delivered += 1
+                    self._condition.notify_all()
+            if spill:
+                # Write to the file without blocking the consumer
+                self._spill_frame(frame)
+        finally:
+            if self.roi is not None:
+                frame.release()  # the queue holds its own reference
+        if evicted is not None:
+            evicted.release()
+
+    def _popleft(self):
+        # Take the oldest frame from the queue (called with the condition
+        # locked)
+        frame = self._queue.popleft()
+        if self.roi is None and isinstance(frame, PooledFrame):
+            self._pooled -= 1
+        return frame
+
+    def _copy_frame(self, frame):
+        '''
+        Copy the image of a frame (of the subscription's kind and pyramid
+        level) out of the frame pool.
+
+        Returns
+        -------
+        copy : `SpilledFrame`
+            The copied frame.
+        '''
+        return SpilledFrame(self._stored_image(frame).copy(), self.kind,
+                            frame.number, frame.timestamp, frame.elapsed_time,
+                            frame.creation_time, frame.overlay,
+                            level=self.level, processor=self._processor())
+
+    def _stored_image(self, frame):
+        '''
+        The image that is stored when a frame is copied or spilled: the
+        full-size raw image for ``'processed'`` subscriptions (processed by the
+        consumer, see `_process_image`), and the raw image at the
+        subscription's pyramid level otherwise. The caller has to hold a
+        reference to the frame.
+        '''
+        if self.kind == 'processed':
+            return frame.raw
+        return frame.downsampled(self.level, 'raw')
+
+    def _processor(self):
+        # The function processing stored raw images, if any
+        return self._process_image if self.kind == 'processed' else None
+
+    def _process_image(self, raw, out=None, overlay=None):
+        '''
+        Process a raw frame or crop like `.Camera.preprocess`, without
+        updating the display window (it follows the full frames). Called
+        lazily, i.e. by the consumer.
+        '''
+        if not raw.size:  # empty region of interest
+            if out is None:
+                out = np.zeros(*processed_format(raw.shape, raw.dtype))
+            return out
+        display_lut = self.camera.display_lut
+        if not display_lut.is_identity(raw.dtype):
+            raw = np.take(display_lut.table(raw.dtype), raw,
+                          out=display_lut.buffer(raw.shape))
+        return draw_overlay(raw, overlay, out=out)
+
+    def _crop_frame(self, frame):
+        '''
+        Copy the region of interest of a frame's raw image into the
+        subscription's crop pool. For ``'processed'`` subscriptions, the crop
+        is processed when it is requested, with the overlays moved to the
+        crop.
+
+        Returns
+        -------
+        cropped : `.PooledFrame` or None
+            The cropped frame (with the metadata of the original frame), or
+            ``None`` if all buffers of the crop pool are in use.
+        '''
+        raw = frame.raw
+        rows, columns = roi_slices(self.roi, raw.shape,
+                                   self.camera.roi_offset())
+        overlay = frame.overlay
+        if self.kind == 'processed' and overlay is not None:
+            if overlay.flipped:
+                # The region refers to the (horizontally flipped) processed
+                # image
+                width = raw.shape[1]
+                columns = slice(width - columns.stop, width - columns.start)
+            overlay = overlay.translated(columns.start, rows.start)
+        crop = raw[rows, columns]
+        pool = self._crop_pool
+        if pool is None or not pool.matches(crop.shape, crop.dtype):
+            # The frame size changed (e.g. a new hardware ROI)
+            processed_shape, processed_dtype = processed_format(crop.shape,
+                                                                crop.dtype)
+            pool = self._crop_pool = FramePool(crop.shape, crop.dtype,
+                                               size=self.maxlen + self.held + 2,
+                                               processor=self._processor(),
+                                               processed_shape=processed_shape,
+                                               processed_dtype=processed_dtype)
+        slot = pool.acquire()
+        if slot is None:
+            return None
+        np.copyto(pool.buffer(slot), crop)
+        return pool.publish(slot, frame.number, frame.timestamp,
+                            frame.elapsed_time, frame.creation_time,
+                            overlay=overlay)
+
+    def _spill_frame(self, frame):
+        '''
+        Copy a frame to the spill file, or count it as dropped if this is not
+        possible. Called by the acquisition thread (without the condition
+        locked, while ``_spill_writing`` is set), the spilled frames are
+        therefore appended in order.
+        '''
+        offset = None
+        data = self._stored_image(frame)
+        try:
+            if (self.spill_limit is None or
+                    self._spill.nbytes + data.nbytes <= self.spill_limit):
+                offset = self._spill.write(data)
+        except (OSError, ValueError) as ex:
+            if not self._closed:  # the file is closed by `unsubscribe`
+                logging.getLogger(__name__).error('Could not write frame to '
+                                                  'spill file: {}'.format(ex))
+        with self._condition:
+            self._spill_writing = False
+            if offset is None:
+                self.dropped += 1
+                return
+            self._spilled.append((offset, data.shape, data.dtype, frame.number,
+                                  frame.timestamp, frame.elapsed_time,
+                                  frame.creation_time, frame.overlay))
+            self.spilled += 1
+            self.delivered += 1
+            self._condition.notify_all()
+
+    def _read_spilled(self, entry):
+        offset, shape, dtype = entry[:3]
+        try:
+            image = self._spill.read(offset, shape, dtype)
+        finally:
+            with self._condition:
+                self._spill_readers -= 1
+                # Empty the spill file once it has been read completely
+                if (not self._spilled and not self._spill_readers and
+                        not self._spill_writing):
+                    self._spill.reset()
+        return SpilledFrame(image, self.kind, *entry[3:], level=self.level,
+                            processor=self._processor())
+
+    def wait(self, timeout=None):
+        '''
+        Wait until a frame is available.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            The maximum time to wait (in seconds). Waits indefinitely if not
+            specified.
+
+        Returns
+        -------
+        available : bool
+            Whether a frame is available. ``False`` if the timeout expired or
+            the subscription has been closed.
+        '''
+        with self._condition:
+            return self._condition.wait_for(lambda: len(self) or self._closed,
+                                            timeout=timeout) and len(self) > 0
+
+    def get(self, timeout=None):
+        '''
+        Get the next frame, waiting for it if necessary.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            The maximum time to wait (in seconds). Waits indefinitely if not
+            specified, use ``0`` to not wait at all.
+
+        Returns
+        -------
+        frame : `.PooledFrame`, `SpilledFrame`, or None
+            The next frame, or ``None`` if no frame arrived before the
+            timeout, or if the subscription is closed and no frames are left.
+            The frame has to be released by the caller.
+        '''
+        with self._condition:
+            if not self._condition.wait_for(lambda: len(self) or self._closed,
+                                            timeout=timeout):
+                return None
+            if len(self._queue):
+                return self._popleft()
+            if not len(self._spilled):
+                return None
+            # Frames in the spill file are always newer than queued frames
+            entry = self._spilled.popleft()
+            self._spill_readers += 1
+        return self._read_spilled(entry)
+
+    def __iter__(self):
+        '''Iterate over all frames until the subscription is closed.'''
+        while True:
+            frame = self.get()
+            if frame is None:
+                return
+            yield frame
+
+    def close(self):
+        '''
+        Stop receiving new frames. Frames that are already waiting can still
+        be retrieved with `get`.
+        '''
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self.camera._remove_subscription(self)
+
+    def unsubscribe(self):
+        '''
+        Stop receiving new frames and release all frames that are still
+        waiting.
+        '''
+        self.close()
+        with self._condition:
+            remaining = list(self._queue)
+            self._queue.clear()
+            self._pooled = 0
+            self._spilled.clear()
+        for frame in remaining:
+            frame.release()
+        if self._spill is not None:
+            self._spill.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.unsubscribe()
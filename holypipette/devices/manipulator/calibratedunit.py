@@ -251,6 +251,38 @@ class CalibratedUnit(ManipulatorUnit):
             # The third axis is in um, the first two in pixels, hence the odd formula
             p.append(((M[0,axis]**2 + M[1,axis]**2))**.5) #TODO: is this correct? 
         return p
+
+    def camera_roi(self, width_um, height_um=None, position=None):
+        '''
+        Region of interest of the camera around a position of the unit, e.g.
+        to only receive the part of the image around the pipette tip (see
+        `.Camera.subscribe` and `.Camera.grab`).
+
+        Parameters
+        ----------
+        width_um : width of the region in um
+        height_um : height of the region in um (defaults to width_um)
+        position : XYZ position vector in um in the unit's coordinate system
+                   (defaults to the current position)
+
+        Returns
+        -------
+        The region (x, y, width, height) in pixels (camera coordinate frame,
+        origin at the top left corner).
+        '''
+        if height_um is None:
+            height_um = width_um
+        if position is None:
+            center = self.reference_position()
+        else:
+            center = self.um_to_pixels(position) + self.stage.reference_position() + self.emperical_offset
+        pixel_per_um = getattr(self.camera, 'pixel_per_um', None)
+        if pixel_per_um is None:
+            pixel_per_um = self.pixel_per_um()[0]
+        width = int(round(width_um * pixel_per_um))
+        height = int(round(height_um * pixel_per_um))
+        return (int(round(center[0])) - width // 2,
+                int(round(center[1])) - height // 2, width, height)
     
 
     def save_configuration(self):
@@ -378,14 +410,14 @@ class CalibratedStage(CalibratedUnit):
 
         try:
             for row in range(ny):
-                img, _ = self.camera.snap()
+                img = self.camera.grab(fresh_after=time.time())
                 big_image[row*dy:(row+1)*dy, column*dx:(column+1)*dx] = img
                 for _ in range(1,nx):
                     column+=xdirection
                     self.reference_relative_move([-dx*xdirection,0,0]) # sign: it's a compensatory move
                     self.wait_until_still()
                     self.sleep(0.1)
-                    img, _ = self.camera.snap()
+                    img = self.camera.grab(fresh_after=time.time())
                     big_image[row * dy:(row + 1) * dy, column * dx:(column + 1) * dx] = img
                 if row<ny-1:
                     xdirection = -xdirection
@@ -7,7 +7,7 @@ from __future__ import absolute_import
 from .manipulator import Manipulator
 
 from numpy import zeros, clip, pi
-import time
+from holypipette.utils import clock
 import math
 
 __all__ = ['FakeManipulator']
@@ -65,8 +65,8 @@ class FakeManipulator(Manipulator):
             return False
 
         #see if the last command is still running
-        dt = time.time() - self.cmd_time[axis-1]
-        self.cmd_time[axis-1] = time.time()
+        dt = clock.time() - self.cmd_time[axis-1]
+        self.cmd_time[axis-1] = clock.time()
 
         #we're moving forward, but haven't reached the setpoint
         if (self.x[axis-1] + self.speeds[axis-1] * dt < self.setpoint[axis-1]) and self.speeds[axis-1] > 0:
@@ -103,7 +103,7 @@ class FakeManipulator(Manipulator):
         else:
             self.setpoint[axis-1] = clip(x, self.min[axis-1], self.max[axis-1])
         
-        self.cmd_time[axis-1] = time.time()
+        self.cmd_time[axis-1] = clock.time()
         self.speeds[axis-1] = self.max_speed * math.copysign(1, x - self.x[axis-1])
 
 
@@ -115,4 +115,4 @@ class FakeManipulator(Manipulator):
     def wait_until_still(self, axes=None):
         for i in range(self.num_axes):
             while self.update_axis(i+1):
-                time.sleep(0.1)
\ No newline at end of file
+                clock.sleep(0.1)
\ No newline at end of file
@@ -8,10 +8,10 @@ To make a new device, one must implement at least:
 TODO:
 * Add minimum and maximum for each axis
 """
-import time
 from numpy import array
 
 from holypipette.controller import TaskController
+from holypipette.utils import clock
 from holypipette.utils.supabaseDBstuff import supabase
 
 __all__ = ['Manipulator', 'ManipulatorError']
@@ -155,9 +155,9 @@ class Manipulator(TaskController):
 
         current_position = position
         previous_position = current_position
-        t0 = time.time()
+        t0 = clock.time()
         while (abs(current_position-position)>precision).any():
-            if (time.time()-t0>timeout) & (array(previous_position == current_position).all()):
+            if (clock.time()-t0>timeout) & (array(previous_position == current_position).all()):
                 raise ManipulatorError("Time out while waiting for manipulator to reach target position.")
             previous_position = current_position
             if len(axes) == 1:
@@ -9,6 +9,7 @@ TODO:
 from holypipette.devices.manipulator import Manipulator
 import time
 import warnings
+from holypipette.utils import clock
 try:
     import cv2
 except:
@@ -93,7 +94,7 @@ class Microscope(Manipulator):
 
         Parameters
         ----------
-        camera : a camera, eg with a snap() method
+        camera : a camera, eg with a grab() method
         z : A list of z positions
         preprocessing : a function that processes the images (optional)
         save : saves images to disk if True
@@ -108,8 +109,8 @@ class Microscope(Manipulator):
             current_z = zi
             self.wait_until_still()
             # We wait a little bit because there might be mechanical oscillations
-            time.sleep(pause) # also make sure the camera is in sync
-            img = preprocessing(camera.snap())
+            clock.sleep(pause) # also make sure the camera is in sync
+            img = preprocessing(camera.grab(fresh_after=time.time()))
             images.append(img)
             if save is not None:
                 cv2.imwrite('./screenshots/'+save+'{}.jpg'.format(k), img)
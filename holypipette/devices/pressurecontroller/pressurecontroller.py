@@ -2,9 +2,9 @@
 A general pressure controller class
 '''
 import collections
-import time
 
 from holypipette.controller.base import TaskController
+from holypipette.utils import clock
 
 all = ['PressureController',  'FakePressureController']
 
@@ -38,12 +38,12 @@ class PressureController(TaskController):
         '''
         Makes a ramp of pressure
         '''
-        t0 = time.time()
+        t0 = clock.time()
         t = t0
         while t-t0<duration:
             self.set_pressure(amplitude*(t-t0)/duration)
-            time.sleep(0.05)
-            t = time.time()
+            clock.sleep(0.05)
+            t = clock.time()
         self.set_pressure(0.)
 
 
@@ -20,13 +20,15 @@ import param
 from PyQt5 import QtCore, QtWidgets, QtGui
 from PyQt5.QtCore import Qt
 from PyQt5.QtWidgets import (QDialog, QPushButton, QDialogButtonBox, QHBoxLayout, QVBoxLayout,
-                             QLabel, QLineEdit, QStyle, QFileDialog, QSpinBox)
+                             QLabel, QLineEdit, QStyle, QFileDialog, QSpinBox,
+                             QComboBox, QCheckBox)
 import qtawesome as qta
 
 from holypipette.interface.camera import CameraInterface
 from holypipette.controller import TaskController
 from holypipette.interface.patch import NumberWithUnit
 from holypipette.interface.base import command
+from holypipette.devices.camera.recording import COMPRESSIONS, available_compressions
 from .livefeed import LiveFeedQt
 
 
@@ -290,8 +292,21 @@ class LogNotifyHandler(logging.Handler):
             message = '{} ({})'.format(record.msg, str(exc))
         self.signal.emit(message)
 
+def format_recording_stats(stats):
+    '''
+    Summarizes the frame counts returned by `.Camera.recording_stats`.
+    '''
+    text = '{acquired} acquired, {written} written, {spilled} spilled, {dropped} dropped'.format(**stats)
+    if stats['skipped']:
+        text += ', {skipped} skipped'.format(**stats)
+    if stats['waiting']:
+        text += ', {waiting} waiting'.format(**stats)
+    return text
+
+
 class RecordingDialog(QDialog):
-    def __init__(self, base_directory, frame_rate, pixels, settings, parent=None):
+    def __init__(self, base_directory, frame_rate, pixels, settings,
+                 last_recording=None, parent=None):
         super(RecordingDialog, self).__init__(parent=parent)
 
         self.frame_rate = frame_rate
@@ -343,6 +358,35 @@ class RecordingDialog(QDialog):
         self.prefix_preview = QLabel()
         self.prefix_edit.setText(settings.get('prefix', 'frame'))
 
+        compression_label = QLabel('Compression:')
+        self.compression_combo = QComboBox()
+        self.compression_combo.addItem('none')
+        self.compression_combo.addItems(available_compressions())
+        self.level_spin = QSpinBox()
+        self.level_spin.setRange(0, 22)
+        self.level_spin.setPrefix('level ')
+        self.workers_spin = QSpinBox()
+        self.workers_spin.setRange(0, os.cpu_count() or 1)
+        self.workers_spin.setSuffix(' worker(s)')
+        self.compression_combo.currentTextChanged.connect(self.compression_edited)
+        index = self.compression_combo.findText(settings.get('compression', 'none'))
+        self.compression_combo.setCurrentIndex(max(index, 0))
+        self.compression_edited(self.compression_combo.currentText())  # trigger even for default value
+        self.level_spin.setValue(settings.get('compression_level', self.level_spin.value()))
+        self.workers_spin.setValue(settings.get('workers', 0))
+        compression_layout = QHBoxLayout()
+        compression_layout.addWidget(compression_label)
+        compression_layout.addWidget(self.compression_combo)
+        compression_layout.addWidget(self.level_spin)
+        compression_layout.addWidget(self.workers_spin)
+
+        self.lossless_check = QCheckBox('Lossless (move frames to a temporary file when the queue is full)')
+        self.lossless_check.setChecked(settings.get('lossless', False))
+        if last_recording is not None:
+            self.last_recording_label = QLabel('<i>Last recording: {}</i>'.format(format_recording_stats(last_recording)))
+        else:
+            self.last_recording_label = None
+
         btns = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
         btns.accepted.connect(self.accept)
         btns.rejected.connect(self.reject)
@@ -355,11 +399,22 @@ class RecordingDialog(QDialog):
         self.layout.addWidget(self.frame_rate_label)
         self.layout.addLayout(memory_layout)
         self.layout.addWidget(self.file_queue_frames)
+        self.layout.addLayout(compression_layout)
+        self.layout.addWidget(self.lossless_check)
+        if self.last_recording_label is not None:
+            self.layout.addWidget(self.last_recording_label)
         self.layout.addWidget(btns)
         self.setLayout(self.layout)
     
     def prefix_edited(self):
-        self.prefix_preview.setText('<i>{}_00000.tiff</i>'.format(self.prefix_edit.text()))
+        self.prefix_preview.setText('<i>{}.hpr</i>'.format(self.prefix_edit.text() or 'recording'))
+
+    def compression_edited(self, value):
+        enabled = value != 'none'
+        self.level_spin.setEnabled(enabled)
+        self.workers_spin.setEnabled(enabled)
+        if enabled:
+            self.level_spin.setValue(COMPRESSIONS[value])
 
     def skip_edited(self, value):
         if self.frame_rate > 0:
@@ -432,6 +487,35 @@ class CameraGui(QtWidgets.QMainWindow):
         painter.drawLine(c_x, c_y - 15, c_x, c_y + 15)
         painter.end()
 
+    def draw_pipeline_stats(self, pixmap):
+        '''
+        Draws the timing statistics of the acquisition pipeline (see
+        `.Camera.pipeline_stats`) in the upper left corner.
+
+        Parameters
+        ----------
+        pixmap : `QPixmap`
+            The pixmap to draw on.
+        '''
+        stats = self.camera.pipeline_stats()
+        lines = ['{:.1f} fps{}, {} gaps ({} frames missed)'.format(stats['frame_rate'],
+                                                                   ' (idle)' if self.camera.adaptive_rate.idle else '',
+                                                                   stats['gaps'],
+                                                                   stats['missed_frames']),
+                 'stage: p50 / p95 / p99 (ms)']
+        for stage in ('snap', 'correct', 'preprocess', 'enqueue', 'display', 'write'):
+            if stats[stage]['count']:
+                lines.append('{}: {:.1f} / {:.1f} / {:.1f}'.format(stage,
+                                                                   stats[stage]['p50']*1000,
+                                                                   stats[stage]['p95']*1000,
+                                                                   stats[stage]['p99']*1000))
+        painter = QtGui.QPainter(pixmap)
+        painter.setPen(QtGui.QPen(QtGui.QColor(255, 255, 0)))
+        line_height = painter.fontMetrics().height()
+        for idx, line in enumerate(lines):
+            painter.drawText(10, 10 + (idx + 1)*line_height, line)
+        painter.end()
+
     def __init__(self, camera, image_edit=None, display_edit=None,
                  with_tracking=False, base_directory='.'):
         super(CameraGui, self).__init__()
@@ -441,6 +525,7 @@ class CameraGui(QtWidgets.QMainWindow):
                                                 with_tracking=with_tracking)
         self.base_directory = base_directory
         self.show_overlay = True
+        self.show_pipeline_stats = False
         self.with_tracking = with_tracking
         self.status_bar = QtWidgets.QStatusBar()
         self.task_abort_button = QtWidgets.QToolButton(clicked=self.abort_task)
@@ -498,8 +583,12 @@ class CameraGui(QtWidgets.QMainWindow):
         self.video = LiveFeedQt(self.camera,
                                 image_edit=self.image_edit,
                                 display_edit=self.display_edit,
-                                mouse_handler=self.video_mouse_press)
+                                mouse_handler=self.video_mouse_press,
+                                full_resolution=lambda: len(self.image_edit_funcs) > 0)
         self.recording_settings = {}
+        self.recording_timer = QtCore.QTimer(self)
+        self.recording_timer.setInterval(500)
+        self.recording_timer.timeout.connect(self.update_recording_status)
         self.setFocus()  # Need this to handle arrow keys, etc.
         self.interface_signals = {self.camera_interface: (self.camera_signal,
                                                           self.camera_reset_signal)}
@@ -538,6 +627,8 @@ class CameraGui(QtWidgets.QMainWindow):
         if self.show_overlay:
             for func in self.display_edit_funcs:
                 func(pixmap)
+        if self.show_pipeline_stats:
+            self.draw_pipeline_stats(pixmap)
 
     def image_edit(self, image):
         '''
@@ -578,7 +669,9 @@ class CameraGui(QtWidgets.QMainWindow):
         else:
             dlg = RecordingDialog(self.base_directory, frame_rate=self.camera.get_frame_rate(),
                                   pixels=self.camera.width * self.camera.height,
-                                  settings=self.recording_settings, parent=self)
+                                  settings=self.recording_settings,
+                                  last_recording=self.camera.recording_stats(),
+                                  parent=self)
             if dlg.exec_():
                 directory = os.path.abspath(dlg.directory_edit.text())
                 prefix = dlg.prefix_edit.text()
@@ -587,11 +680,42 @@ class CameraGui(QtWidgets.QMainWindow):
                 self.recording_settings['memory'] = memory
                 skip_frames = dlg.skip_spin.value()
                 self.recording_settings['skip_frames'] = skip_frames
+                compression = dlg.compression_combo.currentText()
+                self.recording_settings['compression'] = compression
+                compression_level = dlg.level_spin.value()
+                self.recording_settings['compression_level'] = compression_level
+                workers = dlg.workers_spin.value()
+                self.recording_settings['workers'] = workers
+                lossless = dlg.lossless_check.isChecked()
+                self.recording_settings['lossless'] = lossless
+                if compression == 'none':
+                    compression = compression_level = None
                 queue_size = int(memory*1e6/(self.camera.width * self.camera.height)) + 1
                 self.camera.start_recording(directory=directory, file_prefix=prefix,
-                                            skip_frames=skip_frames, queue_size=queue_size)
+                                            skip_frames=skip_frames, queue_size=queue_size,
+                                            compression=compression,
+                                            compression_level=compression_level,
+                                            workers=workers, lossless=lossless)
                 self.is_recording = True
+                self.recording_timer.start()
         self.record_button.setChecked(self.is_recording)
+        self.update_recording_status()
+
+    def update_recording_status(self):
+        '''
+        Shows the frame counts of the current recording in the status bar,
+        until all frames have been written to disk.
+        '''
+        stats = self.camera.recording_stats()
+        if stats is None or not (self.is_recording or stats['active']):
+            self.recording_timer.stop()
+            if 'recording' in self.status_messages:
+                self.set_status_message('recording', None)
+            if stats is not None:
+                self.status_bar.showMessage('Recording finished: ' + format_recording_stats(stats), 5000)
+            return
+        prefix = 'Recording' if self.is_recording else 'Finishing recording'
+        self.set_status_message('recording', '{}: {}'.format(prefix, format_recording_stats(stats)))
 
     def register_commands(self):
         '''
@@ -616,6 +740,8 @@ class CameraGui(QtWidgets.QMainWindow):
                                  self.camera_interface.save_image)
         self.register_key_action(Qt.Key_I, Qt.SHIFT,
                                  self.toggle_recording)
+        self.register_key_action(Qt.Key_L, Qt.SHIFT,
+                                 self.toggle_pipeline_stats)
 
     def close(self):
         '''
@@ -680,6 +806,7 @@ class CameraGui(QtWidgets.QMainWindow):
             # displayed image is not necessarily the same size as the original camera image
             scale = 1.0 * self.camera.width / self.video.pixmap().size().width()
             position = (xs * scale, ys * scale)
+            self.camera.adaptive_rate.wake()
             if command.is_blocking:
                 self.start_task(command.task_description, command.__self__)
             if command.__self__ in self.interface_signals:
@@ -748,6 +875,8 @@ class CameraGui(QtWidgets.QMainWindow):
         self.task_abort_button.setVisible(True)
         self.running_task = task_name
         self.running_task_interface = interface
+        # Tasks move devices and analyze images without user interaction
+        self.camera.adaptive_rate.demand_full_rate()
 
     def abort_task(self):
         self.task_abort_button.setEnabled(False)
@@ -764,6 +893,7 @@ class CameraGui(QtWidgets.QMainWindow):
 
         self.task_progress.setVisible(False)
         self.task_abort_button.setVisible(False)
+        self.camera.adaptive_rate.release_full_rate()
         # 0: correct execution (no need to show a message)
         if exit_reason == 0:
             text = "Task '{}' finished successfully.".format(self.running_task)
@@ -813,6 +943,7 @@ class CameraGui(QtWidgets.QMainWindow):
                 # (we allow the "General" category to still allow to see the
                 # help, etc.)
                 return
+            self.camera.adaptive_rate.wake()
             if command.is_blocking:
                 self.start_task(command.task_description, command.__self__)
             if command.__self__ in self.interface_signals:
@@ -888,6 +1019,11 @@ class CameraGui(QtWidgets.QMainWindow):
     def toggle_overlay(self):
         self.show_overlay = not self.show_overlay
 
+    @command(category='Camera',
+             description='Show/hide the timing statistics of the acquisition pipeline')
+    def toggle_pipeline_stats(self):
+        self.show_pipeline_stats = not self.show_pipeline_stats
+
     def activate_configuration_display(self):
         current_sizes = self.splitter.sizes()
         if current_sizes[1] == 0:
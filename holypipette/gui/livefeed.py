@@ -2,22 +2,36 @@ from __future__ import print_function
 from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtCore import Qt
 
+import threading
 import traceback
 import numpy as np
 
+from holypipette.devices.camera.framepool import PYRAMID_LEVELS
+
 
 __all__ = ['LiveFeedQt']
 
 
 class LiveFeedQt(QtWidgets.QLabel):
+    #: Emitted (from a background thread) when the camera has a new frame
+    frame_available = QtCore.pyqtSignal()
+
     def __init__(self, camera, image_edit=None, display_edit=None,
-                 mouse_handler=None, parent=None):
+                 mouse_handler=None, full_resolution=None, parent=None):
         super(LiveFeedQt, self).__init__(parent=parent)
         # The image_edit function (does nothing by default) gets the raw
         # unscaled image (i.e. a numpy array), while the display_edit
         # function gets a QPixmap and is meant to draw GUI elements in
         # "display space" (by default, a red cross in the middle of the
         # screen).
+        # Frames that are shown smaller than their original size are taken
+        # from the frame's image pyramid, unless image_edit needs the full
+        # resolution image (full_resolution is a function returning whether
+        # this is the case, by default whenever image_edit is set)
+        if full_resolution is None:
+            needs_full_resolution = image_edit is not None
+            full_resolution = lambda: needs_full_resolution
+        self.full_resolution = full_resolution
         if image_edit is None:
             image_edit = lambda frame: frame
         self.image_edit = image_edit
@@ -36,13 +50,50 @@ class LiveFeedQt(QtWidgets.QLabel):
         # Remember the last frame that we displayed, to not unnecessarily
         # process/show the same frame for slow input sources
         self._last_frameno = None
+        self._last_level = None
         self._last_edited_frame = None
+        self._last_displayed_frameno = None
 
+        self._update_pending = threading.Event()
         self.update_image()
 
+        # Update the image whenever the camera has a new frame
+        self.frame_available.connect(self.update_image)
+        subscription = self._frame_subscription = self.camera.subscribe(policy='latest')
+        self._frame_thread = threading.Thread(target=self._wait_for_frames,
+                                              name='livefeed_frames',
+                                              daemon=True)
+        self._frame_thread.start()
+        self.destroyed.connect(lambda *args: subscription.unsubscribe())
+
+        # Still redraw regularly if there are no new frames (e.g. for
+        # overlays drawn by display_edit)
         timer = QtCore.QTimer(self)
         timer.timeout.connect(self.update_image)
-        timer.start(50) #20 Hz
+        timer.start(500)
+
+    def _wait_for_frames(self):
+        for frame in self._frame_subscription:
+            frame.release()  # we only display the camera's latest frame
+            # Do not queue up more than one update if the GUI is busy
+            if not self._update_pending.is_set():
+                self._update_pending.set()
+                self.frame_available.emit()
+
+    def _display_level(self, frame):
+        '''
+        The smallest pyramid level of the frame that is still at least as
+        large as the displayed image.
+        '''
+        if self.full_resolution():
+            return 0
+        height, width = frame.raw.shape[:2]
+        size = self.size()
+        scale = min(size.width() / width, size.height() / height)
+        level = 0
+        while level < PYRAMID_LEVELS and scale <= 0.5**(level + 1):
+            level += 1
+        return level
 
     def mousePressEvent(self, event):
         # Ignore clicks that are not on the image
@@ -58,34 +109,44 @@ class LiveFeedQt(QtWidgets.QLabel):
 
     @QtCore.pyqtSlot()
     def update_image(self):
+        self._update_pending.clear()
+        # get last frame from camera (the reference makes sure that it does
+        # not get overwritten while we are using it)
+        last_frame = self.camera.borrow_last_frame()
+        if last_frame is None:
+            return  # No frame acquired yet
         try:
-            # get last frame from camera
-            frameno, frame = self.camera.last_frame()
-            if frame is None:
-                return  # Frame acquisition thread has stopped
-            if self._last_frameno is None or self._last_frameno != frameno:
+            frameno = last_frame.number
+            level = self._display_level(last_frame)
+            if (self._last_frameno is None or self._last_frameno != frameno or
+                    self._last_level != level):
                 # No need to preprocess a frame again if it has not changed
-                frame = self.image_edit(frame)
+                frame = self.image_edit(last_frame.downsampled(level, 'processed'))
             
                 self._last_edited_frame = frame
                 self._last_frameno = frameno
+                self._last_level = level
             else:
                 frame = self._last_edited_frame
             
+            if frame.dtype == np.dtype('uint16'):
+                # 16-bit image (e.g. from image_edit), map it for display
+                frame = self.camera.display_lut.apply(frame, out=self.camera.display_lut.buffer(frame.shape))
+            height, width = frame.shape[:2]
             if len(frame.shape) == 2:
                 # Grayscale image via MicroManager
                 if frame.dtype == np.dtype('uint32'):
-                    bytesPerLine = self.width*4
+                    bytesPerLine = width*4
                     format = QtGui.QImage.Format_RGB32
                 else:
-                    bytesPerLine = self.width
+                    bytesPerLine = width
                     format = QtGui.QImage.Format_Indexed8
             else:
                 # Color image via OpenCV
-                bytesPerLine = 3*self.width
+                bytesPerLine = 3*width
                 format = QtGui.QImage.Format_RGB888
             
-            q_image = QtGui.QImage(frame.data, self.width, self.height,
+            q_image = QtGui.QImage(frame.data, width, height,
                                    bytesPerLine, format)
 
             if format == QtGui.QImage.Format_RGB888:
@@ -102,6 +163,11 @@ class LiveFeedQt(QtWidgets.QLabel):
             if self.display_edit is not None:
                 self.display_edit(scaled_pixmap)
             self.setPixmap(scaled_pixmap)
+            if frameno != self._last_displayed_frameno:
+                self.camera.timing.record_latency('display', last_frame.timestamp)
+                self._last_displayed_frameno = frameno
 
         except Exception:
             print(traceback.format_exc())
+        finally:
+            last_frame.release()
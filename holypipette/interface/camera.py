@@ -36,6 +36,31 @@ class CameraInterface(TaskInterface):
         self.camera.auto_exposure()
         self.signal_updated_exposure()
 
+    @command(category='Camera',
+             description='Toggle continuous auto exposure')
+    def toggle_continuous_exposure(self):
+        if self.camera.continuous_auto_exposure:
+            self.camera.stop_auto_exposure()
+        else:
+            self.camera.start_auto_exposure()
+
+    @blocking_command(category='Camera',
+                      description='Capture the dark frame for flat-field correction',
+                      task_description='Capturing dark frame')
+    def capture_dark_frame(self):
+        self.camera.capture_dark_frame()
+
+    @blocking_command(category='Camera',
+                      description='Capture the flat frame for flat-field correction',
+                      task_description='Capturing flat frame')
+    def capture_flat_frame(self):
+        self.camera.capture_flat_frame()
+
+    @command(category='Camera',
+             description='Toggle flat-field correction')
+    def toggle_flat_field(self):
+        self.camera.flat_field.enabled = not self.camera.flat_field.enabled
+
     @command(category='Camera',
              description='Increase exposure time by {:.1f}ms',
              default_arg=2.5)
@@ -64,7 +89,7 @@ class CameraInterface(TaskInterface):
         except ImportError:
             self.error('Saving images needs the PIL or Pillow module')
             return
-        frame, _ = self.camera.snap()
+        frame = self.camera.grab()
         fname, _ = QtWidgets.QFileDialog.getSaveFileName(caption='Save image',
                                                          filter='Images (*.png, *.tiff)',
                                                          options=QtWidgets.QFileDialog.DontUseNativeDialog)
@@ -0,0 +1,179 @@
+'''
+Pluggable clock for the timing of tasks and simulated devices.
+
+Code that waits for (or measures) physical processes -- the movement of a
+manipulator, the formation of a seal, a pressure ramp -- uses the `time` and
+`sleep` functions of this module instead of the functions of the standard
+`time` module. By default, they forward to the wall clock (`RealClock`). For
+the simulated rig, the clock can be replaced with `set_clock`:
+
+* `AcceleratedClock` runs faster than real time by a constant factor.
+* `SimulatedClock` only advances when `sleep` is called, and sleeping returns
+  immediately. Runs are therefore as fast as possible and do not depend on the
+  load of the machine. Time advances with every call of `sleep`, so this clock
+  is meant for a single thread running a task (e.g. in headless tests).
+
+The camera acquisition (frame timestamps, frame rates) always uses real time.
+'''
+import threading
+import time as _time
+
+__all__ = ['Clock', 'RealClock', 'AcceleratedClock', 'SimulatedClock',
+           'clock_from_string', 'get_clock', 'set_clock', 'time', 'sleep']
+
+
+class Clock(object):
+    '''
+    Base class for clocks.
+    '''
+    def time(self):
+        '''The current time in seconds (as `time.time`).'''
+        raise NotImplementedError()
+
+    def sleep(self, seconds):
+        '''Wait for the given time in seconds (as `time.sleep`).'''
+        raise NotImplementedError()
+
+    def add_listener(self, listener):
+        '''
+        Register a function that is called as ``listener(time)`` whenever the
+        time jumps forward (only for `SimulatedClock`, ignored otherwise).
+        '''
+        pass
+
+    def remove_listener(self, listener):
+        '''Remove a function registered with `add_listener`.'''
+        pass
+
+
+class RealClock(Clock):
+    '''
+    The wall clock.
+    '''
+    def time(self):
+        return _time.time()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            _time.sleep(seconds)
+
+    def __repr__(self):
+        return 'RealClock()'
+
+
+class AcceleratedClock(Clock):
+    '''
+    A clock that runs faster than real time.
+
+    Parameters
+    ----------
+    factor : float, optional
+        The number of simulated seconds per real second. Defaults to 100.
+    '''
+    def __init__(self, factor=100.):
+        if factor <= 0:
+            raise ValueError('"factor" has to be positive')
+        self.factor = factor
+        self._start = _time.time()
+
+    def time(self):
+        return self._start + (_time.time() - self._start) * self.factor
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            _time.sleep(seconds / self.factor)
+
+    def __repr__(self):
+        return 'AcceleratedClock(factor={})'.format(self.factor)
+
+
+class SimulatedClock(Clock):
+    '''
+    A clock that only advances when `sleep` is called.
+    Simulations registered with `add_listener` are advanced right after the
+    time jumped forward, in the sleeping thread.
+
+    Parameters
+    ----------
+    start : float, optional
+        The initial time. Defaults to 0, so that the simulated times (and
+        their rounding errors) do not depend on the time of the run.
+    '''
+    def __init__(self, start=0.):
+        self._lock = threading.Lock()
+        self._now = start
+        self._listeners = []
+
+    def time(self):
+        return self._now
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            with self._lock:
+                self._now += seconds
+                now = self._now
+            # Simulations advance with the clock, in the sleeping thread
+            for listener in list(self._listeners):
+                listener(now)
+        # Let other threads run
+        _time.sleep(0)
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def __repr__(self):
+        return 'SimulatedClock()'
+
+
+def clock_from_string(description):
+    '''
+    Create a clock from a short description: ``'real'``, ``'simulated'``,
+    ``'accelerated'``, or ``'accelerated:<factor>'`` (e.g.
+    ``'accelerated:20'``).
+    '''
+    name, _, argument = description.strip().lower().partition(':')
+    if name == 'real':
+        return RealClock()
+    elif name == 'simulated':
+        return SimulatedClock()
+    elif name == 'accelerated':
+        return AcceleratedClock(float(argument)) if argument else AcceleratedClock()
+    raise ValueError('Unknown clock "{}", has to be "real", "simulated", or '
+                     '"accelerated[:factor]"'.format(description))
+
+
+_clock = RealClock()
+
+
+def get_clock():
+    '''The clock used by `time` and `sleep`.'''
+    return _clock
+
+
+def set_clock(clock):
+    '''
+    Replace the clock used by `time` and `sleep`.
+
+    Parameters
+    ----------
+    clock : `Clock` or str
+        The new clock, or its description (see `clock_from_string`).
+    '''
+    global _clock
+    if isinstance(clock, str):
+        clock = clock_from_string(clock)
+    _clock = clock
+
+
+def time():
+    '''The current time in seconds, according to the current clock.'''
+    return _clock.time()
+
+
+def sleep(seconds):
+    '''Wait for the given time in seconds, according to the current clock.'''
+    _clock.sleep(seconds)
@@ -0,0 +1,90 @@
+'''
+Seeds and manifests of simulated sessions.
+
+All random draws of the simulated rig (cell and pipette properties, seal
+formation, measurement and camera noise) use `numpy.random.Generator` objects
+that are derived from a single rig seed, one independent generator per
+component. The seed (together with the clock) is stored in a session
+manifest, so that a run can be repeated with exactly the same random draws.
+'''
+import json
+import os
+import platform
+import sys
+import time
+import zlib
+
+import numpy as np
+
+__all__ = ['new_seed', 'component_generator', 'write_manifest', 'read_manifest']
+
+
+def new_seed():
+    '''A new random rig seed (from the operating system's entropy).'''
+    return int(np.random.SeedSequence().entropy)
+
+
+def component_generator(seed, name):
+    '''
+    The random number generator of a simulated component.
+
+    Parameters
+    ----------
+    seed : int
+        The rig seed.
+    name : str
+        The name of the component (e.g. ``'camera'``). Generators of
+        different components are statistically independent, and only depend
+        on the seed and the name (not on the order of their creation).
+
+    Returns
+    -------
+    rng : `numpy.random.Generator`
+        The generator.
+    '''
+    sequence = np.random.SeedSequence(seed, spawn_key=(zlib.crc32(name.encode('utf-8')),))
+    return np.random.default_rng(sequence)
+
+
+def write_manifest(filename, seed, clock='real', **extra):
+    '''
+    Write the manifest of a simulated session as JSON.
+
+    Parameters
+    ----------
+    filename : str
+        The name of the manifest file (its directory is created if
+        necessary).
+    seed : int
+        The rig seed.
+    clock : str, optional
+        The description of the clock (see `.clock.clock_from_string`).
+        Defaults to ``'real'``.
+    extra
+        Additional (JSON-serializable) entries.
+    '''
+    manifest = {'seed': seed,
+                'clock': clock,
+                'start_time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'argv': sys.argv,
+                'python': platform.python_version(),
+                'numpy': np.__version__}
+    manifest.update(extra)
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(filename, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+
+def read_manifest(filename):
+    '''
+    Read a manifest written with `write_manifest`.
+
+    Returns
+    -------
+    manifest : dict
+        The entries of the manifest (including ``'seed'`` and ``'clock'``).
+    '''
+    with open(filename) as f:
+        return json.load(f)
@@ -1,6 +1,20 @@
 '''
 "Fake setup" for GUI development on a computer without access to a rig
+
+The timing of the simulated devices and of the tasks can be changed with the
+HOLYPIPETTE_CLOCK environment variable (see `holypipette.utils.clock`):
+"real" (default), "simulated" (time only advances while tasks wait), or
+"accelerated:<factor>" (e.g. "accelerated:100").
+
+All random draws of the simulation are derived from a single seed, taken from
+the HOLYPIPETTE_SEED environment variable (a new seed if it is not set). The
+seed and the clock are stored in a session manifest in the telemetry folder.
+To repeat a session, set HOLYPIPETTE_REPLAY to the name of its manifest.
 '''
+import os
+import time
+
+from holypipette.utils import clock, session
 from holypipette.devices.amplifier.amplifier import FakeAmplifier
 from holypipette.devices.amplifier.DAQ import FakeDAQ
 from holypipette.devices.pressurecontroller import FakePressureController
@@ -8,6 +22,17 @@ from holypipette.devices.camera.camera import FakeCamera
 from holypipette.devices.camera import FakeCalCamera, WorldModel
 from holypipette.devices.manipulator import *
 
+if os.environ.get('HOLYPIPETTE_REPLAY'):
+    manifest = session.read_manifest(os.environ['HOLYPIPETTE_REPLAY'])
+    seed, clock_description = manifest['seed'], manifest['clock']
+else:
+    seed = int(os.environ.get('HOLYPIPETTE_SEED') or session.new_seed())
+    clock_description = os.environ.get('HOLYPIPETTE_CLOCK', 'real')
+clock.set_clock(clock_description)
+session.write_manifest('telemetry/session_' + time.strftime("%Y%m%d-%H%M%S") + '.json',
+                       seed, clock_description)
+print('Simulation seed: {} (clock: {})'.format(seed, clock_description))
+
 controller = FakeManipulator(min=[-1000, -1000, -1000],
                              max=[1000, 1000, 1000])
 pipetteManip = FakeManipulator(min=[-1000, -1000, -50],
@@ -19,13 +44,15 @@ pipetteManip.x = [200, 300, 125] # start with pipette in frame
 controller.x = [0, 0, 0]
 
 pressure = FakePressureController()
-worldModel = WorldModel(pipette=pipetteManip, pressure=pressure)
-camera = FakeCalCamera(stageManip=controller, pipetteManip=pipetteManip, image_z=0, worldModel=worldModel)
+worldModel = WorldModel(pipette=pipetteManip, pressure=pressure,
+                        rng=session.component_generator(seed, 'world'))
+camera = FakeCalCamera(stageManip=controller, pipetteManip=pipetteManip, image_z=0, worldModel=worldModel,
+                       rng=session.component_generator(seed, 'camera'))
 
 microscope = Microscope(controller, 3)
 microscope.up_direction = 1.0
 
 unit = ManipulatorUnit(pipetteManip, [1, 2, 3])
 
-daq = FakeDAQ(worldModel=worldModel)
+daq = FakeDAQ(worldModel=worldModel, rng=session.component_generator(seed, 'daq'))
 amplifier = FakeAmplifier(worldModel=worldModel)